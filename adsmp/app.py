@@ -2,29 +2,84 @@
 from __future__ import absolute_import, unicode_literals
 from past.builtins import basestring
 from . import exceptions
-from adsmp.models import ChangeLog, IdentifierMapping, MetricsBase, MetricsModel, Records
+from adsmp.models import ChangeLog, Fulltext, IdentifierMapping, IndexRequest, MetricsBase, MetricsModel, Records
 from adsmsg import OrcidClaims, DenormalizedRecord, FulltextUpdate, MetricsRecord, NonBibRecord, NonBibRecordList, MetricsRecordList, AugmentAffiliationResponseRecord, AugmentAffiliationResponseRecordList, AugmentAffiliationRequestRecord, AugmentAffiliationRequestRecordList
 from adsmsg.msg import Msg
 from adsputils import ADSCelery, create_engine, sessionmaker, scoped_session, contextmanager
-from sqlalchemy.orm import load_only as _load_only
-from sqlalchemy import Table, bindparam
+from sqlalchemy.orm import load_only as _load_only, selectinload
+from sqlalchemy import Table, bindparam, text
 import adsputils
 import json
-from adsmp import solr_updater
+import requests
+from adsmp import solr_updater, http_client, instrumentation
 from adsputils import serializer
 from sqlalchemy import exc
+import multiprocessing
 from multiprocessing.util import register_after_fork
 import zlib
-import requests
-from copy import deepcopy
 import sys
+import re
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+
+# solr is unreachable: splitting the batch would only repeat the failure
+_solr_unavailable = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+_changelog_partition_name = re.compile(r'^change_log_y(\d{4})m(\d{2})$')
+# catches the rows of months that have no partition (see ensure_changelog_partitions)
+_changelog_default = 'change_log_default'
+
+
+def _next_month(d):
+    return datetime(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+
+def _checksum(data, ignore_keys=('mtime', 'ctime', 'update_timestamp')):
+    """See ADSMasterPipelineCelery.checksum"""
+    assert isinstance(ignore_keys, tuple)
+
+    if isinstance(data, basestring):
+        if sys.version_info > (3,):
+            data_str = data.encode('utf-8')
+        else:
+            data_str = unicode(data)
+        return hex(zlib.crc32(data_str) & 0xffffffff)
+    else:
+        # skip all the modification timestamps without copying the data, then
+        # feed json.dumps(data, sort_keys=True) key by key into a running crc
+        keys = sorted(k for k in data if not any(x in k for x in ignore_keys))
+        crc = zlib.crc32(b'{')
+        for i, k in enumerate(keys):
+            chunk = '%s%s: %s' % (i and ', ' or '', json.dumps(k), json.dumps(data[k], sort_keys=True))
+            crc = zlib.crc32(chunk.encode('utf-8'), crc)
+        crc = zlib.crc32(b'}', crc)
+        return hex(crc & 0xffffffff)
+
+
+def _solr_doc(db_record):
+    """Returns the solr document built from a db record and its checksum;
+    module level so that it can run in the transform process pool"""
+    solr_payload = solr_updater.transform_json_record(db_record)
+    # ADS microservices assume the identifier field exists and contains the canonical bibcode:
+    if 'identifier' not in solr_payload:
+        solr_payload['identifier'] = []
+    if 'bibcode' in solr_payload and solr_payload['bibcode'] not in solr_payload['identifier']:
+        solr_payload['identifier'].append(solr_payload['bibcode'])
+    return solr_payload, _checksum(solr_payload)
 
 
 class ADSMasterPipelineCelery(ADSCelery):
 
     def __init__(self, app_name, *args, **kwargs):
         ADSCelery.__init__(self, app_name, *args, **kwargs)
+        # number of payloads written/skipped as unchanged by update_storage(_bulk), per type
+        self.storage_written = Counter()
+        self.storage_skipped = Counter()
+        self._transform_pool = None
         # this is used for bulk/efficient updates to metrics db
         self._metrics_engine = self._metrics_session = None
         if self._config.get('METRICS_SQLALCHEMY_URL', None):
@@ -76,16 +131,24 @@ class ADSMasterPipelineCelery(ADSCelery):
         """Update the document in the database, every time
         empty the solr/metrics processed timestamps.
 
+        When the payload is identical to the stored one (same payload
+        checksum) nothing is written and the record is not marked as updated.
+
         returns the sql record as a json object or an error string """
 
-        if not isinstance(payload, basestring):
-            payload = json.dumps(payload)
+        payload = self._parse_payload(payload)
+        checksum = self.payload_checksum(payload)
+        checksum_column = type in self._storage_columns and self._storage_columns[type][0] + '_payload_checksum' or None
 
         with self.session_scope() as session:
             r = session.query(Records).filter_by(bibcode=bibcode).first()
             if r is None:
                 r = Records(bibcode=bibcode)
                 session.add(r)
+            elif checksum_column and getattr(r, checksum_column) == checksum:
+                self._count_storage('skipped', type, 1)
+                self.logger.debug('Skipping unchanged %s for %s', type, bibcode)
+                return r.toJSON(load_only=Records._row_fields)
             now = adsputils.get_date()
             oldval = None
             if type == 'metadata' or type == 'bib_data':
@@ -116,27 +179,309 @@ class ADSMasterPipelineCelery(ADSCelery):
                 r.augments_updated = now
             else:
                 raise Exception('Unknown type: %s' % type)
+            if oldval is not None and oldval != 'not-stored':
+                oldval = json.dumps(oldval)
             session.add(ChangeLog(key=bibcode, type=type, oldvalue=oldval))
 
+            setattr(r, checksum_column, checksum)
             r.updated = now
-            out = r.toJSON()
+            # the fulltext is only loaded (and returned) when it is what changed
+            out = r.toJSON(load_only=None if type == 'fulltext' else Records._row_fields)
             try:
                 session.commit()
+                self._count_storage('written', type, 1)
                 return out
             except exc.IntegrityError:
                 self.logger.exception('error in app.update_storage while updating database for bibcode {}, type {}'.format(bibcode, type))
                 session.rollback()
                 raise
 
+    def _count_storage(self, what, type, n):
+        """Counts the written/skipped (unchanged) records per type, in
+        storage_written/storage_skipped and as instrumentation counts
+        (task update_storage, stage <type>_<what>)"""
+        if not n:
+            return
+        getattr(self, 'storage_' + what)[type] += n
+        instrumentation.count('update_storage', '%s_%s' % (type, what), records=n)
+
+    def _parse_payload(self, payload):
+        """Payloads are stored as json (jsonb on postgres): strings must be
+        serialized json, anything else is rejected with a ValueError"""
+        if isinstance(payload, basestring):
+            try:
+                return json.loads(payload)
+            except ValueError:
+                raise ValueError('Payload is not valid json: %s' % payload[:100])
+        return payload
+
+    def payload_checksum(self, payload):
+        """Checksum of a payload as it is stored (dict, list, None...), kept in
+        the <column>_payload_checksum columns to detect unchanged updates"""
+        if isinstance(payload, dict):
+            return self.checksum(payload, ignore_keys=())
+        return self.checksum(json.dumps(payload, sort_keys=True))
+
+    # maps message type to (payload column, timestamp column, keep old value in change log)
+    _storage_columns = {
+        'metadata': ('bib_data', 'bib_data_updated', True),
+        'bib_data': ('bib_data', 'bib_data_updated', True),
+        'nonbib_data': ('nonbib_data', 'nonbib_data_updated', True),
+        'orcid_claims': ('orcid_claims', 'orcid_claims_updated', True),
+        'fulltext': ('fulltext', 'fulltext_updated', False),
+        'metrics': ('metrics', 'metrics_updated', False),
+        'augment': ('augments', 'augments_updated', False),
+    }
+
+    def update_storage_bulk(self, type, records):
+        """Bulk version of update_storage, used for the list messages
+        (nonbib and metrics). All rows are fetched with one query, upserted
+        with one statement and change log entries are inserted in bulk;
+        there is only one commit per call. Payloads identical to the
+        stored ones are skipped.
+
+        :param: type - string, same values as accepted by update_storage
+        :param: records - list of (bibcode, payload) tuples
+        :return: list of bibcodes that were saved
+        """
+        if type not in self._storage_columns:
+            raise Exception('Unknown type: %s' % type)
+        if not records:
+            return []
+        column, updated_column, keep_oldvalue = self._storage_columns[type]
+        checksum_column = column + '_payload_checksum'
+
+        now = adsputils.get_date()
+        # a bibcode may only appear once in an upsert statement, the last payload wins
+        values = {}
+        for bibcode, payload in records:
+            try:
+                payload = self._parse_payload(payload)
+            except ValueError as e:
+                self.logger.error('Not saving %s of %s: %s', type, bibcode, e)
+                continue
+            values[bibcode] = {'bibcode': bibcode, column: payload, updated_column: now, 'updated': now,
+                               checksum_column: self.payload_checksum(payload)}
+
+        with self.session_scope() as session:
+            oldvalues = {}
+            skipped = 0
+            stored = [Records.bibcode, getattr(Records, checksum_column)]
+            if keep_oldvalue:
+                stored.append(getattr(Records, column))
+            for row in session.query(*stored).filter(Records.bibcode.in_(list(values.keys()))):
+                if row[1] == values[row[0]][checksum_column]:
+                    del values[row[0]]
+                    skipped += 1
+                elif keep_oldvalue:
+                    oldvalues[row[0]] = row[2] if row[2] is None else json.dumps(row[2])
+            self._count_storage('skipped', type, skipped)
+            if not values:
+                return []
+
+            bibcodes = list(values.keys())
+            values = list(values.values())
+            fulltexts = None
+            if column == 'fulltext':
+                # stored in its own table
+                fulltexts = [{'bibcode': v['bibcode'], 'data': v.pop(column)} for v in values]
+
+            dialect_insert = insert if session.get_bind().dialect.name == 'postgresql' else sqlite_insert
+            upsert = dialect_insert(Records.__table__)
+            set_ = {updated_column: getattr(upsert.excluded, updated_column),
+                    checksum_column: getattr(upsert.excluded, checksum_column),
+                    'updated': getattr(upsert.excluded, 'updated')}
+            if fulltexts is None:
+                set_[column] = getattr(upsert.excluded, column)
+            upsert = upsert.on_conflict_do_update(index_elements=['bibcode'], set_=set_)
+            changes = [{'key': bibcode, 'type': type, 'oldvalue': oldvalues.get(bibcode) if keep_oldvalue else 'not-stored', 'created': now}
+                       for bibcode in bibcodes]
+            try:
+                session.execute(upsert, values)
+                if fulltexts is not None:
+                    fulltext_upsert = dialect_insert(Fulltext.__table__)
+                    fulltext_upsert = fulltext_upsert.on_conflict_do_update(index_elements=['bibcode'],
+                                                                            set_={'data': fulltext_upsert.excluded.data})
+                    session.execute(fulltext_upsert, fulltexts)
+                session.execute(ChangeLog.__table__.insert(), changes)
+                session.commit()
+                self._count_storage('written', type, len(bibcodes))
+                return bibcodes
+            except exc.IntegrityError:
+                self.logger.exception('error in app.update_storage_bulk while updating database for %s bibcodes, type %s', len(bibcodes), type)
+                session.rollback()
+                raise
+
     def delete_by_bibcode(self, bibcode):
         with self.session_scope() as session:
             r = session.query(Records).filter_by(bibcode=bibcode).first()
             if r is not None:
-                session.add(ChangeLog(key='bibcode:%s' % bibcode, type='deleted', oldvalue=serializer.dumps(r.toJSON())))
+                session.add(ChangeLog(key='bibcode:%s' % bibcode, type='deleted', oldvalue=serializer.dumps(r.toJSON(load_only=Records._row_fields))))
                 session.delete(r)
+                session.query(Fulltext).filter_by(bibcode=bibcode).delete(synchronize_session=False)
                 session.commit()
                 return True
 
+    def delete_by_bibcodes(self, bibcodes):
+        """Deletes many records in one transaction, every deleted record
+        gets its entry in the change log.
+
+        @return: list of bibcodes that were found and deleted
+        """
+        deleted = []
+        if not bibcodes:
+            return deleted
+        with self.session_scope() as session:
+            for r in session.query(Records).filter(Records.bibcode.in_(bibcodes)):
+                session.add(ChangeLog(key='bibcode:%s' % r.bibcode, type='deleted', oldvalue=serializer.dumps(r.toJSON(load_only=Records._row_fields))))
+                deleted.append(r.bibcode)
+            session.query(Records).filter(Records.bibcode.in_(deleted)).delete(synchronize_session=False)
+            session.query(Fulltext).filter(Fulltext.bibcode.in_(deleted)).delete(synchronize_session=False)
+            session.commit()
+        return deleted
+
+    def _changelog_partitioned(self, session):
+        if session.get_bind().dialect.name != 'postgresql':
+            return False
+        return session.execute(text("SELECT relkind FROM pg_class WHERE relname = 'change_log'")).scalar() == 'p'
+
+    def _changelog_partitions(self, session):
+        """@return: dict of the monthly partitions, name -> (start, end)"""
+        out = {}
+        for (name,) in session.execute(text("SELECT c.relname FROM pg_inherits i "
+                                            "JOIN pg_class c ON c.oid = i.inhrelid "
+                                            "JOIN pg_class p ON p.oid = i.inhparent "
+                                            "WHERE p.relname = 'change_log'")):
+            m = _changelog_partition_name.match(name)
+            if m:
+                start = datetime(int(m.group(1)), int(m.group(2)), 1)
+                out[name] = (start, _next_month(start))
+        return out
+
+    def _changelog_months_in_default(self, session):
+        """@return: first day of every month that has rows in the default partition"""
+        return set(m.replace(tzinfo=None) for (m,) in session.execute(
+            text("SELECT DISTINCT date_trunc('month', created) FROM {}".format(_changelog_default))))
+
+    def _create_changelog_partition(self, session, start):
+        """Creates the partition for the month starting at start. Rows of that
+        month that went to the default partition (because the partition was
+        missing) are moved into it: postgres refuses to create a partition
+        when the default partition holds rows of its range."""
+        end = _next_month(start)
+        name = 'change_log_y%04dm%02d' % (start.year, start.month)
+        create = text("CREATE TABLE {} PARTITION OF change_log FOR VALUES FROM ('{}') TO ('{}')"
+                      .format(name, start.isoformat(), end.isoformat()))
+        in_range = "created >= '{}' AND created < '{}'".format(start.isoformat(), end.isoformat())
+        moved = session.execute(text('SELECT count(*) FROM {} WHERE {}'.format(_changelog_default, in_range))).scalar()
+        if moved:
+            session.execute(text('ALTER TABLE change_log DETACH PARTITION {}'.format(_changelog_default)))
+            session.execute(create)
+            session.execute(text('INSERT INTO change_log (id, created, key, type, oldvalue, permanent) '
+                                 'SELECT id, created, key, type, oldvalue, permanent FROM {} WHERE {}'
+                                 .format(_changelog_default, in_range)))
+            session.execute(text('DELETE FROM {} WHERE {}'.format(_changelog_default, in_range)))
+            session.execute(text('ALTER TABLE change_log ATTACH PARTITION {} DEFAULT'.format(_changelog_default)))
+        else:
+            session.execute(create)
+        self.logger.info('Created change_log partition %s (%s entries moved from %s)', name, moved, _changelog_default)
+        return name
+
+    def ensure_changelog_partitions(self, months_ahead=None):
+        """Creates the monthly change_log partitions for the current month
+        and the following months_ahead months, and for every month that has
+        rows in the default partition (they are moved into it). Only does
+        something when change_log is a partitioned (postgres) table.
+
+        Called from run.py --prune-changelog; takes a lock that blocks the
+        writers while the partitions are created.
+
+        @return: list of created partitions
+        """
+        if months_ahead is None:
+            months_ahead = self.conf.get('CHANGELOG_PARTITIONS_AHEAD', 3)
+        start = adsputils.get_date().replace(day=1, hour=0, minute=0, second=0, microsecond=0, tzinfo=None)
+        wanted = set()
+        for i in range(months_ahead + 1):
+            wanted.add(start)
+            start = _next_month(start)
+
+        created = []
+        with self.session_scope() as session:
+            if not self._changelog_partitioned(session):
+                return created
+            existing = self._changelog_partitions(session)
+            missing = wanted.union(self._changelog_months_in_default(session))
+            missing = [m for m in missing if 'change_log_y%04dm%02d' % (m.year, m.month) not in existing]
+            if not missing:
+                return created
+            # writers (and a concurrent run) wait until the partitions exist
+            session.execute(text('LOCK TABLE change_log IN SHARE ROW EXCLUSIVE MODE'))
+            existing = self._changelog_partitions(session)
+            for start in sorted(wanted.union(self._changelog_months_in_default(session))):
+                if 'change_log_y%04dm%02d' % (start.year, start.month) not in existing:
+                    created.append(self._create_changelog_partition(session, start))
+            session.commit()
+        return created
+
+    def prune_changelog(self, older_than, archive=False, batch_size=None):
+        """Removes change log entries created before older_than; entries
+        marked as permanent are always kept.
+
+        When change_log is partitioned, every monthly partition that ends
+        before older_than is detached and dropped - or kept as a standalone
+        table <partition>_archived if archive is set. If it holds permanent
+        entries, a new partition for the same month is created with only
+        those. Whatever remains (e.g. in the default partition) is deleted in
+        batches, one short transaction each.
+
+        @return: number of removed entries
+        """
+        cutoff = adsputils.get_date(older_than)
+        batch_size = batch_size or self.conf.get('CHANGELOG_PRUNE_BATCH_SIZE', 10000)
+        removed = 0
+
+        with self.session_scope() as session:
+            if self._changelog_partitioned(session):
+                for name, (start, end) in sorted(self._changelog_partitions(session).items()):
+                    if end > cutoff.replace(tzinfo=None):
+                        continue
+                    count = session.execute(text('SELECT count(*) FROM {} WHERE permanent IS NOT TRUE'.format(name))).scalar()
+                    if not count:
+                        # nothing but permanent entries (left by an earlier run)
+                        continue
+                    session.execute(text('LOCK TABLE change_log IN SHARE ROW EXCLUSIVE MODE'))
+                    session.execute(text('ALTER TABLE change_log DETACH PARTITION {}'.format(name)))
+                    old = name + (archive and '_archived' or '_pruned')
+                    session.execute(text('ALTER TABLE {} RENAME TO {}'.format(name, old)))
+                    if session.execute(text('SELECT 1 FROM {} WHERE permanent IS TRUE LIMIT 1'.format(old))).scalar():
+                        self._create_changelog_partition(session, start)
+                        session.execute(text('INSERT INTO change_log (id, created, key, type, oldvalue, permanent) '
+                                             'SELECT id, created, key, type, oldvalue, permanent FROM {} '
+                                             'WHERE permanent IS TRUE'.format(old)))
+                    if archive:
+                        # the archived table must not depend on the id sequence of change_log
+                        session.execute(text('ALTER TABLE {} ALTER COLUMN id DROP DEFAULT'.format(old)))
+                    else:
+                        session.execute(text('DROP TABLE {}'.format(old)))
+                    session.commit()
+                    removed += count
+                    self.logger.info('%s change_log partition %s (%s entries)', archive and 'Archived' or 'Dropped', name, count)
+
+        while True:
+            with self.session_scope() as session:
+                ids = [x for (x,) in session.query(ChangeLog.id)
+                                            .filter(ChangeLog.created < cutoff)
+                                            .filter(ChangeLog.permanent.isnot(True))
+                                            .limit(batch_size)]
+                if not ids:
+                    break
+                session.query(ChangeLog).filter(ChangeLog.id.in_(ids)).delete(synchronize_session=False)
+                session.commit()
+                removed += len(ids)
+        self.logger.info('Removed %s change_log entries older than %s', removed, cutoff.isoformat())
+        return removed
+
     def rename_bibcode(self, old_bibcode, new_bibcode):
         assert old_bibcode and new_bibcode
         assert old_bibcode != new_bibcode
@@ -160,21 +505,69 @@ class ADSMasterPipelineCelery(ADSCelery):
             else:
                 self.logger.error('Rename operation, bibcode doesnt exist: old=%s, new=%s', old_bibcode, new_bibcode)
 
+    def claim_index_requests(self, bibcodes, options=None):
+        """Registers bibcodes about to be sent to task_index_records.
+
+        Bibcodes that are already queued with the same options (and were
+        queued less than INDEX_INFLIGHT_TTL seconds ago) are left out, as
+        are repeated bibcodes; the caller sends only the returned ones.
+
+        :param: bibcodes - list of bibcodes
+        :param: options - dict, the kwargs of the index request
+        :return: list of bibcodes to queue
+        """
+        bibcodes = list(OrderedDict.fromkeys(bibcodes))
+        if not bibcodes:
+            return []
+        options = self.checksum(json.dumps(options or {}, sort_keys=True))
+        now = adsputils.get_date()
+        expired = now - timedelta(seconds=self.conf.get('INDEX_INFLIGHT_TTL', 3600))
+
+        with self.session_scope() as session:
+            # requests whose task never ran (lost messages) are forgotten after the ttl
+            session.query(IndexRequest).filter(IndexRequest.queued < expired).delete(synchronize_session=False)
+            queued = set(b for b, in session.query(IndexRequest.bibcode)
+                                            .filter(IndexRequest.bibcode.in_(bibcodes))
+                                            .filter(IndexRequest.options == options))
+            claimed = [b for b in bibcodes if b not in queued]
+            if claimed:
+                dialect_insert = insert if session.get_bind().dialect.name == 'postgresql' else sqlite_insert
+                # a conflict is a concurrent claim of the same request, it stays as it is
+                upsert = dialect_insert(IndexRequest.__table__).on_conflict_do_nothing(index_elements=['bibcode', 'options'])
+                session.execute(upsert, [{'bibcode': b, 'options': options, 'queued': now} for b in claimed])
+            session.commit()
+        if len(claimed) < len(bibcodes):
+            self.logger.debug('Coalesced %s index requests already in flight', len(bibcodes) - len(claimed))
+        return claimed
+
+    def release_index_requests(self, bibcodes):
+        """Called when task_index_records starts, updates made from now on
+        need a new index request. Claims with other options are released
+        too: the worst case is one index request that is not coalesced."""
+        with self.session_scope() as session:
+            session.query(IndexRequest).filter(IndexRequest.bibcode.in_(bibcodes)).delete(synchronize_session=False)
+            session.commit()
+
     def get_record(self, bibcode, load_only=None):
+        # fulltext is not a column of the records table
+        columns = load_only and [f for f in load_only if f != 'fulltext']
         if isinstance(bibcode, list):
             out = []
             with self.session_scope() as session:
                 q = session.query(Records).filter(Records.bibcode.in_(bibcode))
-                if load_only:
-                    q = q.options(_load_only(*load_only))
+                if columns:
+                    q = q.options(_load_only(*columns))
+                if not load_only or 'fulltext' in load_only:
+                    # one extra query for the whole batch instead of one per record
+                    q = q.options(selectinload(Records._fulltext))
                 for r in q.all():
                     out.append(r.toJSON(load_only=load_only))
             return out
         else:
             with self.session_scope() as session:
                 q = session.query(Records).filter_by(bibcode=bibcode)
-                if load_only:
-                    q = q.options(_load_only(*load_only))
+                if columns:
+                    q = q.options(_load_only(*columns))
                 r = q.first()
                 if r is None:
                     return None
@@ -244,6 +637,9 @@ class ADSMasterPipelineCelery(ADSCelery):
 
         :param: solr_docs - list of json objects (solr documents)
         :param: solr_urls - list of strings, solr servers.
+
+        Rejected batches are bisected to find the offending docs; connection
+        errors and timeouts are raised instead.
         """
         self.logger.debug('Updating solr: num_docs=%s solr_urls=%s', len(solr_docs), solr_urls)
         # batch send solr update
@@ -256,38 +652,73 @@ class ADSMasterPipelineCelery(ADSCelery):
         else:
             self.logger.error('%s docs failed indexing', len(errs))
             failed_bibcodes = []
-            # recover from errors by sending docs one by one
-            for doc, checksum in zip(solr_docs, solr_docs_checksum):
+            try:
+                # narrow down the offending docs by halving the failed batch,
+                # a single bad doc in a batch of n costs about 2 log2(n) posts
+                if len(solr_docs) > 1:
+                    half = len(solr_docs) // 2
+                    self._index_solr_bisect(solr_docs[:half], solr_docs_checksum[:half], solr_urls, commit, update_processed, failed_bibcodes)
+                    self._index_solr_bisect(solr_docs[half:], solr_docs_checksum[half:], solr_urls, commit, update_processed, failed_bibcodes)
+                else:
+                    self._index_solr_single(solr_docs[0], solr_docs_checksum[0], solr_urls, commit, update_processed, failed_bibcodes)
+            finally:
+                # finally update postgres record
+                if failed_bibcodes and update_processed:
+                    self.mark_processed(failed_bibcodes, 'solr', checksums=None, status='solr-failed')
+
+    def _index_solr_bisect(self, solr_docs, solr_docs_checksum, solr_urls, commit, update_processed, failed_bibcodes):
+        """Posts a part of a failed batch, splits it again if it fails too"""
+        if len(solr_docs) == 1:
+            self._index_solr_single(solr_docs[0], solr_docs_checksum[0], solr_urls, commit, update_processed, failed_bibcodes)
+            return
+        try:
+            errs = [x for x in solr_updater.update_solr(solr_docs, solr_urls, ignore_errors=True, commit=commit) if x != 200]
+        except _solr_unavailable:
+            raise
+        except Exception as e:
+            self.logger.error('Failed posting %s docs to Solr: %s', len(solr_docs), e)
+            errs = [e]
+        if len(errs) == 0:
+            if update_processed:
+                self.mark_processed([x['bibcode'] for x in solr_docs], 'solr', checksums=solr_docs_checksum, status='success')
+            return
+        half = len(solr_docs) // 2
+        self._index_solr_bisect(solr_docs[:half], solr_docs_checksum[:half], solr_urls, commit, update_processed, failed_bibcodes)
+        self._index_solr_bisect(solr_docs[half:], solr_docs_checksum[half:], solr_urls, commit, update_processed, failed_bibcodes)
+
+    def _index_solr_single(self, doc, checksum, solr_urls, commit, update_processed, failed_bibcodes):
+        """Posts one doc that failed within a batch, retrying without fulltext if solr choked on it"""
+        try:
+            self.logger.error('trying individual update_solr %s', doc)
+            solr_updater.update_solr([doc], solr_urls, ignore_errors=False, commit=commit)
+            if update_processed:
+                self.mark_processed((doc['bibcode'],), 'solr', checksums=(checksum,), status='success')
+            self.logger.debug('%s success', doc['bibcode'])
+        except _solr_unavailable:
+            raise
+        except Exception as e:
+            # if individual insert fails,
+            # and if 'body' is in excpetion we assume Solr failed on body field
+            # then we try once more without fulltext
+            # this bibcode needs to investigated as to why fulltext/body is failing
+            failed_bibcode = doc['bibcode']
+            if 'body' in str(e) or 'not all arguments converted during string formatting' in str(e):
+                tmp_doc = dict(doc)
+                tmp_doc.pop('body', None)
                 try:
-                    self.logger.error('trying individual update_solr %s', doc)
-                    solr_updater.update_solr([doc], solr_urls, ignore_errors=False, commit=commit)
+                    solr_updater.update_solr([tmp_doc], solr_urls, ignore_errors=False, commit=commit)
                     if update_processed:
                         self.mark_processed((doc['bibcode'],), 'solr', checksums=(checksum,), status='success')
-                    self.logger.debug('%s success', doc['bibcode'])
+                    self.logger.debug('%s success without body', doc['bibcode'])
+                except _solr_unavailable:
+                    raise
                 except Exception as e:
-                    # if individual insert fails,
-                    # and if 'body' is in excpetion we assume Solr failed on body field
-                    # then we try once more without fulltext
-                    # this bibcode needs to investigated as to why fulltext/body is failing
-                    failed_bibcode = doc['bibcode']           
-                    if 'body' in str(e) or 'not all arguments converted during string formatting' in str(e):
-                        tmp_doc = dict(doc)
-                        tmp_doc.pop('body', None)
-                        try:
-                            solr_updater.update_solr([tmp_doc], solr_urls, ignore_errors=False, commit=commit)
-                            if update_processed:
-                                self.mark_processed((doc['bibcode'],), 'solr', checksums=(checksum,), status='success')
-                            self.logger.debug('%s success without body', doc['bibcode'])
-                        except Exception as e:
-                            self.logger.exception('Failed posting bibcode %s to Solr even without fulltext (urls: %s)', failed_bibcode, solr_urls)
-                            failed_bibcodes.append(failed_bibcode)
-                    else:
-                        # here if body not in error message do not retry, just note as a fail
-                        self.logger.error('Failed posting individual bibcode %s to Solr\nurls: %s, offending payload %s, error is %s', failed_bibcode, solr_urls, doc, e)
-                        failed_bibcodes.append(failed_bibcode)
-            # finally update postgres record
-            if failed_bibcodes and update_processed:
-                self.mark_processed(failed_bibcodes, 'solr', checksums=None, status='solr-failed')
+                    self.logger.exception('Failed posting bibcode %s to Solr even without fulltext (urls: %s)', failed_bibcode, solr_urls)
+                    failed_bibcodes.append(failed_bibcode)
+            else:
+                # here if body not in error message do not retry, just note as a fail
+                self.logger.error('Failed posting individual bibcode %s to Solr\nurls: %s, offending payload %s, error is %s', failed_bibcode, solr_urls, doc, e)
+                failed_bibcodes.append(failed_bibcode)
 
     def mark_processed(self, bibcodes, type, checksums=None, status=None):
         """
@@ -320,12 +751,16 @@ class ADSMasterPipelineCelery(ADSCelery):
         else:
             raise ValueError('invalid type value of %s passed, must be solr, metrics or links' % type)
         updt[timestamp_column] = now
+        updt[checksum_column] = bindparam('_checksum')
         checksums = checksums or [None] * len(bibcodes)
-        for bibcode, checksum in zip(bibcodes, checksums):
-            updt[checksum_column] = checksum
-            with self.session_scope() as session:
-                session.query(Records).filter_by(bibcode=bibcode).update(updt, synchronize_session=False)
-        session.commit()
+        # one executemany statement, every bibcode gets its own checksum
+        stmt = Records.__table__.update() \
+                                .where(Records.__table__.c.bibcode == bindparam('_bibcode')) \
+                                .values(updt)
+        task = {'solr': 'index_solr', 'metrics': 'index_metrics', 'links': 'index_links'}[type]
+        with instrumentation.stage(task, 'mark_processed', records=len(bibcodes)), self.session_scope() as session:
+            session.execute(stmt, [{'_bibcode': bibcode, '_checksum': checksum} for bibcode, checksum in zip(bibcodes, checksums)])
+            session.commit()
 
     def get_metrics(self, bibcode):
         """Helper method to retrieve data from the metrics db
@@ -388,8 +823,9 @@ class ADSMasterPipelineCelery(ADSCelery):
                 trans = session.begin_nested()
                 try:
                     # bulk upsert
-                    trans.session.execute(self._metrics_table_upsert, batch)
-                    trans.commit()
+                    with instrumentation.stage('index_metrics', 'upsert', records=len(batch)):
+                        trans.session.execute(self._metrics_table_upsert, batch)
+                        trans.commit()
                     if update_processed:
                         self.mark_processed([x['bibcode'] for x in batch], 'metrics', checksums=batch_checksum, status='success')
                 except exc.SQLAlchemyError as e:
@@ -422,7 +858,9 @@ class ADSMasterPipelineCelery(ADSCelery):
         if len(links_data):
             # bulk put request
             bibcodes = [x['bibcode'] for x in links_data]
-            r = requests.put(links_url, data=json.dumps(links_data), headers={'Authorization': 'Bearer {}'.format(api_token)})
+            payload = json.dumps(links_data)
+            with instrumentation.stage('index_links', 'http_post', records=len(links_data), bytes=len(payload)):
+                r = http_client.put(links_url, data=payload, headers={'Authorization': 'Bearer {}'.format(api_token)})
             if r.status_code == 200:
                 self.logger.info('sent %s datalinks to %s including %s', len(links_data), links_url, links_data[0])
                 if update_processed:
@@ -432,7 +870,7 @@ class ADSMasterPipelineCelery(ADSCelery):
                 self.logger.error('error sending links to %s, error = %s', links_url, r.text)
                 failed_bibcodes = []
                 for data, checksum in zip(links_data, links_data_checksum):
-                    r = requests.put(links_url, data=json.dumps([data]), headers={'Authorization': 'Bearer {}'.format(api_token)})
+                    r = http_client.put(links_url, data=json.dumps([data]), headers={'Authorization': 'Bearer {}'.format(api_token)})
                     if r.status_code == 200:
                         self.logger.info('sent 1 datalinks to %s for bibcode %s', links_url, data.get('bibcode'))
                         if update_processed:
@@ -451,6 +889,18 @@ class ADSMasterPipelineCelery(ADSCelery):
                 session.commit()
                 return True
 
+    def metrics_delete_by_bibcodes(self, bibcodes):
+        """Deletes many rows from the metrics db with one statement
+
+        @return: number of deleted rows
+        """
+        if not bibcodes:
+            return 0
+        with self.metrics_session_scope() as session:
+            count = session.query(MetricsModel).filter(MetricsModel.bibcode.in_(bibcodes)).delete(synchronize_session=False)
+            session.commit()
+            return count
+
     def checksum(self, data, ignore_keys=('mtime', 'ctime', 'update_timestamp')):
         """
         Compute checksum of the passed in data. Preferred situation is when you
@@ -463,27 +913,45 @@ class ADSMasterPipelineCelery(ADSCelery):
             the key name, we'll ignore this key-value pair
         @return: checksum
         """
-        assert isinstance(ignore_keys, tuple)
+        return _checksum(data, ignore_keys)
 
-        if isinstance(data, basestring):
-            if sys.version_info > (3,):
-                data_str = data.encode('utf-8')
-            else:
-                data_str = unicode(data)
-            return hex(zlib.crc32(data_str) & 0xffffffff)
-        else:
-            data = deepcopy(data)
-            # remove all the modification timestamps
-            for k, v in list(data.items()):
-                for x in ignore_keys:
-                    if x in k:
-                        del data[k]
-                        break
-            if sys.version_info > (3,):
-                data_str = json.dumps(data, sort_keys=True).encode('utf-8')
-            else:
-                data_str = json.dumps(data, sort_keys=True)
-            return hex(zlib.crc32(data_str) & 0xffffffff)
+    def transform_records(self, records):
+        """Builds the solr documents of db records.
+
+        Batches of at least SOLR_TRANSFORM_MIN_BATCH records are spread over
+        SOLR_TRANSFORM_PROCESSES worker processes (0 or 1 keeps everything in
+        this process), smaller batches are not worth the pickling.
+
+        :param: records - list of db records (dicts, as returned by get_record)
+        :return: list of (solr_doc, checksum) tuples, in input order
+        """
+        processes = self.conf.get('SOLR_TRANSFORM_PROCESSES', 0)
+        if processes > 1 and len(records) >= self.conf.get('SOLR_TRANSFORM_MIN_BATCH', 200):
+            try:
+                if self._transform_pool is None:
+                    # forked workers would share (and on exit close) our db connections
+                    self._transform_pool = ProcessPoolExecutor(max_workers=processes,
+                                                               mp_context=multiprocessing.get_context('forkserver'))
+                    register_after_fork(self, ADSMasterPipelineCelery._forget_transform_pool)
+                chunksize = max(1, len(records) // (processes * 4))
+                return list(self._transform_pool.map(_solr_doc, records, chunksize=chunksize))
+            except Exception:
+                self.logger.exception('Transform process pool failed, building %s solr documents serially', len(records))
+                self._close_transform_pool()
+        return [_solr_doc(r) for r in records]
+
+    def _forget_transform_pool(self):
+        # a forked child can not use the pool of its parent
+        self._transform_pool = None
+
+    def _close_transform_pool(self):
+        if self._transform_pool is not None:
+            self._transform_pool.shutdown()
+            self._transform_pool = None
+
+    def close_app(self):
+        self._close_transform_pool()
+        ADSCelery.close_app(self)
 
     def request_aff_augment(self, bibcode, data=None):
         """send aff data for bibcode to augment affiliation pipeline
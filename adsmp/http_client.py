@@ -0,0 +1,102 @@
+"""Pooled HTTP client used for every outbound call of the pipeline (solr,
+links resolver, validation, scripts/reindex.py).
+
+One keep-alive requests.Session is kept per host (scheme://host:port) and
+per process; the sessions are dropped after a fork so that celery workers
+never share sockets with their parent.
+"""
+import os
+import threading
+from multiprocessing.util import register_after_fork
+
+import requests
+from adsputils import load_config
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+config = load_config(proj_home=proj_home)
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+def _host_key(url):
+    u = urlparse(url)
+    return "%s://%s" % (u.scheme, u.netloc)
+
+
+def _retry_policy():
+    kwargs = dict(
+        total=config.get("HTTP_RETRIES", 3),
+        backoff_factor=config.get("HTTP_BACKOFF_FACTOR", 0.5),
+        status_forcelist=config.get("HTTP_RETRY_STATUSES", (502, 503, 504)),
+        raise_on_status=False,
+    )
+    # status based retries only for idempotent methods; solr update posts
+    # fall back to their own error handling
+    methods = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:
+        return Retry(method_whitelist=methods, **kwargs)
+
+
+def _new_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=config.get("HTTP_POOL_CONNECTIONS", 10),
+        pool_maxsize=config.get("HTTP_POOL_MAXSIZE", 10),
+        max_retries=_retry_policy(),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session(url):
+    """Returns the pooled session for the host of the url"""
+    key = _host_key(url)
+    session = _sessions.get(key, None)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key, None)
+            if session is None:
+                session = _sessions[key] = _new_session()
+    return session
+
+
+def reset(*args):
+    """Forgets all sessions; called after fork. The sockets belong to the
+    parent, so they are not closed here"""
+    global _lock
+    _lock = threading.Lock()
+    _sessions.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset)
+else:
+    register_after_fork(_sessions, reset)
+
+
+def request(method, url, **kwargs):
+    kwargs.setdefault("timeout", config.get("HTTP_TIMEOUT", 300))
+    return get_session(url).request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
+
+
+def put(url, **kwargs):
+    return request("PUT", url, **kwargs)
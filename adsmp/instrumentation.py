@@ -0,0 +1,202 @@
+"""Per stage timing of the indexing tasks.
+
+    with instrumentation.stage('index_solr', 'http_post', records=len(docs), bytes=len(payload)):
+        ...
+
+Every stage records its duration, the number of records and payload bytes
+it handled; count() records the same without a duration. What happens with them depends on INSTRUMENTATION:
+
+    - None (default): nothing, stage() hands out a shared no-op context
+    - 'log': one structured log line per stage
+    - 'prometheus': totals are kept per process and served in the prometheus
+      text format on the first free port from INSTRUMENTATION_PORT
+      (celery worker processes get consecutive ports)
+"""
+import os
+import sys
+import threading
+import time
+from multiprocessing.util import register_after_fork
+
+from adsputils import load_config, setup_logging
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
+config = load_config(proj_home=proj_home)
+logger = setup_logging(
+    __name__,
+    proj_home=proj_home,
+    level=config.get("LOGGING_LEVEL", "INFO"),
+    attach_stdout=config.get("LOG_STDOUT", False),
+)
+
+_mode = None
+_stats = {}  # (task, stage) -> [count, errors, seconds, records, bytes]
+_lock = threading.Lock()
+_server = None
+
+
+class _NoopStage(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add(self, records=0, bytes=0):
+        pass
+
+
+_noop = _NoopStage()
+
+
+class _Stage(object):
+    __slots__ = ("task", "stage", "records", "bytes", "start")
+
+    def __init__(self, task, stage, records, bytes):
+        self.task = task
+        self.stage = stage
+        self.records = records
+        self.bytes = bytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        _record(self.task, self.stage, time.time() - self.start, self.records, self.bytes, exc_type is not None)
+        return False
+
+    def add(self, records=0, bytes=0):
+        """Counts that are only known once the stage is running"""
+        self.records += records
+        self.bytes += bytes
+
+
+def stage(task, stage, records=0, bytes=0):
+    """Context manager timing one stage of a task"""
+    if _mode is None:
+        return _noop
+    return _Stage(task, stage, records, bytes)
+
+
+def count(task, stage, records=0, bytes=0):
+    """Records an event that is not timed (e.g. writes that were skipped)"""
+    if _mode is not None:
+        _record(task, stage, 0.0, records, bytes, False)
+
+
+def configure(mode):
+    """Switches the instrumentation: None, 'log' or 'prometheus'"""
+    global _mode
+    if mode not in (None, "log", "prometheus"):
+        raise ValueError("Unknown INSTRUMENTATION mode: %s" % mode)
+    _mode = mode
+
+
+def _record(task, stage, seconds, records, bytes, failed):
+    if _mode == "log":
+        logger.info(
+            "stage %s.%s took %.4fs, %s records, %s bytes",
+            task, stage, seconds, records, bytes,
+            extra={"task": task, "stage": stage, "duration": seconds,
+                   "records": records, "bytes": bytes, "failed": failed},
+        )
+    elif _mode == "prometheus":
+        with _lock:
+            s = _stats.setdefault((task, stage), [0, 0, 0.0, 0, 0])
+            s[0] += 1
+            s[1] += failed and 1 or 0
+            s[2] += seconds
+            s[3] += records
+            s[4] += bytes
+        if _server is None:
+            _start_server()
+
+
+def snapshot():
+    """Returns {(task, stage): {'count', 'errors', 'seconds', 'records', 'bytes'}}"""
+    with _lock:
+        return {
+            k: dict(zip(("count", "errors", "seconds", "records", "bytes"), v))
+            for k, v in _stats.items()
+        }
+
+
+def render():
+    """The totals in the prometheus text exposition format"""
+    metrics = (
+        ("adsmp_stage_calls_total", "counter", "Number of times the stage ran", "count"),
+        ("adsmp_stage_errors_total", "counter", "Number of times the stage raised", "errors"),
+        ("adsmp_stage_seconds_total", "counter", "Time spent in the stage", "seconds"),
+        ("adsmp_stage_records_total", "counter", "Records handled by the stage", "records"),
+        ("adsmp_stage_bytes_total", "counter", "Payload bytes handled by the stage", "bytes"),
+    )
+    stats = sorted(snapshot().items())
+    lines = []
+    for name, type, help, field in metrics:
+        lines.append("# HELP %s %s" % (name, help))
+        lines.append("# TYPE %s %s" % (name, type))
+        for (task, stage), values in stats:
+            lines.append('%s{task="%s",stage="%s"} %s' % (name, task, stage, values[field]))
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        out = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_server():
+    global _server
+    with _lock:
+        if _server is not None:
+            return
+        port = config.get("INSTRUMENTATION_PORT", 9105)
+        for p in range(port, port + config.get("INSTRUMENTATION_PORT_RANGE", 32)):
+            try:
+                _server = HTTPServer((config.get("INSTRUMENTATION_HOST", "127.0.0.1"), p), _MetricsHandler)
+                break
+            except (IOError, OSError):
+                continue
+        else:
+            # keep counting, just nobody can read them
+            _server = False
+            logger.error("No free port for the instrumentation endpoint from %s", port)
+            return
+    thread = threading.Thread(target=_server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving instrumentation metrics on port %s", _server.server_address[1])
+
+
+def _after_fork(*args):
+    # the child has its own totals and endpoint
+    global _server, _stats, _lock
+    _server = None
+    _stats = {}
+    _lock = threading.Lock()
+
+
+# celery's prefork pool forks with billiard, multiprocessing hooks do not run there
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+else:
+    register_after_fork(sys.modules[__name__], _after_fork)
+
+configure(config.get("INSTRUMENTATION", None))
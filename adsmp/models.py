@@ -5,13 +5,19 @@ from past.builtins import basestring
 from adsputils import get_date
 from datetime import datetime
 from dateutil.tz import tzutc
-from sqlalchemy import Column, Integer, BigInteger, String, Text, TIMESTAMP, Boolean, DateTime
+from sqlalchemy import Column, Integer, BigInteger, String, Text, TIMESTAMP, Boolean, DateTime, LargeBinary
 from sqlalchemy import types
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import relationship
 from sqlalchemy.types import Enum
 from sqlalchemy.dialects import postgresql
 from sqlalchemy import text
 import json
+import logging
+import re
+import zlib
+
+logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 MetricsBase = declarative_base()
@@ -33,6 +39,108 @@ class UTCDateTime(types.TypeDecorator):
                             value.microsecond, tzinfo=tzutc())
 
 
+# json escape for the NUL character (preceded by an odd number of backslashes),
+# postgres refuses to store it inside jsonb
+_json_nul = re.compile(r'(\\+)u0000')
+
+
+def _strip_json_nul(match):
+    backslashes = match.group(1)
+    if len(backslashes) % 2 == 0:
+        return match.group(0)
+    return backslashes[:-1]
+
+
+class _SerializedJSONB(types.UserDefinedType):
+    """JSONB column that is bound as already serialized json (by JSONPayload),
+    psycopg2 parses jsonb values itself on read"""
+    cache_ok = True
+
+    def get_col_spec(self, **kw):
+        return 'JSONB'
+
+
+class JSONPayload(types.TypeDecorator):
+    """Stores json documents: JSONB on postgres (parsed by the driver on
+    read), text holding the serialized json on other databases (sqlite, used
+    by the tests). Accepts dicts/lists or strings that are already serialized
+    json, returns the parsed structure."""
+    impl = Text
+    cache_ok = True
+    # payloads that had NUL characters removed before being stored (per process)
+    nul_stripped = 0
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(_SerializedJSONB())
+        return dialect.type_descriptor(Text())
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, basestring):
+            value = json.dumps(value)
+        if dialect.name == 'postgresql' and 'u0000' in value:
+            stripped = _json_nul.sub(_strip_json_nul, value)
+            if stripped != value:
+                JSONPayload.nul_stripped += 1
+                logger.warning('Removed %s NUL characters from a json payload (jsonb can not store them): %s...',
+                               (len(value) - len(stripped)) // 6, stripped[:100])
+            value = stripped
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name == 'postgresql':
+            return value
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value  # not json, returned as stored
+
+
+class CompressedText(types.TypeDecorator):
+    """Text stored zlib compressed. Values that were written uncompressed
+    (before the column was converted) are returned as they are."""
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        return zlib.compress(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None or not isinstance(value, bytes):
+            return value
+        try:
+            value = zlib.decompress(value)
+        except zlib.error:
+            pass
+        return value.decode('utf-8')
+
+
+class CompressedJSON(CompressedText):
+    """Json document stored zlib compressed; accepts the same values as
+    JSONPayload and returns the parsed structure."""
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and not isinstance(value, basestring):
+            value = json.dumps(value)
+        return super(CompressedJSON, self).process_bind_param(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        value = super(CompressedJSON, self).process_result_value(value, dialect)
+        if value is None:
+            return None
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value  # not json, returned as stored
+
+
 class KeyValue(Base):
     """Example model, it stores key/value pairs - a persistent configuration"""
     __tablename__ = 'storage'
@@ -48,15 +156,14 @@ class Records(Base):
     id = Column(Integer, primary_key=True)
     bibcode = Column(String(19), index=True, unique=True)
 
-    bib_data = Column(Text)  # 'metadata' is reserved by SQLAlchemy
-    orcid_claims = Column(Text)
-    nonbib_data = Column(Text)
-    fulltext = Column(Text)
-    metrics = Column(Text)
+    bib_data = Column(JSONPayload)  # 'metadata' is reserved by SQLAlchemy
+    orcid_claims = Column(JSONPayload)
+    nonbib_data = Column(JSONPayload)
+    metrics = Column(JSONPayload)
     # holds a dict of augments to be merged
     # currently only supported key is 'affiliations'
     #  with the value an array holding affiliation strings and '-' placeholders
-    augments = Column(Text)
+    augments = Column(JSONPayload)
 
     # when data is received we set the updated timestamp
     bib_data_updated = Column(UTCDateTime, default=None)
@@ -74,6 +181,14 @@ class Records(Base):
     metrics_processed = Column(UTCDateTime, default=None)
     datalinks_processed = Column(UTCDateTime, default=None)
 
+    # checksums of the stored payloads, unchanged payloads are not written again
+    bib_data_payload_checksum = Column(String(10), default=None)
+    orcid_claims_payload_checksum = Column(String(10), default=None)
+    nonbib_data_payload_checksum = Column(String(10), default=None)
+    fulltext_payload_checksum = Column(String(10), default=None)
+    metrics_payload_checksum = Column(String(10), default=None)
+    augments_payload_checksum = Column(String(10), default=None)
+
     solr_checksum = Column(String(10), default=None)
     metrics_checksum = Column(String(10), default=None)
     datalinks_checksum = Column(String(10), default=None)
@@ -86,6 +201,28 @@ class Records(Base):
                     'datalinks_processed', 'solr_processed', 'metrics_processed']
     _text_fields = ['id', 'bibcode', 'status', 'solr_checksum', 'metrics_checksum', 'datalinks_checksum']
     _json_fields = ['bib_data', 'orcid_claims', 'nonbib_data', 'metrics', 'fulltext', 'augments']
+    # everything stored on the records row, i.e. all fields but the fulltext
+    _row_fields = _text_fields + _date_fields + [f for f in _json_fields if f != 'fulltext']
+
+    # fulltext lives in its own table and is only loaded when accessed (or
+    # eagerly, for a batch, by app.get_record); deletes are issued explicitly
+    # by the app so that removing a record does not have to load its fulltext
+    _fulltext = relationship('Fulltext', primaryjoin='Records.bibcode == foreign(Fulltext.bibcode)',
+                             uselist=False, lazy='select', cascade='all, delete-orphan',
+                             passive_deletes=True, passive_updates=False)
+
+    @property
+    def fulltext(self):
+        return self._fulltext.data if self._fulltext is not None else None
+
+    @fulltext.setter
+    def fulltext(self, value):
+        if value is None:
+            self._fulltext = None
+        elif self._fulltext is None:
+            self._fulltext = Fulltext(data=value)
+        else:
+            self._fulltext.data = value
 
     def toJSON(self, for_solr=False, load_only=None):
         if for_solr:
@@ -105,24 +242,40 @@ class Records(Base):
                     doc[f] = get_date(getattr(self, f))
                 else:
                     doc[f] = None
-            for f in Records._json_fields:  # json
+            for f in Records._json_fields:  # json, already parsed by JSONPayload
                 if load_only and f not in load_only:
                     continue
-                v = getattr(self, f, None)
-                if v:
-                    v = json.loads(v)
-                doc[f] = v
+                doc[f] = getattr(self, f, None)
 
             return doc
 
 
+class Fulltext(Base):
+    """Fulltext of a record, kept out of the records table because of its size"""
+    __tablename__ = 'fulltext'
+    bibcode = Column(String(19), primary_key=True)
+    data = Column(CompressedJSON)
+
+
+class IndexRequest(Base):
+    """Bibcodes sent to task_index_records and not yet picked up by a worker,
+    used to coalesce duplicate index requests (see app.claim_index_requests);
+    requests with different options (kwargs checksum) are distinct"""
+    __tablename__ = 'index_requests'
+    bibcode = Column(String(19), primary_key=True)
+    options = Column(String(10), primary_key=True)
+    queued = Column(UTCDateTime, default=get_date)
+
+
 class ChangeLog(Base):
+    """On postgres 11+ the table is range partitioned by month of `created`
+    (see app.ensure_changelog_partitions and app.prune_changelog)"""
     __tablename__ = 'change_log'
     id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True)
     created = Column(UTCDateTime, default=get_date)
     key = Column(String(255))
     type = Column(String(255))
-    oldvalue = Column(Text)
+    oldvalue = Column(CompressedText)
     permanent = Column(Boolean, default=False)
 
     def toJSON(self):
@@ -2,10 +2,12 @@ import json
 import os
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
 from adsputils import date2solrstamp, load_config, setup_logging
 
+from adsmp import http_client, instrumentation
+
 proj_home = os.path.realpath(os.path.join(os.path.dirname(__file__), "../"))
 config = load_config(proj_home=proj_home)
 logger = setup_logging(
@@ -321,18 +323,22 @@ def delete_by_bibcodes(bibcodes, urls):
     deleted = []
     failed = []
     headers = {"Content-Type": "application/json"}
-    for bibcode in bibcodes:
-        logger.info("Delete: %s" % bibcode)
-        data = json.dumps({"delete": {"query": 'bibcode:"%s"' % bibcode}})
-        i = 0
+    # one OR'ed query per chunk and url; chunks stay below solr's maxBooleanClauses
+    chunk_size = config.get("SOLR_DELETE_BATCH_SIZE", 500)
+    for i in range(0, len(bibcodes), chunk_size):
+        chunk = bibcodes[i : i + chunk_size]
+        logger.info("Delete: %s" % " ".join(chunk))
+        query = "bibcode:(%s)" % " OR ".join('"%s"' % b for b in chunk)
+        data = json.dumps({"delete": {"query": query}})
+        ok = 0
         for url in urls:
-            r = requests.post(url, headers=headers, data=data)
+            r = http_client.post(url, headers=headers, data=data)
             if r.status_code == 200:
-                i += 1
-        if i == len(urls):
-            deleted.append(bibcode)
+                ok += 1
+        if ok == len(urls):
+            deleted.extend(chunk)
         else:
-            failed.append(bibcode)
+            failed.extend(chunk)
     return (deleted, failed)
 
 
@@ -348,16 +354,33 @@ def update_solr(json_records, solr_urls, ignore_errors=False, commit=False):
     if not isinstance(json_records, list):
         json_records = [json_records]
     payload = json.dumps(json_records)
-    out = []
+    urls = []
     for url in solr_urls:
         if commit:
             if "?" in url:
                 url = url + "&commit=true"
             else:
                 url = url + "?commit=true"
-        r = requests.post(
+        urls.append(url)
+
+    def post(url):
+        return http_client.post(
             url, data=payload, headers={"content-type": "application/json"}
         )
+
+    with instrumentation.stage(
+        "index_solr", "http_post", records=len(json_records), bytes=len(payload) * len(urls)
+    ):
+        if len(urls) > 1 and config.get("SOLR_PARALLEL_UPDATES", False):
+            # post to all targets at once, the batch takes as long as the slowest solr
+            with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+                futures = [executor.submit(post, url) for url in urls]
+            responses = [f.result() for f in futures]
+        else:
+            responses = list(map(post, urls))
+
+    out = []
+    for url, r in zip(urls, responses):
         if r.status_code != 200:
             logger.error(
                 "Error sending data to solr\nurl=%s\nresponse=%s\ndata=%s",
@@ -467,44 +490,47 @@ def transform_json_record(db_record):
                     )
                 )
 
-    # Compute doctype scores on the fly
+    # doctype scores come from the table computed at import time
     out["doctype_boost"] = None
 
-    if config.get("DOCTYPE_RANKING", False):
-        doctype_rank = config.get("DOCTYPE_RANKING") 
-        unique_ranks = sorted(set(doctype_rank.values()))
-
-        # Map ranks to scores evenly spaced between 0 and 1 (invert: lowest rank gets the highest score)
-        rank_to_score = {rank: 1 - ( i / (len(unique_ranks) - 1)) for i, rank in enumerate(unique_ranks)}
-
-        # Assign scores to each rank
-        doctype_scores = {doctype: rank_to_score[rank] for doctype, rank in doctype_rank.items()}
-
-        if "doctype" in out.keys():
-            out["doctype_boost"] = doctype_scores.get(out["doctype"], None)
+    if DOCTYPE_SCORES and "doctype" in out:
+        out["doctype_boost"] = DOCTYPE_SCORES.get(out["doctype"], None)
 
     if config.get("ENABLE_HAS", False):
-        # Read-in names of fields to check for solr "has:" field
-        hasfields = sorted(config.get("HAS_FIELDS", []))
-
         # populate "has:" field with fields that exist for a particular record
         has = []
-        for field in hasfields:
-            if out.get(field, ""):
-                # if field is not empty, check if at least one character is alphanumeric
-                # this is done to not count fields where blank entries can be ['-',...]
-
-                # if field does not have a string or list, make it a list of strings so it is iterable
-
-                if not (isinstance(out[field], list) or isinstance(out[field], str)):
-                    out_field = str.join("", str(out[field]))
-                else:
-                    out_field = str.join("", out[field])
-
-                out_field = set(out_field)
-                # iterate through each character of each element in the field to check for at least one alphanumeric character
-                if any([char.isalnum() for char in out_field]):
-                    has.append(field)
+        for field in HAS_FIELDS:
+            # if field is not empty, check if at least one character is alphanumeric
+            # this is done to not count fields where blank entries can be ['-',...]
+            if out.get(field, "") and has_alnum(out[field]):
+                has.append(field)
         out["has"] = has
 
     return out
+
+
+def compute_doctype_scores(doctype_rank):
+    """Maps ranks to scores evenly spaced between 0 and 1 (invert: lowest
+    rank gets the highest score) and assigns the score to each doctype"""
+    if not doctype_rank:
+        return {}
+    unique_ranks = sorted(set(doctype_rank.values()))
+    steps = max(len(unique_ranks) - 1, 1)
+    rank_to_score = {rank: 1 - (i / steps) for i, rank in enumerate(unique_ranks)}
+    return {doctype: rank_to_score[rank] for doctype, rank in doctype_rank.items()}
+
+
+def has_alnum(value):
+    """True if the value (string, list of strings or anything else as its
+    string representation) contains at least one alphanumeric character;
+    stops at the first one found"""
+    if isinstance(value, str):
+        return any(map(str.isalnum, value))
+    if isinstance(value, list):
+        return any(has_alnum(x) for x in value)
+    return any(map(str.isalnum, str(value)))
+
+
+# lookup tables used by transform_json_record, computed once from the config
+DOCTYPE_SCORES = compute_doctype_scores(config.get("DOCTYPE_RANKING", None))
+HAS_FIELDS = sorted(config.get("HAS_FIELDS", []))
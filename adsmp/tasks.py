@@ -2,9 +2,13 @@
 from __future__ import absolute_import, unicode_literals
 from past.builtins import basestring
 import os
+import socket
+import time
+from collections import OrderedDict
 import adsputils
 from adsmp import app as app_module
-from adsmp import solr_updater
+from adsmp import instrumentation, solr_updater
+from adsmp.exceptions import IgnorableException
 from kombu import Queue
 from adsmsg.msg import Msg
 
@@ -44,17 +48,11 @@ def task_update_record(msg):
         if type == 'metadata':
             task_delete_documents(msg.bibcode)
         elif type == 'nonbib_records':
-            for m in msg.nonbib_records: # TODO: this is very ugly, we are repeating ourselves...
-                bibcodes.append(m.bibcode)
-                record = app.update_storage(m.bibcode, 'nonbib_data', None)
-                if record:
-                    logger.debug('Deleted %s, result: %s', type, record)
+            bibcodes = app.update_storage_bulk('nonbib_data', [(m.bibcode, None) for m in msg.nonbib_records])
+            logger.debug('Deleted %s, result: %s', type, bibcodes)
         elif type == 'metrics_records':
-            for m in msg.metrics_records:
-                bibcodes.append(m.bibcode)
-                record = app.update_storage(m.bibcode, 'metrics', None)
-                if record:
-                    logger.debug('Deleted %s, result: %s', type, record)
+            bibcodes = app.update_storage_bulk('metrics', [(m.bibcode, None) for m in msg.metrics_records])
+            logger.debug('Deleted %s, result: %s', type, bibcodes)
         else:
             bibcodes.append(msg.bibcode)
             record = app.update_storage(msg.bibcode, type, None)
@@ -65,19 +63,19 @@ def task_update_record(msg):
         # save into a database
         # passed msg may contain details on one bibcode or a list of bibcodes
         if type == 'nonbib_records':
+            records = []
             for m in msg.nonbib_records:
                 m = Msg(m, None, None) # m is a raw protobuf, TODO: return proper instance from .nonbib_records
-                bibcodes.append(m.bibcode)
-                record = app.update_storage(m.bibcode, 'nonbib_data', m.toJSON())
-                if record:
-                    logger.debug('Saved record from list: %s', record)
+                records.append((m.bibcode, m.toJSON()))
+            bibcodes = app.update_storage_bulk('nonbib_data', records)
+            logger.debug('Saved records from list: %s', bibcodes)
         elif type == 'metrics_records':
+            records = []
             for m in msg.metrics_records:
                 m = Msg(m, None, None)
-                bibcodes.append(m.bibcode)
-                record = app.update_storage(m.bibcode, 'metrics', m.toJSON(including_default_value_fields=True))
-                if record:
-                    logger.debug('Saved record from list: %s', record)
+                records.append((m.bibcode, m.toJSON(including_default_value_fields=True)))
+            bibcodes = app.update_storage_bulk('metrics', records)
+            logger.debug('Saved records from list: %s', bibcodes)
         elif type == 'augment':
             bibcodes.append(msg.bibcode)
             record = app.update_storage(msg.bibcode, 'augment',
@@ -107,6 +105,8 @@ def task_rebuild_index(bibcodes, solr_targets=None):
 
     note that which collection to update is part of the url in solr_targets
     """
+    # the rebuild indexes the current data, pending index requests are served too
+    app.release_index_requests(bibcodes)
     reindex_records(bibcodes, force=True, update_solr=True, update_metrics=False, update_links=False, commit=False,
                     ignore_checksums=True, solr_targets=solr_targets, update_processed=False, priority=0)
 
@@ -121,6 +121,10 @@ def task_index_records(bibcodes, force=False, update_solr=True, update_metrics=T
     (that one, quite obviously, is in turn started by cron)
     Use code also called by task_rebuild_index,
     """
+    if isinstance(bibcodes, basestring):
+        bibcodes = [bibcodes]
+    # from here on new updates of these bibcodes need a new index request
+    app.release_index_requests(bibcodes)
     reindex_records(bibcodes, force=force, update_solr=update_solr, update_metrics=update_metrics, update_links=update_links, commit=commit,
                     ignore_checksums=ignore_checksums, solr_targets=solr_targets, update_processed=update_processed)
 
@@ -183,9 +187,21 @@ def reindex_records(bibcodes, force=False, update_solr=True, update_metrics=True
         if update_links:
             fields += ['nonbib_data', 'bib_data', 'datalinks_checksum']
 
+    # load the whole batch with a few IN (...) queries instead of one query per bibcode
+    records = {}
+    chunk_size = app.conf.get('REINDEX_LOAD_CHUNK_SIZE', 1000)
+    with instrumentation.stage('index_records', 'db_load') as stage:
+        for i in range(0, len(bibcodes), chunk_size):
+            for r in app.get_record(bibcodes[i:i + chunk_size], load_only=fields):
+                records[r['bibcode']] = r
+        stage.add(records=len(records))
+
+    # records whose solr document gets built (in one go, see app.transform_records)
+    solr_input = []
+
     # check if we have complete record
     for bibcode in bibcodes:
-        r = app.get_record(bibcode, load_only=fields)
+        r = records.get(bibcode, None)
 
         if r is None:
             logger.error('The bibcode %s doesn\'t exist!', bibcode)
@@ -218,21 +234,9 @@ def reindex_records(bibcodes, force=False, update_solr=True, update_metrics=True
                 logger.debug('Forced indexing of: %s (metadata=%s, orcid=%s, nonbib=%s, fulltext=%s, metrics=%s, augments=%s)' %
                              (bibcode, bib_data_updated, orcid_claims_updated, nonbib_data_updated, fulltext_updated,
                               metrics_updated, augments_updated))
-            # build the solr record
+            # the solr record is built below
             if update_solr:
-                solr_payload = solr_updater.transform_json_record(r)
-                # ADS microservices assume the identifier field exists and contains the canonical bibcode:
-                if 'identifier' not in solr_payload:
-                    solr_payload['identifier'] = []
-                if 'bibcode' in solr_payload and solr_payload['bibcode'] not in solr_payload['identifier']:
-                    solr_payload['identifier'].append(solr_payload['bibcode'])
-                logger.debug('Built SOLR: %s', solr_payload)
-                solr_checksum = app.checksum(solr_payload)
-                if ignore_checksums or r.get('solr_checksum', None) != solr_checksum:
-                    solr_records.append(solr_payload)
-                    solr_records_checksum.append(solr_checksum)
-                else:
-                    logger.debug('Checksum identical, skipping solr update for: %s', bibcode)
+                solr_input.append(r)
 
             # get data for metrics
             if update_metrics:
@@ -261,29 +265,43 @@ def reindex_records(bibcodes, force=False, update_solr=True, update_metrics=True
                 logger.debug('%s not ready for indexing yet (metadata=%s, orcid=%s, nonbib=%s, fulltext=%s, metrics=%s, augments=%s)' %
                              (bibcode, bib_data_updated, orcid_claims_updated, nonbib_data_updated, fulltext_updated,
                               metrics_updated, augments_updated))
-    if solr_records:
-        task_index_solr.apply_async(
-            args=(solr_records, solr_records_checksum,),
-            kwargs={
-               'commit': commit,
-               'solr_targets': solr_targets,
-               'update_processed': update_processed
-            }
-        )
-    if metrics_records:
-        task_index_metrics.apply_async(
-            args=(metrics_records, metrics_records_checksum,),
-            kwargs={
-               'update_processed': update_processed
-            }
-        )
-    if links_data_records:
-        task_index_data_links_resolver.apply_async(
-            args=(links_data_records, links_data_records_checksum,),
-            kwargs={
-               'update_processed': update_processed
-            }
-        )
+
+    # build the solr records
+    with instrumentation.stage('index_records', 'transform', records=len(solr_input)):
+        solr_output = app.transform_records(solr_input)
+    for r, (solr_payload, solr_checksum) in zip(solr_input, solr_output):
+        logger.debug('Built SOLR: %s', solr_payload)
+        if ignore_checksums or r.get('solr_checksum', None) != solr_checksum:
+            solr_records.append(solr_payload)
+            solr_records_checksum.append(solr_checksum)
+        else:
+            logger.debug('Checksum identical, skipping solr update for: %s', r['bibcode'])
+
+    with instrumentation.stage('index_records', 'enqueue',
+                               records=len(solr_records) + len(metrics_records) + len(links_data_records)):
+        if solr_records:
+            task_index_solr.apply_async(
+                args=(solr_records, solr_records_checksum,),
+                kwargs={
+                   'commit': commit,
+                   'solr_targets': solr_targets,
+                   'update_processed': update_processed
+                }
+            )
+        if metrics_records:
+            task_index_metrics.apply_async(
+                args=(metrics_records, metrics_records_checksum,),
+                kwargs={
+                   'update_processed': update_processed
+                }
+            )
+        if links_data_records:
+            task_index_data_links_resolver.apply_async(
+                args=(links_data_records, links_data_records_checksum,),
+                kwargs={
+                   'update_processed': update_processed
+                }
+            )
 
 
 @app.task(queue='delete-records')
@@ -305,5 +323,174 @@ def task_delete_documents(bibcode):
         logger.debug('Failed to deleted metrics record: %s', bibcode)
 
 
+@app.task(queue='delete-records')
+def task_delete_documents_batch(bibcodes):
+    """Delete many documents from SOLR and from our storage; the
+    records are removed in one transaction, solr and metrics get one
+    request per batch.
+    @param bibcodes: list of strings
+    """
+    logger.debug('To delete: %s', bibcodes)
+    deleted = app.delete_by_bibcodes(bibcodes)
+    if len(deleted) != len(bibcodes):
+        logger.debug('Bibcodes not in storage: %s', set(bibcodes).difference(deleted))
+    deleted, failed = solr_updater.delete_by_bibcodes(bibcodes, app.conf['SOLR_URLS'])
+    if len(failed):
+        logger.error('Failed deleting documents from solr: %s', failed)
+    if len(deleted):
+        logger.debug('Deleted SOLR docs: %s', deleted)
+
+    count = app.metrics_delete_by_bibcodes(bibcodes)
+    logger.debug('Deleted %s metrics records', count)
+
+
+# ============================= BATCHED CONSUMER ================================== #
+
+def _update_record_group(msg):
+    """Returns (status, type, records) of an update-record message, records
+    are the (bibcode, payload) tuples task_update_record would store; None
+    when the status is unclear
+    """
+    status = app.get_msg_status(msg)
+    type = app.get_msg_type(msg)
+    if status not in ('active', 'deleted'):
+        return None
+
+    if type in ('nonbib_records', 'metrics_records'):
+        msgs = [Msg(m, None, None) for m in getattr(msg, type)]
+        including_default_value_fields = type == 'metrics_records'
+        type = type == 'nonbib_records' and 'nonbib_data' or 'metrics'
+    else:
+        msgs = [msg]
+        including_default_value_fields = type == 'augment'
+
+    records = []
+    for m in msgs:
+        if status == 'deleted':
+            records.append((m.bibcode, None))
+        elif including_default_value_fields:
+            records.append((m.bibcode, m.toJSON(including_default_value_fields=True)))
+        else:
+            records.append((m.bibcode, m.toJSON()))
+    return status, type, records
+
+
+class UpdateRecordBatch(object):
+    """Collects update-record messages and stores them grouped by (status, type),
+    one bulk operation per group. The broker messages are only acknowledged
+    after their group was committed.
+    """
+
+    def __init__(self):
+        self.groups = OrderedDict()  # (status, type) -> [(msg, records, broker message)]
+        self.bibcodes = {}  # bibcode -> set of (status, type) of its pending updates
+        self.size = 0
+        self.started = None
+
+    def __len__(self):
+        return self.size
+
+    def add(self, msg, message):
+        group = _update_record_group(msg)
+        if group is None:
+            logger.error('Received a message with unclear status: %s', msg)
+            message.ack()
+            return
+        status, type, records = group
+        key = (status, type)
+        # groups are applied one after the other, store what is pending when the
+        # order matters: the same payload set and deleted, or the record deleted
+        if any(self._conflicts(key, self.bibcodes.get(bibcode, ())) for bibcode, _ in records):
+            self.flush()
+        if not self.size:
+            self.started = time.time()
+        for bibcode, _ in records:
+            self.bibcodes.setdefault(bibcode, set()).add(key)
+        self.groups.setdefault(key, []).append((msg, records, message))
+        self.size += 1
+
+    @staticmethod
+    def _conflicts(key, pending):
+        deleted = ('deleted', 'metadata')
+        if key == deleted or deleted in pending:
+            return bool(set(pending).difference([key]))
+        return any(type == key[1] and status != key[0] for status, type in pending)
+
+    def flush(self):
+        groups = self.groups
+        self.groups, self.bibcodes, self.size, self.started = OrderedDict(), {}, 0, None
+        for (status, type), entries in groups.items():
+            try:
+                self._store(status, type, [r for _, records, _ in entries for r in records])
+            except Exception:
+                logger.exception('Failed storing %s messages of type %s in bulk, retrying one by one', len(entries), type)
+                for msg, _, message in entries:
+                    try:
+                        task_update_record(msg)
+                    except Exception:
+                        # back to the queue, the error may well be transient
+                        logger.exception('Failed updating record, requeued: %s', msg)
+                        message.requeue()
+                    else:
+                        message.ack()
+            else:
+                for _, _, message in entries:
+                    message.ack()
+
+    def _store(self, status, type, records):
+        if status == 'deleted' and type == 'metadata':
+            task_delete_documents_batch(list(OrderedDict.fromkeys(bibcode for bibcode, _ in records)))
+            return
+        bibcodes = app.update_storage_bulk(type, records)
+        logger.debug('Saved %s %s records, result: %s', status, type, bibcodes)
+        if status == 'active' and type == 'metadata':
+            for bibcode in OrderedDict.fromkeys(bibcode for bibcode, _ in records):
+                app.request_aff_augment(bibcode)
+
+
+def consume_update_record_batches(batch_size=None, max_wait=None):
+    """Opt-in alternative to a celery worker for the update-record queue:
+    collects up to batch_size messages, or what arrives within max_wait
+    milliseconds, and stores them with UpdateRecordBatch. Messages are
+    acknowledged after the commit, anything not yet stored is redelivered
+    by the broker when the consumer stops. Messages that cannot be stored,
+    even one by one, are requeued; unreadable ones are rejected.
+    """
+    batch_size = batch_size or app.conf.get('UPDATE_RECORD_BATCH_SIZE', 100)
+    max_wait = (max_wait or app.conf.get('UPDATE_RECORD_BATCH_WAIT', 500)) / 1000.0
+    queue = [q for q in app.conf.CELERY_QUEUES if q.name == 'update-record'][0]
+    batch = UpdateRecordBatch()
+
+    def on_message(body, message):
+        if message.headers.get('task', task_update_record.name) != task_update_record.name:
+            logger.error('Unexpected task in the update-record queue: %s', message.headers.get('task'))
+            message.reject()
+            return
+        try:
+            # celery protocol 2 sends (args, kwargs, embed), protocol 1 a dict
+            args = body[0] if isinstance(body, (list, tuple)) else body.get('args', ())
+            batch.add(args[0], message)
+        except IgnorableException:
+            # e.g. a payload of unknown type, task_update_record drops it too
+            logger.exception('Ignoring message from the update-record queue: %s', body)
+            message.ack()
+        except Exception:
+            # it would be redelivered, and fail, again and again
+            logger.exception('Rejecting unreadable message from the update-record queue: %s', body)
+            message.reject()
+
+    with app.connection_for_read() as conn:
+        with conn.Consumer(queue, callbacks=[on_message], accept=['adsmsg', 'json']) as consumer:
+            consumer.qos(prefetch_count=batch_size)
+            while True:
+                timeout = max_wait if batch.started is None else max(0.0, batch.started + max_wait - time.time())
+                try:
+                    conn.drain_events(timeout=timeout)
+                except socket.timeout:
+                    pass
+                if len(batch) >= batch_size or (len(batch) and time.time() >= batch.started + max_wait):
+                    batch.flush()
+
+
 if __name__ == '__main__':
     app.start()
@@ -7,13 +7,17 @@ import os
 import sys
 import copy
 import json
+import zlib
+import requests
 
 import adsputils
-from adsmp import app, models
+from adsmp import app, models, instrumentation
 from adsmp.models import Base, MetricsBase
 from adsputils import get_date
 import testing.postgresql
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy import text
 
 
 class TestAdsOrcidCelery(unittest.TestCase):
@@ -77,6 +81,16 @@ class TestAdsOrcidCelery(unittest.TestCase):
         self.assertTrue(r['processed'])
         self.assertEqual(r['status'], 'solr-failed')
 
+        # every bibcode gets its own checksum
+        self.app.update_storage('def', 'bib_data', {'bibcode': 'def', 'hey': 1})
+        self.app.mark_processed(['abc', 'def'], 'metrics', checksums=['c1', 'c2'], status='success')
+        self.assertEqual(self.app.get_record('abc')['metrics_checksum'], 'c1')
+        self.assertEqual(self.app.get_record('def')['metrics_checksum'], 'c2')
+        self.assertEqual(self.app.get_record('def')['status'], 'success')
+        self.app.mark_processed(['abc', 'def'], 'metrics', status='metrics-failed')
+        self.assertEqual(self.app.get_record('def')['metrics_checksum'], None)
+        self.assertEqual(self.app.get_record('def')['status'], 'metrics-failed')
+
     def test_index_solr(self):
         self.app.update_storage('abc', 'bib_data', {'bibcode': 'abc', 'hey': 1})
         self.app.update_storage('foo', 'bib_data', {'bibcode': 'foo', 'hey': 1})
@@ -178,6 +192,65 @@ class TestAdsOrcidCelery(unittest.TestCase):
             self.assertTrue('good body' in x)
             self.assertTrue('http://solr1' in x)
 
+    def test_index_solr_bisect(self):
+        docs = [{'bibcode': 'b%s' % i, 'body': 'body'} for i in range(8)]
+        checksums = ['c%s' % i for i in range(8)]
+        docs[5]['body'] = 'BAD BODY'
+
+        def update_solr(json_records, solr_urls, ignore_errors=False, commit=False):
+            if any(x.get('body') == 'BAD BODY' for x in json_records):
+                if ignore_errors:
+                    return [400]
+                raise Exception('Error posting data to SOLR: body failed')
+            return []
+
+        with mock.patch('adsmp.solr_updater.update_solr', side_effect=update_solr) as us, \
+                mock.patch.object(self.app, 'mark_processed') as mp:
+            self.app.index_solr(docs, checksums, ['http://solr1'])
+            # batch, halves of 4, b4-b5, b4 and b5 alone, b5 without body, b6-b7
+            self.assertEqual(us.call_count, 8)
+            self.assertEqual([len(c[0][0]) for c in us.call_args_list], [8, 4, 4, 2, 1, 1, 1, 2])
+            self.assertFalse('body' in us.call_args_list[6][0][0][0])
+            marked = [b for c in mp.call_args_list for b in c[0][0]]
+            self.assertEqual(sorted(marked), ['b%s' % i for i in range(8)])
+            self.assertTrue(all(c[1]['status'] == 'success' for c in mp.call_args_list))
+
+        # a doc failing for another reason is marked as failed, the rest indexed
+        docs[5]['body'] = 'body'
+        docs[2]['bibcode'] = 'bad'
+
+        def update_solr(json_records, solr_urls, ignore_errors=False, commit=False):
+            if any(x['bibcode'] == 'bad' for x in json_records):
+                if ignore_errors:
+                    return [500]
+                raise Exception('Error posting data to SOLR: failed')
+            return []
+
+        with mock.patch('adsmp.solr_updater.update_solr', side_effect=update_solr) as us, \
+                mock.patch.object(self.app, 'mark_processed') as mp:
+            self.app.index_solr(docs, checksums, ['http://solr1'])
+            self.assertEqual(us.call_count, 7)
+            self.assertEqual(mp.call_args_list[-1], mock.call(['bad'], 'solr', checksums=None, status='solr-failed'))
+
+    def test_index_solr_unavailable(self):
+        """Connection errors are not bisected, the batch fails once"""
+        docs = [{'bibcode': 'b%s' % i} for i in range(8)]
+        checksums = ['c%s' % i for i in range(8)]
+        responses = [[500], [200], requests.exceptions.ConnectionError('refused')]
+        with mock.patch('adsmp.solr_updater.update_solr', side_effect=responses) as us, \
+                mock.patch.object(self.app, 'mark_processed') as mp:
+            self.assertRaises(requests.exceptions.ConnectionError, self.app.index_solr, docs, checksums, ['http://solr1'])
+            # the batch, the first half indexed, then solr went away
+            self.assertEqual(us.call_count, 3)
+            self.assertEqual(mp.call_args_list, [mock.call(['b0', 'b1', 'b2', 'b3'], 'solr', checksums=checksums[:4], status='success')])
+
+        # a timeout of a single doc is not retried without its body either
+        with mock.patch('adsmp.solr_updater.update_solr', side_effect=[[500], requests.exceptions.Timeout('body')]) as us, \
+                mock.patch.object(self.app, 'mark_processed') as mp:
+            self.assertRaises(requests.exceptions.Timeout, self.app.index_solr, docs[:1], checksums[:1], ['http://solr1'])
+            self.assertEqual(us.call_count, 2)
+            self.assertFalse(mp.called)
+
     def test_update_metrics(self):
         self.app.update_storage('abc', 'metrics', {
                      'author_num': 1,
@@ -212,6 +285,26 @@ class TestAdsOrcidCelery(unittest.TestCase):
         self.app.metrics_delete_by_bibcode('abc')
         m = self.app.get_metrics('abc')
         self.assertFalse(m, 'deleted metrics data')
+
+    def test_delete_by_bibcodes(self):
+        """Records and metrics are deleted in batches"""
+        for bibcode in ('abc', 'def', 'ghi'):
+            self.app.update_storage(bibcode, 'metrics', {'author_num': 1, 'bibcode': bibcode})
+            self.app.index_metrics([self.app.get_record(bibcode)], ['checksum'])
+        self.assertEqual(sorted(self.app.delete_by_bibcodes(['abc', 'def', 'xyz'])), ['abc', 'def'])
+        self.assertEqual(self.app.get_record('abc'), None)
+        self.assertEqual(self.app.get_record('def'), None)
+        self.assertTrue(self.app.get_record('ghi'))
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(models.ChangeLog).filter_by(type='deleted').count(), 2)
+            r = session.query(models.ChangeLog).filter_by(key='bibcode:def').first()
+            self.assertTrue('def' in r.oldvalue)
+        self.assertEqual(self.app.delete_by_bibcodes([]), [])
+
+        self.assertEqual(self.app.metrics_delete_by_bibcodes(['abc', 'def', 'xyz']), 2)
+        self.assertFalse(self.app.get_metrics('abc'))
+        self.assertTrue(self.app.get_metrics('ghi'))
+        self.assertEqual(self.app.metrics_delete_by_bibcodes([]), 0)
         
     def test_update_records(self):
         """Makes sure we can write recs into the storage."""
@@ -297,7 +390,7 @@ class TestAdsOrcidCelery(unittest.TestCase):
         # init database so timestamps and checksum can be updated
         nonbib_data = {'data_links_rows': [{'baz': 0}]}
         self.app.update_storage('linkstest', 'nonbib_data', nonbib_data)
-        with mock.patch('requests.put', return_value=m) as p:
+        with mock.patch('adsmp.http_client.put', return_value=m) as p:
             datalinks_payload = {u'bibcode': u'linkstest', u'data_links_rows': [{u'baz': 0}]}
             checksum = 'thechecksum'
             self.app.index_datalinks([datalinks_payload], [checksum])
@@ -322,7 +415,7 @@ class TestAdsOrcidCelery(unittest.TestCase):
         # init database so timestamps and checksum can be updated
         nonbib_data = {'data_links_rows': [{'baz': 0}]}
         self.app.update_storage('linkstest', 'nonbib_data', nonbib_data)
-        with mock.patch('requests.put', return_value=m) as p:
+        with mock.patch('adsmp.http_client.put', return_value=m) as p:
             datalinks_payload = {u'bibcode': u'linkstest', u'data_links_rows': [{u'baz': 0}]}
             checksum = 'thechecksum'
             self.app.index_datalinks([datalinks_payload], [checksum])
@@ -342,7 +435,7 @@ class TestAdsOrcidCelery(unittest.TestCase):
         # init database so timestamps and checksum can be updated
         nonbib_data = {'data_links_rows': [{'baz': 0}]}
         self.app.update_storage('linkstest', 'nonbib_data', nonbib_data)
-        with mock.patch('requests.put') as p:
+        with mock.patch('adsmp.http_client.put') as p:
             bad = mock.Mock()
             bad.status_code = 500
             good = mock.Mock()
@@ -369,7 +462,7 @@ class TestAdsOrcidCelery(unittest.TestCase):
         # init database so timestamps and checksum can be updated
         nonbib_data = {'data_links_rows': [{'baz': 0}]}
         self.app.update_storage('linkstest', 'nonbib_data', nonbib_data)
-        with mock.patch('requests.put', return_value=m) as p:
+        with mock.patch('adsmp.http_client.put', return_value=m) as p:
             datalinks_payload = {u'bibcode': u'linkstest', u'data_links_rows': [{u'baz': 0}]}
             checksum = 'thechecksum'
             self.app.index_datalinks([datalinks_payload], [checksum], update_processed=False)
@@ -388,7 +481,224 @@ class TestAdsOrcidCelery(unittest.TestCase):
         """test database exception IntegrityError is caught"""
         with mock.patch('sqlalchemy.orm.session.Session.commit', side_effect=[IntegrityError('a', 'b', 'c', 'd'), None]):
             self.assertRaises(IntegrityError, self.app.update_storage, 'abc', 'nonbib_data', '{}')
-        
+
+    def test_update_storage_bulk(self):
+        """Makes sure a list of payloads is written in one go"""
+        now = adsputils.get_date()
+        self.app.update_storage('abc', 'nonbib_data', {'boost': 1})
+        out = self.app.update_storage_bulk('nonbib_data', [('abc', {'boost': 2}), ('def', {'boost': 3}), ('def', {'boost': 4})])
+        self.assertEqual(out, ['abc', 'def'])
+        r = self.app.get_record('abc')
+        self.assertEqual(r['nonbib_data'], {'boost': 2})
+        self.assertTrue(now < r['nonbib_data_updated'])
+        self.assertTrue(now < r['updated'])
+        r = self.app.get_record('def')
+        self.assertEqual(r['nonbib_data'], {'boost': 4})
+        self.assertTrue(r['created'])
+        with self.app.session_scope() as session:
+            changes = session.query(models.ChangeLog).filter_by(key='abc').order_by(models.ChangeLog.id).all()
+            self.assertEqual(len(changes), 2)
+            self.assertEqual(json.loads(changes[1].oldvalue), {'boost': 1})
+            self.assertEqual(session.query(models.ChangeLog).filter_by(key='def').count(), 1)
+
+        self.app.update_storage_bulk('metrics', [('abc', {'citation_num': 5})])
+        self.assertEqual(self.app.get_record('abc')['metrics'], {'citation_num': 5})
+        self.assertEqual(self.app.update_storage_bulk('metrics', []), [])
+        self.assertRaises(Exception, self.app.update_storage_bulk, 'foobar', [('abc', {})])
+
+    def test_update_storage_unchanged(self):
+        """Identical payloads are not written again"""
+        self.app.update_storage('abc', 'nonbib_data', {'boost': 1, 'norm_cites': 2})
+        updated = self.app.get_record('abc')['updated']
+        r = self.app.update_storage('abc', 'nonbib_data', '{"norm_cites": 2, "boost": 1}')
+        self.assertEqual(r['nonbib_data'], {'boost': 1, 'norm_cites': 2})
+        self.assertEqual(self.app.get_record('abc')['updated'], updated)
+        self.assertEqual(self.app.storage_skipped['nonbib_data'], 1)
+        self.assertEqual(self.app.storage_written['nonbib_data'], 1)
+
+        self.assertEqual(self.app.update_storage_bulk('nonbib_data', [('abc', {'boost': 1, 'norm_cites': 2}),
+                                                                      ('def', {'boost': 3})]), ['def'])
+        self.assertEqual(self.app.get_record('abc')['updated'], updated)
+        self.assertEqual(self.app.storage_skipped['nonbib_data'], 2)
+        self.assertEqual(self.app.update_storage_bulk('nonbib_data', [('def', {'boost': 3})]), [])
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(models.ChangeLog).filter_by(key='abc').count(), 1)
+            self.assertEqual(session.query(models.ChangeLog).filter_by(key='def').count(), 1)
+
+        # a change is written, the same payload for another column is not skipped
+        self.app.update_storage('abc', 'nonbib_data', {'boost': 2, 'norm_cites': 2})
+        self.assertTrue(self.app.get_record('abc')['updated'] > updated)
+        self.app.update_storage('abc', 'metrics', {'boost': 2, 'norm_cites': 2})
+        self.assertEqual(self.app.get_record('abc')['metrics'], {'boost': 2, 'norm_cites': 2})
+        self.assertEqual(self.app.storage_written['nonbib_data'], 3)
+        self.assertEqual(self.app.storage_written['metrics'], 1)
+        self.assertEqual(self.app.payload_checksum(None), self.app.checksum('null'))
+
+    def test_update_storage_instrumentation(self):
+        """Written and skipped (unchanged) records are reported to the instrumentation"""
+        server = instrumentation._server
+        instrumentation._server = False
+        instrumentation.configure('prometheus')
+        try:
+            self.app.update_storage('abc', 'nonbib_data', {'boost': 1})
+            self.app.update_storage('abc', 'nonbib_data', {'boost': 1})
+            self.app.update_storage_bulk('nonbib_data', [('abc', {'boost': 1}), ('def', {'boost': 2})])
+            stats = instrumentation.snapshot()
+        finally:
+            instrumentation.configure(None)
+            instrumentation._stats.clear()
+            instrumentation._server = server
+        self.assertEqual(stats[('update_storage', 'nonbib_data_skipped')]['records'], 2)
+        self.assertEqual(stats[('update_storage', 'nonbib_data_written')]['records'], 2)
+        self.assertEqual(stats[('update_storage', 'nonbib_data_written')]['count'], 2)
+
+    def test_claim_index_requests(self):
+        """Bibcodes already queued with the same options are coalesced"""
+        self.assertEqual(self.app.claim_index_requests(['abc', 'def', 'abc']), ['abc', 'def'])
+        self.assertEqual(self.app.claim_index_requests(['abc', 'ghi']), ['ghi'])
+        # other options are a different request
+        self.assertEqual(self.app.claim_index_requests(['abc'], {'force': True}), ['abc'])
+        self.assertEqual(self.app.claim_index_requests(['abc', 'def'], {'force': True}), ['def'])
+        # and does not replace the first one
+        self.assertEqual(self.app.claim_index_requests(['abc', 'def']), [])
+        self.app.release_index_requests(['abc'])
+        self.assertEqual(self.app.claim_index_requests(['abc', 'def'], {'force': True}), ['abc'])
+        self.assertEqual(self.app.claim_index_requests([]), [])
+
+        # requests older than the ttl are forgotten
+        with self.app.session_scope() as session:
+            session.query(models.IndexRequest).update({'queued': adsputils.get_date('2000-01-01')})
+            session.commit()
+        self.assertEqual(self.app.claim_index_requests(['abc', 'ghi']), ['abc', 'ghi'])
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(models.IndexRequest).count(), 2)
+
+    def test_transform_records(self):
+        """Solr documents are built in a process pool for large enough batches"""
+        for bibcode in ('abc', 'def', 'ghi'):
+            self.app.update_storage(bibcode, 'bib_data', {'bibcode': bibcode, 'title': [bibcode.upper()]})
+        records = self.app.get_record(['abc', 'def', 'ghi'])
+        serial = self.app.transform_records(records)
+        self.assertEqual([doc['bibcode'] for doc, _ in serial], ['abc', 'def', 'ghi'])
+        self.assertEqual(serial[0][0]['identifier'], ['abc'])
+        self.assertEqual(serial[0][1], self.app.checksum(serial[0][0]))
+
+        self.app.conf['SOLR_TRANSFORM_PROCESSES'] = 2
+        self.app.conf['SOLR_TRANSFORM_MIN_BATCH'] = 2
+        with mock.patch('adsmp.app.ProcessPoolExecutor', wraps=app.ProcessPoolExecutor) as pool:
+            self.assertEqual(self.app.transform_records(records), serial)
+            self.assertEqual(pool.call_count, 1)
+            # the pool is kept, small batches stay in this process
+            self.assertEqual(self.app.transform_records(records[1:]), serial[1:])
+            self.assertEqual(self.app.transform_records(records[:1]), serial[:1])
+            self.assertEqual(pool.call_count, 1)
+        self.app._close_transform_pool()
+
+        with mock.patch('adsmp.app.ProcessPoolExecutor', side_effect=OSError('no fork')):
+            self.assertEqual(self.app.transform_records(records), serial)
+
+    def test_json_payload(self):
+        """Payload columns take dicts or serialized json and are read back parsed"""
+        self.app.update_storage('abc', 'bib_data', {'bibcode': 'abc', 'hey': 1})
+        r = self.app.update_storage('abc', 'bib_data', '{"bibcode": "abc", "hey": 2}')
+        self.assertEqual(r['bib_data'], {'bibcode': 'abc', 'hey': 2})
+        with self.app.session_scope() as session:
+            rec = session.query(models.Records).filter_by(bibcode='abc').first()
+            self.assertEqual(rec.bib_data, {'bibcode': 'abc', 'hey': 2})
+            changes = session.query(models.ChangeLog).filter_by(key='abc').order_by(models.ChangeLog.id).all()
+            self.assertEqual(changes[0].oldvalue, None)
+            self.assertEqual(json.loads(changes[1].oldvalue), {'bibcode': 'abc', 'hey': 1})
+
+        payload = models.JSONPayload()
+        pg = postgresql.dialect()
+        self.assertEqual(payload.process_bind_param({'a': 1}, pg), '{"a": 1}')
+        self.assertEqual(payload.process_bind_param(None, pg), None)
+        # postgres can not store NUL in jsonb, a literal backslash followed by u0000 is kept
+        self.assertEqual(payload.process_bind_param({'a': u'x\u0000y', 'b': '\\u0000'}, pg),
+                         '{"a": "xy", "b": "\\\\u0000"}')
+        self.assertEqual(payload.process_result_value({'a': 1}, pg), {'a': 1})
+        self.assertEqual(payload.process_result_value('{"a": 1}', sqlite.dialect()), {'a': 1})
+        self.assertEqual(payload.process_result_value('foobar', sqlite.dialect()), 'foobar')
+
+    def test_fulltext_table(self):
+        """Fulltext is kept compressed in its own table and only loaded when asked for"""
+        self.app.update_storage('abc', 'bib_data', {'bibcode': 'abc'})
+        self.app.update_storage('def', 'bib_data', {'bibcode': 'def'})
+        r = self.app.update_storage('abc', 'fulltext', {'body': 'foo bar ' * 100})
+        self.assertEqual(r['fulltext'], {'body': 'foo bar ' * 100})
+        self.assertNotIn('fulltext', self.app.update_storage('abc', 'nonbib_data', {'boost': 1}))
+        with self.app.session_scope() as session:
+            raw = session.execute(text('SELECT data FROM fulltext WHERE bibcode = :bibcode'), {'bibcode': 'abc'}).scalar()
+            self.assertTrue(len(raw) < 100)
+            self.assertEqual(json.loads(zlib.decompress(raw)), {'body': 'foo bar ' * 100})
+
+        self.app.update_storage_bulk('fulltext', [('def', {'body': 'def body'})])
+        recs = dict((x['bibcode'], x) for x in self.app.get_record(['abc', 'def']))
+        self.assertEqual(recs['abc']['fulltext'], {'body': 'foo bar ' * 100})
+        self.assertEqual(recs['def']['fulltext'], {'body': 'def body'})
+        self.assertTrue(recs['def']['fulltext_updated'])
+        recs = self.app.get_record(['abc', 'def'], load_only=['bibcode', 'bib_data'])
+        self.assertNotIn('fulltext', recs[0])
+        self.assertEqual(self.app.get_record('abc', load_only=['bibcode', 'fulltext'])['fulltext'],
+                         {'body': 'foo bar ' * 100})
+
+        self.app.rename_bibcode('abc', 'ghi')
+        self.assertEqual(self.app.get_record('ghi')['fulltext'], {'body': 'foo bar ' * 100})
+
+        self.app.update_storage('def', 'fulltext', None)
+        self.assertEqual(self.app.get_record('def')['fulltext'], None)
+        self.app.update_storage('def', 'fulltext', {'body': 'again'})
+        self.app.delete_by_bibcode('def')
+        self.app.delete_by_bibcodes(['ghi'])
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(models.Fulltext).count(), 0)
+            for c in session.query(models.ChangeLog).filter_by(type='deleted'):
+                self.assertNotIn('"fulltext"', c.oldvalue)
+
+    def test_prune_changelog(self):
+        with self.app.session_scope() as session:
+            session.add(models.ChangeLog(key='a', type='t', oldvalue='old a', created=get_date('2020-01-01')))
+            session.add(models.ChangeLog(key='b', type='t', oldvalue='old b', created=get_date('2020-01-02'), permanent=True))
+            session.add(models.ChangeLog(key='c', type='t', oldvalue='old c', created=get_date('2020-01-03')))
+            session.add(models.ChangeLog(key='d', type='t', oldvalue='old d', created=get_date('2021-01-01')))
+            session.commit()
+            # oldvalue is stored compressed, entries written before the conversion are read as they are
+            raw = session.execute(text("SELECT oldvalue FROM change_log WHERE key = 'a'")).scalar()
+            self.assertEqual(zlib.decompress(raw), b'old a')
+            session.execute(text("UPDATE change_log SET oldvalue = CAST('legacy' AS BLOB) WHERE key = 'd'"))
+            session.commit()
+
+        # sqlite is not partitioned
+        self.assertEqual(self.app.ensure_changelog_partitions(), [])
+        self.assertEqual(self.app.prune_changelog('2020-06-01', batch_size=1), 2)
+        with self.app.session_scope() as session:
+            left = dict((c.key, c.oldvalue) for c in session.query(models.ChangeLog))
+            self.assertEqual(left, {'b': 'old b', 'd': 'legacy'})
+        self.assertEqual(self.app.prune_changelog('2020-06-01'), 0)
+
+    def test_checksum(self):
+        """Checksum of a dict must match crc32 of json.dumps(sort_keys=True) without the ignored keys"""
+        def reference(data, ignore_keys=('mtime', 'ctime', 'update_timestamp')):
+            data = copy.deepcopy(data)
+            for k in list(data.keys()):
+                if any(x in k for x in ignore_keys):
+                    del data[k]
+            return hex(zlib.crc32(json.dumps(data, sort_keys=True).encode('utf-8')) & 0xffffffff)
+
+        docs = [{},
+                {'bibcode': 'abc'},
+                {'bibcode': 'abc', 'update_timestamp': '2018', 'metadata_mtime': 'x', 'ctime': 'y'},
+                {'title': [u'Caf\xe9 ☃ "quoted"\n'], 'author': ['a', 'b'], 'z': {'b': 1, 'a': [1.5, None, True]},
+                 'citation_count': 3, 'body': u'x' * 1000, 'boost': 0.1},
+                {'update_timestamp': 'only ignored'}]
+        for doc in docs:
+            self.assertEqual(self.app.checksum(doc), reference(doc))
+        self.assertEqual(self.app.checksum(docs[3], ignore_keys=('body',)), reference(docs[3], ignore_keys=('body',)))
+        self.assertEqual(self.app.checksum(docs[2]), self.app.checksum({'bibcode': 'abc'}))
+        self.assertEqual(self.app.checksum(u'abc'), hex(zlib.crc32(b'abc') & 0xffffffff))
+        # the input is not modified
+        self.assertIn('update_timestamp', docs[2])
+
     def test_rename_bibcode(self):
         self.app.update_storage('abc', 'metadata', {'foo': 'bar', 'hey': 1})
         r = self.app.get_record('abc')
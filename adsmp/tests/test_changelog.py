@@ -0,0 +1,150 @@
+import unittest
+import os
+import imp
+
+import mock
+import testing.postgresql
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from adsputils import get_date
+from sqlalchemy import text
+
+from adsmp import app
+from adsmp.models import Base, ChangeLog
+
+
+class TestChangeLogPartitions(unittest.TestCase):
+    """change_log partitioned by month (postgres)"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.postgresql = \
+            testing.postgresql.Postgresql(host='127.0.0.1', port=15678, user='postgres',
+                                          database='test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.postgresql.stop()
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        proj_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+        self.app = app.ADSMasterPipelineCelery('test', local_config=\
+            {
+            'SQLALCHEMY_URL': 'postgresql://postgres@127.0.0.1:15678/test',
+            'METRICS_SQLALCHEMY_URL': None,
+            'SQLALCHEMY_ECHO': False,
+            'PROJ_HOME' : proj_home,
+            'TEST_DIR' : os.path.join(proj_home, 'adsmp/tests'),
+            })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+        # partition change_log the way the migration does it, starting from
+        # the text oldvalue it expects
+        self.app._session.execute(text('ALTER TABLE change_log ALTER COLUMN oldvalue TYPE TEXT USING NULL'))
+        self.app._session.commit()
+        self.migration = imp.load_source('partition_change_log',
+                                         os.path.join(proj_home, 'alembic/versions/c81e4a5f2d36_partition_change_log.py'))
+        self.migrate(self.migration.upgrade)
+
+    def migrate(self, step):
+        with Base.metadata.bind.begin() as conn:
+            with Operations.context(MigrationContext.configure(conn)):
+                step()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        with self.app.session_scope() as session:
+            for (name,) in session.execute(text("SELECT tablename FROM pg_tables WHERE tablename LIKE 'change_log_%'")):
+                session.execute(text('DROP TABLE IF EXISTS {}'.format(name)))
+            session.commit()
+        Base.metadata.drop_all()
+        self.app.close_app()
+
+    def add(self, key, created, permanent=False):
+        with self.app.session_scope() as session:
+            session.add(ChangeLog(key=key, type='t', oldvalue='old ' + key, created=get_date(created), permanent=permanent))
+            session.commit()
+
+    def count(self, table):
+        with self.app.session_scope() as session:
+            return session.execute(text('SELECT count(*) FROM {}'.format(table))).scalar()
+
+    def partitions(self):
+        with self.app.session_scope() as session:
+            return sorted(self.app._changelog_partitions(session))
+
+    def left(self):
+        with self.app.session_scope() as session:
+            return sorted(c.key for c in session.query(ChangeLog))
+
+    def test_partitions(self):
+        now = get_date()
+        current = 'change_log_y%04dm%02d' % (now.year, now.month)
+        self.assertTrue(current in self.partitions())
+        self.assertEqual(self.app.ensure_changelog_partitions(), [])
+
+        # no partition for these months, the rows land in the default partition
+        self.add('a', '2020-01-01')
+        self.add('b', '2020-01-02', permanent=True)
+        self.add('c', '2020-02-01')
+        self.add('d', '2020-02-02', permanent=True)
+        self.add('e', now.isoformat())
+        self.assertEqual(self.count('change_log_default'), 4)
+
+        # the partitions are created and the rows moved into them
+        self.assertEqual(self.app.ensure_changelog_partitions(), ['change_log_y2020m01', 'change_log_y2020m02'])
+        self.assertEqual(self.count('change_log_default'), 0)
+        self.assertEqual(self.count('change_log_y2020m01'), 2)
+        self.assertEqual(self.count('change_log_y2020m02'), 2)
+        self.assertEqual(self.left(), ['a', 'b', 'c', 'd', 'e'])
+
+        # january is dropped, the permanent entry stays in a partition of its month
+        self.assertEqual(self.app.prune_changelog('2020-02-01'), 1)
+        self.assertEqual(self.left(), ['b', 'c', 'd', 'e'])
+        self.assertEqual(self.count('change_log_y2020m01'), 1)
+        self.assertEqual(self.count('change_log_default'), 0)
+        self.assertTrue('change_log_y2020m01' in self.partitions())
+
+        # february is archived
+        self.assertEqual(self.app.prune_changelog('2020-03-01', archive=True), 1)
+        self.assertEqual(self.left(), ['b', 'd', 'e'])
+        self.assertEqual(self.count('change_log_y2020m02_archived'), 2)
+        self.assertEqual(self.count('change_log_y2020m02'), 1)
+        self.assertEqual(self.count('change_log_default'), 0)
+
+        # nothing left to prune, partitions holding only permanent entries are left alone
+        self.assertEqual(self.app.prune_changelog('2020-03-01'), 0)
+        self.assertEqual(self.left(), ['b', 'd', 'e'])
+
+    def test_prune_with_missing_partitions(self):
+        # the partitions ahead were never created: pruning still works
+        with self.app.session_scope() as session:
+            for name in self.partitions():
+                session.execute(text('DROP TABLE {}'.format(name)))
+            session.commit()
+        self.add('a', '2020-01-01')
+        self.add('e', get_date().isoformat())
+        self.assertEqual(self.app.prune_changelog('2020-06-01'), 1)
+        self.assertEqual(self.left(), ['e'])
+        self.assertEqual(len(self.app.ensure_changelog_partitions()), 4)
+        self.assertEqual(self.count('change_log_default'), 0)
+
+    def test_before_postgres_11(self):
+        # the migration leaves change_log a plain table, pruning deletes in batches
+        self.migrate(self.migration.downgrade)
+        with mock.patch.object(self.migration, '_partitioning_supported', return_value=False):
+            self.migrate(self.migration.upgrade)
+        self.assertEqual(self.partitions(), [])
+        self.add('a', '2020-01-01')
+        self.add('b', '2020-01-02', permanent=True)
+        self.add('e', get_date().isoformat())
+        self.assertEqual(self.app.ensure_changelog_partitions(), [])
+        self.assertEqual(self.app.prune_changelog('2020-06-01'), 1)
+        self.assertEqual(self.left(), ['b', 'e'])
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(ChangeLog).filter_by(key='b').one().oldvalue, 'old b')
+
+
+if __name__ == '__main__':
+    unittest.main()
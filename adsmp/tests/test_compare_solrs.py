@@ -0,0 +1,46 @@
+import unittest
+
+import mock
+
+from scripts import compare_solrs
+
+
+class TestCompareSolrs(unittest.TestCase):
+
+    def solr(self, docs):
+        """Fake solr answering cursor queries from a list of docs, two per page"""
+        docs = sorted(docs, key=lambda d: d['bibcode'])
+
+        def query_solr(endpoint, query, rows=200, sort=None, fl=None, cursor_mark=None):
+            start = 0 if cursor_mark == '*' else int(cursor_mark)
+            page = docs[start:start + 2]
+            return {'response': {'docs': page},
+                    'nextCursorMark': str(start + len(page)) if page else cursor_mark}
+        return query_solr
+
+    def test_merge_join(self):
+        docs1 = iter([{'bibcode': 'a'}, {'bibcode': 'b'}, {'bibcode': 'd'}])
+        docs2 = iter([{'bibcode': 'b'}, {'bibcode': 'c'}, {'bibcode': 'd'}, {'bibcode': 'e'}])
+        out = [(b, d1 is not None, d2 is not None) for b, d1, d2 in compare_solrs.merge_join(docs1, docs2)]
+        self.assertEqual(out, [('a', True, False), ('b', True, True), ('c', False, True),
+                               ('d', True, True), ('e', False, True)])
+
+    def test_compare_collections(self):
+        old = [{'bibcode': b, 'title': 't', 'id': i} for i, b in enumerate(['a', 'b', 'c', 'd', 'e'])]
+        new = [{'bibcode': b, 'title': 't', 'id': i} for i, b in enumerate(['b', 'c', 'd', 'e', 'f'])]
+        new[1]['title'] = 'changed'
+        solrs = {'http://old': self.solr(old), 'http://new': self.solr(new)}
+
+        def query_solr(endpoint, *args, **kwargs):
+            return solrs[endpoint](endpoint, *args, **kwargs)
+
+        with mock.patch.object(compare_solrs, 'query_solr', side_effect=query_solr) as qs:
+            totals = compare_solrs.compare_collections('http://old', 'http://new', rows=2)
+        self.assertEqual(totals, {'same': 3, 'changed': 1, 'added': 1, 'missing': 1})
+        # three pages and the empty one closing each cursor
+        self.assertEqual(qs.call_count, 8)
+        self.assertTrue(all(c[1]['sort'] == 'bibcode asc,id asc' for c in qs.call_args_list))
+
+
+if __name__ == '__main__':
+    unittest.main()
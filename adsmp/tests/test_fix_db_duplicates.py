@@ -93,5 +93,91 @@ class TestFixDbDuplicates(unittest.TestCase):
             self.assertEqual("{'bibcode': 'abc', 'world': 2}", r.nonbib_data)
 
 
+
+class TestFixDbDuplicatesSql(unittest.TestCase):
+    """The set based merge, on a records table without the unique bibcode index"""
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        proj_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+        self.app = app.ADSMasterPipelineCelery('test', local_config=\
+            {
+            'SQLALCHEMY_URL': 'sqlite:///',
+            'METRICS_SQLALCHEMY_URL': None,
+            'SQLALCHEMY_ECHO': False,
+            'PROJ_HOME' : proj_home,
+            'TEST_DIR' : os.path.join(proj_home, 'adsmp/tests'),
+            })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+        with self.app.session_scope() as session:
+            session.execute('DROP INDEX ix_records_bibcode')
+            session.execute('CREATE INDEX ix_records_bibcode ON records (bibcode)')
+            session.commit()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+        self.app.close_app()
+
+    def add(self, session, **kwargs):
+        rec = models.Records(**kwargs)
+        session.add(rec)
+        session.flush()
+
+    def test_process_all(self):
+        t = [adsputils.get_date('2020-01-0%sT00:00:00Z' % i) for i in range(1, 5)]
+        with self.app.session_scope() as session:
+            self.add(session, bibcode='abc', bib_data={'hello': 1}, bib_data_updated=t[0], bib_data_payload_checksum='0x1',
+                     nonbib_data={'world': 1}, nonbib_data_updated=t[0])
+            self.add(session, bibcode='abc', bib_data={'hello': 2}, bib_data_updated=t[2], bib_data_payload_checksum=None,
+                     nonbib_data={'world': 2}, nonbib_data_updated=t[1], fulltext_updated=t[1])
+            self.add(session, bibcode='abc', bib_data={'hello': 3}, bib_data_updated=t[1], bib_data_payload_checksum='0x3',
+                     metrics={'m': 3}, metrics_updated=t[3])
+            self.add(session, bibcode='def', bib_data={'def': 1}, bib_data_updated=t[0])
+            self.add(session, bibcode='def', orcid_claims={'o': 1}, orcid_claims_updated=t[0])
+            self.add(session, bibcode='ghi', bib_data={'ghi': 1}, bib_data_updated=t[0])
+            session.commit()
+
+        self.assertEqual(fix_db_duplicates.find_duplicates(self.app), ['abc', 'def'])
+        self.assertEqual(fix_db_duplicates.process_all(self.app, batch_size=1), 2)
+
+        with self.app.session_scope() as session:
+            recs = dict((r.bibcode, r) for r in session.query(models.Records).all())
+            self.assertEqual(sorted(recs), ['abc', 'def', 'ghi'])
+            r = recs['abc']
+            self.assertEqual(r.id, 1)
+            # every column of a field comes from the newest row
+            self.assertEqual(r.bib_data, {'hello': 2})
+            self.assertEqual(r.bib_data_updated, t[2])
+            self.assertEqual(r.bib_data_payload_checksum, None)
+            self.assertEqual(r.nonbib_data, {'world': 2})
+            self.assertEqual(r.metrics, {'m': 3})
+            self.assertEqual(r.fulltext_updated, t[1])
+            self.assertEqual(r.augments, None)
+            self.assertEqual(recs['def'].bib_data, {'def': 1})
+            self.assertEqual(recs['def'].orcid_claims, {'o': 1})
+            self.assertEqual(recs['ghi'].bib_data, {'ghi': 1})
+        self.assertEqual(fix_db_duplicates.find_duplicates(self.app), [])
+
+    def test_process_bibcode(self):
+        # the per bibcode mode also merges padded variants of the bibcode
+        t = [adsputils.get_date('2020-01-0%sT00:00:00Z' % i) for i in range(1, 3)]
+        with self.app.session_scope() as session:
+            self.add(session, bibcode='abc', bib_data={'hello': 1}, bib_data_updated=t[0])
+            self.add(session, bibcode=' abc ', bib_data={'hello': 2}, bib_data_updated=t[1],
+                     nonbib_data={'world': 2}, nonbib_data_updated=t[1])
+            session.add(models.Fulltext(bibcode='abc', data={'body': 'text'}))
+            session.commit()
+        self.assertEqual(fix_db_duplicates.find_duplicates(self.app), [])
+
+        fix_db_duplicates.process_bibcode(self.app, 'abc')
+        with self.app.session_scope() as session:
+            recs = session.query(models.Records).all()
+            self.assertEqual([(r.bibcode, r.bib_data, r.nonbib_data) for r in recs],
+                             [('abc', {'hello': 2}, {'world': 2})])
+            # the fulltext of the kept record is not deleted with the duplicate
+            self.assertEqual(session.query(models.Fulltext).count(), 1)
+
 if __name__ == '__main__':
     unittest.main()
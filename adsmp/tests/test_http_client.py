@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from mock import patch
+
+from adsmp import http_client
+
+
+class TestHttpClient(unittest.TestCase):
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        http_client.reset()
+
+    def test_sessions_per_host(self):
+        s1 = http_client.get_session('http://localhost:9983/solr/collection1/update')
+        s2 = http_client.get_session('http://localhost:9983/solr/collection2/update')
+        s3 = http_client.get_session('http://localhost:9984/solr/collection1/update')
+        self.assertTrue(s1 is s2)
+        self.assertFalse(s1 is s3)
+        adapter = s1.get_adapter('http://localhost:9983/solr')
+        self.assertEqual(adapter._pool_maxsize, http_client.config.get('HTTP_POOL_MAXSIZE', 10))
+        self.assertTrue(adapter.max_retries.total)
+
+        http_client.reset()
+        self.assertFalse(s1 is http_client.get_session('http://localhost:9983/solr/collection1/update'))
+
+    def test_request(self):
+        session = http_client.get_session('http://localhost:8080/update')
+        with patch.object(session, 'request', return_value='response') as r:
+            self.assertEqual(http_client.put('http://localhost:8080/update', data='[]'), 'response')
+            r.assert_called_with('PUT', 'http://localhost:8080/update', data='[]',
+                                 timeout=http_client.config.get('HTTP_TIMEOUT', 300))
+            http_client.post('http://localhost:8080/update', data='[]', timeout=5)
+            r.assert_called_with('POST', 'http://localhost:8080/update', data='[]', timeout=5)
+            http_client.get('http://localhost:8080/update', params={'q': '*'})
+            self.assertEqual(r.call_args[0][0], 'GET')
+
+
+if __name__ == '__main__':
+    unittest.main()
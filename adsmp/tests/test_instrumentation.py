@@ -0,0 +1,94 @@
+import os
+import unittest
+
+import mock
+
+from adsmp import instrumentation
+
+
+class TestInstrumentation(unittest.TestCase):
+
+    def setUp(self):
+        # never bind the metrics endpoint from the tests
+        self._server = instrumentation._server
+        instrumentation._server = False
+        instrumentation._stats.clear()
+
+    def tearDown(self):
+        instrumentation.configure(None)
+        instrumentation._stats.clear()
+        instrumentation._server = self._server
+
+    def test_disabled(self):
+        instrumentation.configure(None)
+        s = instrumentation.stage('index_solr', 'http_post', records=10)
+        self.assertTrue(s is instrumentation._noop)
+        with s as st:
+            st.add(records=5)
+        self.assertEqual(instrumentation.snapshot(), {})
+
+    def test_unknown_mode(self):
+        self.assertRaises(ValueError, instrumentation.configure, 'statsd')
+
+    def test_prometheus(self):
+        instrumentation.configure('prometheus')
+        with instrumentation.stage('index_solr', 'http_post', records=2, bytes=100):
+            pass
+        with instrumentation.stage('index_records', 'db_load') as st:
+            st.add(records=3)
+        try:
+            with instrumentation.stage('index_solr', 'http_post', records=1, bytes=50):
+                raise IOError('solr down')
+        except IOError:
+            pass
+        instrumentation.count('update_storage', 'metrics_skipped', records=4)
+
+        stats = instrumentation.snapshot()
+        self.assertEqual(stats[('index_solr', 'http_post')]['count'], 2)
+        self.assertEqual(stats[('index_solr', 'http_post')]['errors'], 1)
+        self.assertEqual(stats[('index_solr', 'http_post')]['records'], 3)
+        self.assertEqual(stats[('index_solr', 'http_post')]['bytes'], 150)
+        self.assertEqual(stats[('index_records', 'db_load')]['records'], 3)
+        self.assertEqual(stats[('update_storage', 'metrics_skipped')]['records'], 4)
+        self.assertEqual(stats[('update_storage', 'metrics_skipped')]['seconds'], 0.0)
+
+        out = instrumentation.render()
+        self.assertTrue('# TYPE adsmp_stage_calls_total counter' in out)
+        self.assertTrue('adsmp_stage_calls_total{task="index_solr",stage="http_post"} 2' in out)
+        self.assertTrue('adsmp_stage_records_total{task="index_records",stage="db_load"} 3' in out)
+
+    def test_log(self):
+        instrumentation.configure('log')
+        with mock.patch.object(instrumentation.logger, 'info') as info:
+            with instrumentation.stage('index_metrics', 'upsert', records=4):
+                pass
+        self.assertEqual(info.call_count, 1)
+        extra = info.call_args[1]['extra']
+        self.assertEqual((extra['task'], extra['stage'], extra['records'], extra['failed']),
+                         ('index_metrics', 'upsert', 4, False))
+        self.assertEqual(instrumentation.snapshot(), {})
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs fork')
+    def test_fork(self):
+        instrumentation.configure('prometheus')
+        with instrumentation.stage('index_solr', 'http_post', records=2):
+            pass
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # child: the parent's totals and endpoint are gone
+            ok = instrumentation.snapshot() == {} and instrumentation._server is None
+            os.write(write, ok and b'1' or b'0')
+            os._exit(0)
+        os.close(write)
+        out = os.read(read, 1)
+        os.close(read)
+        os.waitpid(pid, 0)
+        self.assertEqual(out, b'1')
+        # the parent keeps its own
+        self.assertEqual(instrumentation.snapshot()[('index_solr', 'http_post')]['records'], 2)
+        self.assertFalse(instrumentation._server is None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import os
+
+import mock
+import testing.postgresql
+
+from adsmp import app, models
+from adsmp.models import Base, Records
+
+
+class TestJSONPayloadPostgres(unittest.TestCase):
+    """The payload columns are jsonb on postgres"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.postgresql = \
+            testing.postgresql.Postgresql(host='127.0.0.1', port=15678, user='postgres',
+                                          database='test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.postgresql.stop()
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        proj_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+        self.app = app.ADSMasterPipelineCelery('test', local_config=\
+            {
+            'SQLALCHEMY_URL': 'postgresql://postgres@127.0.0.1:15678/test',
+            'METRICS_SQLALCHEMY_URL': None,
+            'SQLALCHEMY_ECHO': False,
+            'PROJ_HOME' : proj_home,
+            'TEST_DIR' : os.path.join(proj_home, 'adsmp/tests'),
+            })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        Base.metadata.drop_all()
+        self.app.close_app()
+
+    def test_jsonb(self):
+        self.app.update_storage('abc', 'bib_data', {'bibcode': 'abc', 'title': ['a title'], 'year': 2020})
+        self.app.update_storage('abc', 'nonbib_data', '{"boost": 0.5}')
+        with self.app.session_scope() as session:
+            self.assertEqual(session.execute("SELECT pg_typeof(bib_data)::text, bib_data->>'year' FROM records").fetchone(),
+                             ('jsonb', '2020'))
+            r = session.query(Records).filter_by(bibcode='abc').one()
+            self.assertEqual(r.bib_data, {'bibcode': 'abc', 'title': ['a title'], 'year': 2020})
+            self.assertEqual(r.nonbib_data, {'boost': 0.5})
+
+    def test_nul(self):
+        stripped = models.JSONPayload.nul_stripped
+        with mock.patch.object(models.logger, 'warning') as warning:
+            self.app.update_storage('abc', 'bib_data', {'bibcode': 'abc', 'title': 'a\x00b', 'path': 'c:\\u0000'})
+            self.assertEqual(warning.call_count, 1)
+        self.assertEqual(models.JSONPayload.nul_stripped, stripped + 1)
+        # the NUL is gone, an escaped backslash followed by u0000 is kept
+        self.assertEqual(self.app.get_record('abc')['bib_data'], {'bibcode': 'abc', 'title': 'ab', 'path': 'c:\\u0000'})
+
+        with mock.patch.object(models.logger, 'warning') as warning:
+            self.app.update_storage('abc', 'nonbib_data', {'path': 'c:\\u0000'})
+            self.assertEqual(warning.call_count, 0)
+
+    def test_invalid_json(self):
+        self.assertRaises(ValueError, self.app.update_storage, 'abc', 'bib_data', 'not json')
+        self.assertEqual(self.app.get_record('abc'), None)
+        saved = self.app.update_storage_bulk('nonbib_data', [('abc', 'not json'), ('foo', '{"boost": 1}')])
+        self.assertEqual(saved, ['foo'])
+        self.assertEqual(self.app.get_record('foo')['nonbib_data'], {'boost': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
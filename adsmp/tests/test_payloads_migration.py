@@ -0,0 +1,63 @@
+import unittest
+import os
+import imp
+
+import testing.postgresql
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import create_engine, text
+
+
+class TestPayloadsAsJsonb(unittest.TestCase):
+    """migration 6f2b8c1d4e73 (postgres)"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.postgresql = \
+            testing.postgresql.Postgresql(host='127.0.0.1', port=15678, user='postgres',
+                                          database='test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.postgresql.stop()
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        proj_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+        self.migration = imp.load_source('payloads_as_jsonb',
+                                         os.path.join(proj_home, 'alembic/versions/6f2b8c1d4e73_payloads_as_jsonb.py'))
+        self.engine = create_engine('postgresql://postgres@127.0.0.1:15678/test')
+        with self.engine.begin() as conn:
+            conn.execute(text('CREATE TABLE records (bibcode VARCHAR(19) PRIMARY KEY, {})'.format(
+                ', '.join('{} TEXT'.format(c) for c in self.migration.columns))))
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        with self.engine.begin() as conn:
+            conn.execute(text('DROP TABLE records'))
+        self.engine.dispose()
+
+    def test_upgrade(self):
+        values = {'valid': '{"title": "x"}',
+                  'nul': '{"title": "x\\u0000y"}',
+                  'empty': '',
+                  'blank': '  ',
+                  'invalid': 'not json',
+                  'null': None}
+        with self.engine.begin() as conn:
+            for bibcode, value in values.items():
+                conn.execute(text('INSERT INTO records (bibcode, bib_data) VALUES (:bibcode, :value)'),
+                             {'bibcode': bibcode, 'value': value})
+            with Operations.context(MigrationContext.configure(conn)):
+                self.migration.upgrade()
+            migrated = dict(conn.execute(text('SELECT bibcode, bib_data FROM records')).fetchall())
+        self.assertEqual(migrated, {'valid': {'title': 'x'},
+                                    'nul': {'title': 'xy'},
+                                    'empty': None,
+                                    'blank': None,
+                                    'invalid': 'not json',
+                                    'null': None})
+
+
+if __name__ == '__main__':
+    unittest.main()
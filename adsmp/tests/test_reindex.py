@@ -28,8 +28,8 @@ class TestReindex(unittest.TestCase):
         commit_time = datetime.datetime.utcnow() + datetime.timedelta(seconds=60)
         with patch('scripts.reindex.execute', return_value=(0, None, None)):
             with patch('os.path.exists', return_value=False):
-                with patch('requests.get', solr_responses):
-                    with patch('requests.post', solr_responses):
+                with patch('adsmp.http_client.get', solr_responses):
+                    with patch('adsmp.http_client.post', solr_responses):
                         with patch('scripts.reindex.str_to_datetime', return_value=commit_time):
                             with patch('time.sleep', return_value=None):
                                 with patch('scripts.reindex.assert_same', return_value=None):
@@ -78,7 +78,7 @@ class TestReindex(unittest.TestCase):
 
         solr_responses = Mock()
         solr_responses.side_effect = self.create_solr_monitor_side_effect()
-        with patch('requests.get', solr_responses):
+        with patch('adsmp.http_client.get', solr_responses):
             with patch('time.sleep', return_value=None):
                 reindex.monitor_solr_writes()
                 self.assertEqual(10, solr_responses.call_count)
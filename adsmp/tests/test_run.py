@@ -1,12 +1,16 @@
 
 import unittest
-from mock import patch
+from mock import patch, MagicMock
 import os
+import json
+from datetime import timedelta
 import testing.postgresql
+from adsputils import get_date
 
 from adsmp import app
-from adsmp.models import Base, Records
-from run import reindex_failed_bibcodes
+from adsmp.models import Base, KeyValue, Records
+from sqlalchemy import text
+from run import rebuild_collection, record_stats, reindex, reindex_failed_bibcodes
 
 
 class TestFixDbDuplicates(unittest.TestCase):
@@ -73,3 +77,177 @@ class TestFixDbDuplicates(unittest.TestCase):
             rec = session.query(Records).filter_by(bibcode='bibcode5').first()
             self.assertEqual(rec.status, None)
 
+
+    def test_reindex(self):
+        now = get_date()
+        with self.app.session_scope() as session:
+            for i in range(1, 8):
+                session.add(Records(bibcode='bibcode%s' % i, bib_data='{}', updated=now,
+                                    processed=now + timedelta(days=1) if i == 4 else None))
+            session.commit()
+
+        self.app.conf['REINDEX_PAGE_SIZE'] = 2
+        with patch('run.app', self.app), \
+                patch('adsmp.tasks.task_index_records.apply_async', return_value=None) as queue_bibcodes:
+            reindex(batch_size=2)
+            # records already processed after their last update are skipped in sql
+            sent = [c[1]['args'][0] for c in queue_bibcodes.call_args_list]
+            self.assertEqual(sent, [['bibcode1', 'bibcode2'], ['bibcode3', 'bibcode5'], ['bibcode6', 'bibcode7']])
+            with self.app.session_scope() as session:
+                self.assertTrue(session.query(KeyValue).filter_by(key='last.reindex.normal').first())
+                # finished runs leave no checkpoint behind
+                self.assertEqual(session.query(KeyValue).filter_by(key='last.reindex.normal.checkpoint').count(), 0)
+
+            queue_bibcodes.reset_mock()
+            reindex(since='1972', batch_size=10, force_processing=True)
+            self.assertEqual(len(queue_bibcodes.call_args_list[0][1]['args'][0]), 7)
+
+            # nothing was picked up by a worker, the same requests are coalesced
+            queue_bibcodes.reset_mock()
+            reindex(since='1972', batch_size=10, force_processing=True)
+            self.assertFalse(queue_bibcodes.called)
+            self.app.release_index_requests(['bibcode2'])
+            reindex(since='1972', batch_size=10, force_processing=True)
+            self.assertEqual(queue_bibcodes.call_args[1]['args'][0], ['bibcode2'])
+
+    def test_reindex_resume(self):
+        now = get_date()
+        with self.app.session_scope() as session:
+            for i in range(1, 6):
+                session.add(Records(bibcode='bibcode%s' % i, bib_data='{}', updated=now))
+            session.commit()
+
+        with patch('run.app', self.app), \
+                patch('adsmp.tasks.task_index_records.apply_async') as queue_bibcodes:
+            # die after the first batch went out
+            queue_bibcodes.side_effect = [None, Exception('broker gone')]
+            self.assertRaises(Exception, reindex, batch_size=2)
+            with self.app.session_scope() as session:
+                cp = json.loads(session.query(KeyValue).filter_by(key='last.reindex.normal.checkpoint').first().value)
+                self.assertEqual(cp['last_id'], 2)
+
+            queue_bibcodes.reset_mock()
+            queue_bibcodes.side_effect = None
+            reindex(batch_size=2)
+            sent = [c[1]['args'][0] for c in queue_bibcodes.call_args_list]
+            self.assertEqual(sent, [['bibcode3', 'bibcode4'], ['bibcode5']])
+            with self.app.session_scope() as session:
+                self.assertEqual(session.query(KeyValue).filter_by(key='last.reindex.normal.checkpoint').count(), 0)
+
+    def test_rebuild_collection(self):
+        with self.app.session_scope() as session:
+            for i in range(1, 6):
+                session.add(Records(bibcode='bibcode%s' % i, bib_data='{}'))
+            session.commit()
+
+        self.app.conf['REBUILD_QUEUE_HIGH_WATER'] = 10
+        self.app.conf['REBUILD_QUEUE_LOW_WATER'] = 2
+        self.app.conf['REBUILD_QUEUE_CHECK_BATCHES'] = 2
+        # depth is read for rebuild-index and index-solr before every second
+        # batch; the third batch finds index-solr over the high water mark and
+        # waits for it to drain below the low water mark, then the final drain
+        # loops run
+        depths = [0, 0,  0, 11,  5, 3,  2, 0,  0,  0]
+        rabbitmq = MagicMock()
+        rabbitmq.get_queue_depth.side_effect = depths
+        with patch('run.app', self.app), \
+                patch('run.PyRabbitClient', return_value=rabbitmq), \
+                patch('run.time.sleep') as sleep, \
+                patch('adsmp.tasks.task_rebuild_index.delay', return_value=None) as delay:
+            rebuild_collection(None, 2)
+            self.assertEqual([c[0][0] for c in delay.call_args_list],
+                             [['bibcode1', 'bibcode2'], ['bibcode3', 'bibcode4'], ['bibcode5']])
+            self.assertEqual(rabbitmq.get_queue_depth.call_count, len(depths))
+            self.assertEqual(sleep.call_count, 4)
+
+    def test_record_stats(self):
+        now = get_date()
+        with self.app.session_scope() as session:
+            session.add(Records(bibcode='bibcode1', status='success', bib_data='{}',
+                                updated=now - timedelta(days=2), processed=now - timedelta(days=1)))
+            session.add(Records(bibcode='bibcode2', status='solr-failed', bib_data='{}',
+                                updated=now - timedelta(days=3), processed=now - timedelta(days=4)))
+            session.add(Records(bibcode='bibcode3', status='solr-failed', updated=now - timedelta(days=1)))
+            session.add(Records(bibcode='bibcode4', fulltext='foobar', updated=now - timedelta(days=5),
+                                processed=now - timedelta(days=5)))
+            session.commit()
+
+        with patch.object(self.app, 'session_scope', wraps=self.app.session_scope) as scope:
+            stats = record_stats(self.app)
+            self.assertEqual(scope.call_count, 1)
+        self.assertFalse(stats['estimated'])
+        self.assertEqual(stats['total'], 4)
+        self.assertEqual(stats['columns']['bib_data'], 2)
+        self.assertEqual(stats['columns']['bibcode'], 4)
+        self.assertEqual(stats['columns']['fulltext'], 1)
+        self.assertEqual(stats['status'], {'success': 1, 'solr-failed': 2, None: 1})
+        # never processed, processed before the last update or at the same time
+        self.assertEqual(stats['pending'], 3)
+        self.assertEqual(stats['processed'], 1)
+        self.assertEqual(stats['oldest_pending'], now - timedelta(days=5))
+        # no statistics to estimate from on sqlite
+        self.assertEqual(record_stats(self.app, estimate=True), stats)
+
+
+class TestRecordStatsPostgres(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.postgresql = \
+            testing.postgresql.Postgresql(host='127.0.0.1', port=15678, user='postgres',
+                                          database='test')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.postgresql.stop()
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        proj_home = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
+        self.app = app.ADSMasterPipelineCelery('test', local_config=\
+            {
+            'SQLALCHEMY_URL': 'postgresql://postgres@127.0.0.1:15678/test',
+            'METRICS_SQLALCHEMY_URL': None,
+            'SQLALCHEMY_ECHO': False,
+            'PROJ_HOME' : proj_home,
+            'TEST_DIR' : os.path.join(proj_home, 'adsmp/tests'),
+            })
+        Base.metadata.bind = self.app._session.get_bind()
+        Base.metadata.create_all()
+
+    def tearDown(self):
+        unittest.TestCase.tearDown(self)
+        with self.app.session_scope() as session:
+            session.execute(text('DROP SCHEMA IF EXISTS other CASCADE'))
+            session.commit()
+        Base.metadata.drop_all()
+        self.app.close_app()
+
+    def test_estimated_stats(self):
+        now = get_date()
+        with self.app.session_scope() as session:
+            for i in range(10):
+                session.add(Records(bibcode='bibcode%s' % i, status=i < 8 and 'success' or None,
+                                    bib_data={'i': i}, updated=now))
+            # a records table of the same name in another schema
+            session.execute(text('CREATE SCHEMA other'))
+            session.execute(text('CREATE TABLE other.records AS SELECT g AS id, NULL::text AS status, '
+                                 "'x'::text AS bibcode FROM generate_series(1, 50) g"))
+            session.commit()
+        with self.app.session_scope() as session:
+            session.execute(text('ANALYZE records'))
+            session.execute(text('ANALYZE other.records'))
+            session.commit()
+
+        stats = record_stats(self.app, estimate=True)
+        self.assertTrue(stats['estimated'])
+        self.assertEqual(stats['total'], 10)
+        self.assertEqual(stats['columns']['bibcode'], 10)
+        self.assertEqual(stats['columns']['bib_data'], 10)
+        self.assertEqual(stats['status'], {'success': 8, None: 2})
+        # the processing state needs a scan, it is left out
+        self.assertEqual((stats['pending'], stats['processed'], stats['oldest_pending']), (None, None, None))
+
+        stats = record_stats(self.app)
+        self.assertFalse(stats['estimated'])
+        self.assertEqual((stats['total'], stats['pending'], stats['processed']), (10, 10, 0))
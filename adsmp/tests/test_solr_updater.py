@@ -805,6 +805,77 @@ class TestSolrUpdater(unittest.TestCase):
             d["uat_facet_hier"],
         )
 
+    def test_update_solr_parallel(self):
+        urls = ["http://solr1/update", "http://solr2/update", "http://solr3/update"]
+        codes = {"http://solr1/update": 200, "http://solr2/update": 503, "http://solr3/update": 500}
+
+        def post(url, data=None, headers=None):
+            r = mock.Mock()
+            r.status_code = codes[url.split("?")[0]]
+            return r
+
+        for parallel in (False, True):
+            with patch.dict(solr_updater.config, {"SOLR_PARALLEL_UPDATES": parallel}), patch(
+                "adsmp.http_client.post", side_effect=post
+            ) as p:
+                out = solr_updater.update_solr([{"bibcode": "foo"}], urls, ignore_errors=True)
+                self.assertEqual(out, [503, 500])
+                self.assertEqual(
+                    sorted([x[0][0] for x in p.call_args_list]), urls
+                )
+
+                p.reset_mock()
+                with self.assertRaises(Exception):
+                    solr_updater.update_solr([{"bibcode": "foo"}], urls, ignore_errors=False)
+
+            with patch.dict(solr_updater.config, {"SOLR_PARALLEL_UPDATES": parallel}), patch(
+                "adsmp.http_client.post", side_effect=post
+            ) as p:
+                out = solr_updater.update_solr([{"bibcode": "foo"}], urls[:1], commit=True)
+                self.assertEqual(out, [])
+                self.assertEqual(p.call_args[0][0], "http://solr1/update?commit=true")
+
+    def test_has_alnum(self):
+        self.assertTrue(solr_updater.has_alnum("abc"))
+        self.assertTrue(solr_updater.has_alnum(["-", "-", "x"]))
+        self.assertTrue(solr_updater.has_alnum(12))
+        self.assertTrue(solr_updater.has_alnum([["-"], ["b"]]))
+        self.assertFalse(solr_updater.has_alnum(["-", "-"]))
+        self.assertFalse(solr_updater.has_alnum(" - ; "))
+        self.assertFalse(solr_updater.has_alnum([]))
+
+    def test_compute_doctype_scores(self):
+        scores = solr_updater.compute_doctype_scores({"article": 1, "abstract": 2, "misc": 3})
+        self.assertEqual(scores, {"article": 1.0, "abstract": 0.5, "misc": 0.0})
+        self.assertEqual(solr_updater.compute_doctype_scores({"article": 1}), {"article": 1.0})
+        self.assertEqual(solr_updater.compute_doctype_scores(None), {})
+        self.assertEqual(round(solr_updater.DOCTYPE_SCORES["inproceedings"], 3), 0.857)
+
+    def test_delete_by_bibcodes(self):
+        r = mock.Mock()
+        r.status_code = 200
+        with patch.dict(solr_updater.config, {"SOLR_DELETE_BATCH_SIZE": 2}), patch(
+            "adsmp.http_client.post", return_value=r
+        ) as p:
+            deleted, failed = solr_updater.delete_by_bibcodes(
+                ["a", "b", "c"], ["http://solr1/update", "http://solr2/update"]
+            )
+            self.assertEqual(deleted, ["a", "b", "c"])
+            self.assertEqual(failed, [])
+            self.assertEqual(p.call_count, 4)
+            self.assertEqual(
+                json.loads(p.call_args_list[0][1]["data"]),
+                {"delete": {"query": 'bibcode:("a" OR "b")'}},
+            )
+            self.assertEqual(
+                json.loads(p.call_args_list[3][1]["data"]),
+                {"delete": {"query": 'bibcode:("c")'}},
+            )
+
+            r.status_code = 500
+            deleted, failed = solr_updater.delete_by_bibcodes(["a"], ["http://solr1/update"])
+            self.assertEqual((deleted, failed), ([], ["a"]))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -7,6 +7,7 @@ from datetime import datetime
 import mock
 from adsmsg import (
     AugmentAffiliationResponseRecord,
+    BibRecord,
     DenormalizedRecord,
     FulltextUpdate,
     MetricsRecord,
@@ -16,6 +17,7 @@ from adsmsg import (
 )
 from adsmsg.orcid_claims import OrcidClaims
 from adsputils import get_date
+from kombu import Queue
 from mock import Mock, patch
 
 from adsmp import app, tasks
@@ -92,6 +94,23 @@ class TestWorkers(unittest.TestCase):
             self.assertTrue(metrics_delete.called)
             self.assertFalse(augment.called)
 
+    def test_task_delete_documents_batch(self):
+        for bibcode in ("bib1", "bib2"):
+            self.app.update_storage(bibcode, "bib_data", {"bibcode": bibcode})
+        with patch(
+            "adsmp.solr_updater.delete_by_bibcodes",
+            return_value=(["bib1", "bib2", "bib3"], []),
+        ) as solr_delete, patch.object(
+            self.app, "metrics_delete_by_bibcodes", return_value=2
+        ) as metrics_delete:
+            tasks.task_delete_documents_batch(["bib1", "bib2", "bib3"])
+            solr_delete.assert_called_once_with(
+                ["bib1", "bib2", "bib3"], ["http://foo.bar.com/solr/v1"]
+            )
+            metrics_delete.assert_called_once_with(["bib1", "bib2", "bib3"])
+        self.assertEqual(self.app.get_record("bib1"), None)
+        self.assertEqual(self.app.get_record("bib2"), None)
+
     def test_task_update_record_delete(self):
         for x, cls in (("fulltext", FulltextUpdate), ("orcid_claims", OrcidClaims)):
             self.app.update_storage("bibcode", x, {"foo": "bar"})
@@ -117,6 +136,114 @@ class TestWorkers(unittest.TestCase):
             self.assertTrue(next_task.called)
             self.assertTrue(next_task.call_args[0], ("bibcode",))
 
+    def test_update_record_batch(self):
+        recs = NonBibRecordList()
+        recs.nonbib_records.extend([NonBibRecord(bibcode="bib1", boost=3.1)._data,
+                                    NonBibRecord(bibcode="bib2", boost=3.2)._data])
+        msgs = [DenormalizedRecord(bibcode="bib1", title=["one"]),
+                DenormalizedRecord(bibcode="bib2", title=["two"]),
+                recs,
+                FulltextUpdate(bibcode="bib1", body="INTRODUCTION"),
+                NonBibRecord(bibcode="bib3", boost=3.3)]
+        messages = [Mock() for _ in msgs]
+        batch = tasks.UpdateRecordBatch()
+        with patch.object(self.app, "update_storage_bulk", wraps=self.app.update_storage_bulk) as bulk, patch(
+            "adsmp.app.ADSMasterPipelineCelery.request_aff_augment"
+        ) as augment:
+            for msg, message in zip(msgs, messages):
+                batch.add(msg, message)
+            self.assertEqual(len(batch), 5)
+            self.assertFalse(any(m.ack.called for m in messages))
+            batch.flush()
+            self.assertEqual(len(batch), 0)
+            # metadata, nonbib_data (list and single message) and fulltext
+            self.assertEqual([c[0][0] for c in bulk.call_args_list], ["metadata", "nonbib_data", "fulltext"])
+            self.assertEqual([c[0][0] for c in augment.call_args_list], ["bib1", "bib2"])
+        self.assertTrue(all(m.ack.called for m in messages))
+        self.assertEqual(self.app.get_record("bib1")["bib_data"]["title"], ["one"])
+        self.assertEqual(self.app.get_record("bib1")["nonbib_data"]["boost"], 3.1)
+        self.assertEqual(self.app.get_record("bib1")["fulltext"]["body"], "INTRODUCTION")
+        self.assertEqual(self.app.get_record("bib3")["nonbib_data"]["boost"], 3.3)
+
+        # a later update of the same bibcode in another group flushes first
+        messages = [Mock(), Mock()]
+        batch.add(FulltextUpdate(bibcode="bib1", body="CHANGED"), messages[0])
+        batch.add(FulltextUpdate(bibcode="bib1", status="deleted"), messages[1])
+        self.assertTrue(messages[0].ack.called)
+        self.assertEqual(len(batch), 1)
+        batch.flush()
+        self.assertTrue(messages[1].ack.called)
+        self.assertEqual(self.app.get_record("bib1")["fulltext"], None)
+
+        # deleting the record flushes any pending update of it
+        messages = [Mock(), Mock()]
+        batch.add(NonBibRecord(bibcode="bib3", boost=1.0), messages[0])
+        batch.add(DenormalizedRecord(bibcode="bib3", status="deleted"), messages[1])
+        self.assertTrue(messages[0].ack.called)
+        with patch("adsmp.solr_updater.delete_by_bibcodes", return_value=(["bib3"], [])) as solr_delete, patch.object(
+            self.app, "metrics_delete_by_bibcodes", return_value=1
+        ):
+            batch.flush()
+            solr_delete.assert_called_once_with(["bib3"], ["http://foo.bar.com/solr/v1"])
+        self.assertTrue(messages[1].ack.called)
+        self.assertEqual(self.app.get_record("bib3"), None)
+
+    def test_update_record_batch_failure(self):
+        messages = [Mock(), Mock()]
+        batch = tasks.UpdateRecordBatch()
+        batch.add(NonBibRecord(bibcode="bib1", boost=3.1), messages[0])
+        batch.add(NonBibRecord(bibcode="bib2", boost=3.2), messages[1])
+        # the bulk write fails, the messages are retried one by one
+        with patch.object(self.app, "update_storage_bulk", side_effect=Exception("boom")), patch.object(
+            self.app, "update_storage", side_effect=[None, Exception("boom")]
+        ) as update:
+            batch.flush()
+            self.assertEqual(update.call_count, 2)
+        self.assertTrue(messages[0].ack.called)
+        self.assertFalse(messages[0].requeue.called)
+        # the failed update goes back to the queue
+        self.assertFalse(messages[1].ack.called)
+        self.assertFalse(messages[1].reject.called)
+        self.assertTrue(messages[1].requeue.called)
+
+    def test_consume_update_record_batches_bad_message(self):
+        class Stop(Exception):
+            pass
+
+        consumer = {}
+
+        def Consumer(queue, callbacks, accept):
+            consumer['callbacks'] = callbacks
+            return mock.MagicMock()
+
+        good, unknown, unreadable = Mock(headers={}), Mock(headers={}), Mock(headers={})
+        bodies = [([NonBibRecord(bibcode="bib1", boost=3.1)], {}, {}), good,
+                  ([BibRecord(bibcode="bib1")], {}, {}), unknown,
+                  ([], {}, {}), unreadable]
+
+        def drain_events(timeout):
+            if not bodies:
+                raise Stop()
+            body, message = bodies.pop(0), bodies.pop(0)
+            for callback in consumer['callbacks']:
+                callback(body, message)
+
+        conn = mock.MagicMock()
+        conn.Consumer.side_effect = Consumer
+        conn.drain_events.side_effect = drain_events
+        self.app.conf.CELERY_QUEUES = (Queue("update-record"),)
+        with patch.object(self.app, "connection_for_read") as connection:
+            connection.return_value.__enter__.return_value = conn
+            self.assertRaises(Stop, tasks.consume_update_record_batches, batch_size=1, max_wait=1000)
+        self.assertTrue(good.ack.called)
+        self.assertEqual(self.app.get_record("bib1")["nonbib_data"]["boost"], 3.1)
+        # a payload of unknown type is dropped, like task_update_record does
+        self.assertTrue(unknown.ack.called)
+        self.assertFalse(unknown.reject.called)
+        # a message that cannot be read is rejected, not redelivered forever
+        self.assertTrue(unreadable.reject.called)
+        self.assertFalse(unreadable.ack.called)
+
     def test_task_update_record_fulltext(self):
         with patch("adsmp.tasks.task_index_records.apply_async") as next_task:
             tasks.task_update_record(
@@ -202,8 +329,16 @@ class TestWorkers(unittest.TestCase):
             rec = MetricsRecord(**metrics_data)
             rec2 = MetricsRecord(**metrics_data2)
             recs.metrics_records.extend([rec._data, rec2._data])
-            tasks.task_update_record(recs)
+            with patch.object(
+                self.app, "update_storage", wraps=self.app.update_storage
+            ) as update_storage:
+                tasks.task_update_record(recs)
+                self.assertFalse(update_storage.called)
             self.assertFalse(next_task.called)
+            self.assertEqual(
+                self.app.get_record("3015ApJ...815..133Z")["metrics"]["bibcode"],
+                "3015ApJ...815..133Z",
+            )
 
     def _reset_checksum(self, bibcode):
         with self.app.session_scope() as session:
@@ -244,21 +379,23 @@ class TestWorkers(unittest.TestCase):
         ), patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "foobar",
-                "augments_updated": get_date(),
-                "bib_data": {},
-                "metrics": {},
-                "bib_data_updated": get_date(),
-                "nonbib_data_updated": get_date(),
-                "orcid_claims_updated": get_date(),
-                "processed": get_date("2012"),
-            },
+            return_value=[
+                {
+                    "bibcode": "foobar",
+                    "augments_updated": get_date(),
+                    "bib_data": {},
+                    "metrics": {},
+                    "bib_data_updated": get_date(),
+                    "nonbib_data_updated": get_date(),
+                    "orcid_claims_updated": get_date(),
+                    "processed": get_date("2012"),
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_records.apply_async", return_value=None
         ) as task_index_records:
             self.assertFalse(update_solr.called)
-            tasks.task_index_records("2015ApJ...815..133S")
+            tasks.task_index_records("foobar")
             self.assertTrue(update_solr.called)
             self.assertTrue(mp.called)
 
@@ -275,19 +412,21 @@ class TestWorkers(unittest.TestCase):
         ), patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "foobar",
-                "augments_updated": get_date(),
-                "bib_data_updated": get_date(),
-                "nonbib_data_updated": get_date(),
-                "orcid_claims_updated": get_date(),
-                "processed": get_date(str(future_year)),
-            },
+            return_value=[
+                {
+                    "bibcode": "foobar",
+                    "augments_updated": get_date(),
+                    "bib_data_updated": get_date(),
+                    "nonbib_data_updated": get_date(),
+                    "orcid_claims_updated": get_date(),
+                    "processed": get_date(str(future_year)),
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_records.apply_async", return_value=None
         ) as task_index_records:
             self.assertFalse(update_solr.called)
-            tasks.task_index_records("2015ApJ...815..133S")
+            tasks.task_index_records("foobar")
             self.assertFalse(update_solr.called)
 
         self._check_checksum("foobar", solr=None)
@@ -301,21 +440,23 @@ class TestWorkers(unittest.TestCase):
         ), patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "foobar",
-                "augments_updated": get_date(),
-                "bib_data_updated": get_date(),
-                "bib_data": {},
-                "metrics": {},
-                "nonbib_data_updated": get_date(),
-                "orcid_claims_updated": get_date(),
-                "processed": get_date(str(future_year)),
-            },
+            return_value=[
+                {
+                    "bibcode": "foobar",
+                    "augments_updated": get_date(),
+                    "bib_data_updated": get_date(),
+                    "bib_data": {},
+                    "metrics": {},
+                    "nonbib_data_updated": get_date(),
+                    "orcid_claims_updated": get_date(),
+                    "processed": get_date(str(future_year)),
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_records.apply_async", return_value=None
         ) as task_index_records:
             self.assertFalse(update_solr.called)
-            tasks.task_index_records("2015ApJ...815..133S", force=True)
+            tasks.task_index_records("foobar", force=True)
             self.assertTrue(update_solr.called)
             self.assertTrue(mp.called)
 
@@ -330,19 +471,21 @@ class TestWorkers(unittest.TestCase):
         ), patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "foobar",
-                "augments_updated": get_date(),
-                "bib_data_updated": None,
-                "nonbib_data_updated": get_date(),
-                "orcid_claims_updated": get_date(),
-                "processed": None,
-            },
+            return_value=[
+                {
+                    "bibcode": "foobar",
+                    "augments_updated": get_date(),
+                    "bib_data_updated": None,
+                    "nonbib_data_updated": get_date(),
+                    "orcid_claims_updated": get_date(),
+                    "processed": None,
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_records.apply_async", return_value=None
         ) as task_index_records:
             self.assertFalse(update_solr.called)
-            tasks.task_index_records("2015ApJ...815..133S")
+            tasks.task_index_records("foobar")
             self.assertFalse(update_solr.called)
 
         self._check_checksum("foobar", solr=None)
@@ -356,21 +499,23 @@ class TestWorkers(unittest.TestCase):
         ), patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "foobar",
-                "augments_updated": get_date(),
-                "bib_data_updated": get_date(),
-                "bib_data": {},
-                "metrics": {},
-                "nonbib_data_updated": None,
-                "orcid_claims_updated": get_date(),
-                "processed": None,
-            },
+            return_value=[
+                {
+                    "bibcode": "foobar",
+                    "augments_updated": get_date(),
+                    "bib_data_updated": get_date(),
+                    "bib_data": {},
+                    "metrics": {},
+                    "nonbib_data_updated": None,
+                    "orcid_claims_updated": get_date(),
+                    "processed": None,
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_records.apply_async", return_value=None
         ) as task_index_records:
             self.assertFalse(update_solr.called)
-            tasks.task_index_records("2015ApJ...815..133S", force=True)
+            tasks.task_index_records("foobar", force=True)
             self.assertTrue(update_solr.called)
             self.assertTrue(mp.called)
             self.assertFalse(task_index_records.called)
@@ -383,20 +528,22 @@ class TestWorkers(unittest.TestCase):
         ), patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "foobar",
-                "augments_updated": get_date(),
-                "bib_data_updated": None,
-                "nonbib_data_updated": None,
-                "orcid_claims_updated": None,
-                "fulltext_claims_updated": get_date(),
-                "processed": None,
-            },
+            return_value=[
+                {
+                    "bibcode": "foobar",
+                    "augments_updated": get_date(),
+                    "bib_data_updated": None,
+                    "nonbib_data_updated": None,
+                    "orcid_claims_updated": None,
+                    "fulltext_claims_updated": get_date(),
+                    "processed": None,
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_records.apply_async", return_value=None
         ) as task_index_records:
             self.assertFalse(update_solr.called)
-            tasks.task_index_records("2015ApJ...815..133S")
+            tasks.task_index_records("foobar")
             self.assertFalse(update_solr.called)
 
         with patch.object(self.app, "mark_processed", return_value=None) as mp, patch(
@@ -407,21 +554,23 @@ class TestWorkers(unittest.TestCase):
         ), patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "foobar",
-                "augments_updated": get_date(),
-                "bib_data_updated": get_date("2012"),
-                "bib_data": {},
-                "metrics": {},
-                "nonbib_data_updated": get_date("2012"),
-                "orcid_claims_updated": get_date("2012"),
-                "processed": get_date("2014"),
-            },
+            return_value=[
+                {
+                    "bibcode": "foobar",
+                    "augments_updated": get_date(),
+                    "bib_data_updated": get_date("2012"),
+                    "bib_data": {},
+                    "metrics": {},
+                    "nonbib_data_updated": get_date("2012"),
+                    "orcid_claims_updated": get_date("2012"),
+                    "processed": get_date("2014"),
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_records.apply_async", return_value=None
         ) as task_index_records:
             self.assertFalse(update_solr.called)
-            tasks.task_index_records("2015ApJ...815..133S")
+            tasks.task_index_records("foobar")
             self.assertTrue(update_solr.called)
             self.assertTrue(mp.called)
 
@@ -443,6 +592,36 @@ class TestWorkers(unittest.TestCase):
             tasks.task_index_records(["non-existent"])
             logger.assert_called_with("The bibcode %s doesn't exist!", "non-existent")
 
+    def test_task_index_records_batch_load(self):
+        """the whole batch is loaded from the database at once"""
+        bibcodes = ["bib%s" % i for i in range(5)]
+        for bibcode in bibcodes:
+            self.app.update_storage(bibcode, "bib_data", {"bibcode": bibcode, "title": "x"})
+        self.app.conf["REINDEX_LOAD_CHUNK_SIZE"] = 2
+        with patch.object(
+            self.app, "get_record", wraps=self.app.get_record
+        ) as getter, patch(
+            "adsmp.tasks.task_index_solr.apply_async", return_value=None
+        ) as next_task:
+            tasks.task_index_records(
+                bibcodes + ["non-existent"],
+                force=True,
+                update_metrics=False,
+                update_links=False,
+            )
+            self.assertEqual(getter.call_count, 3)
+            solr_records = next_task.call_args[1]["args"][0]
+            self.assertEqual([x["bibcode"] for x in solr_records], bibcodes)
+
+    def test_index_tasks_release_index_requests(self):
+        """both indexing tasks release the index requests of their bibcodes"""
+        with patch("adsmp.tasks.reindex_records", return_value=None):
+            self.assertEqual(self.app.claim_index_requests(["abc", "def"]), ["abc", "def"])
+            tasks.task_index_records(["abc"])
+            self.assertEqual(self.app.claim_index_requests(["abc", "def"]), ["abc"])
+            tasks.task_rebuild_index(["abc", "def"])
+            self.assertEqual(self.app.claim_index_requests(["abc", "def"]), ["abc", "def"])
+
     def test_task_index_records_links(self):
         """verify data is sent to links microservice update endpoint"""
         r = Mock()
@@ -456,18 +635,20 @@ class TestWorkers(unittest.TestCase):
         with patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "linkstest",
-                "nonbib_data": {"data_links_rows": [{"baz": 0}]},
-                "bib_data_updated": get_date(),
-                "nonbib_data_updated": get_date(),
-                "processed": get_date(str(future_year)),
-            },
+            return_value=[
+                {
+                    "bibcode": "linkstest",
+                    "nonbib_data": {"data_links_rows": [{"baz": 0}]},
+                    "bib_data_updated": get_date(),
+                    "nonbib_data_updated": get_date(),
+                    "processed": get_date(str(future_year)),
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_data_links_resolver.apply_async",
             wraps=unwind_task_index_data_links_resolver_apply_async,
         ), patch(
-            "requests.put", return_value=r, new_callable=CopyingMock
+            "adsmp.http_client.put", return_value=r, new_callable=CopyingMock
         ) as p:
             tasks.task_index_records(
                 ["linkstest"],
@@ -496,18 +677,20 @@ class TestWorkers(unittest.TestCase):
         with patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "linkstest",
-                "nonbib_data": {"boost": 1.2},
-                "bib_data_updated": get_date(),
-                "nonbib_data_updated": get_date(),
-                "processed": get_date(str(future_year)),
-            },
+            return_value=[
+                {
+                    "bibcode": "linkstest",
+                    "nonbib_data": {"boost": 1.2},
+                    "bib_data_updated": get_date(),
+                    "nonbib_data_updated": get_date(),
+                    "processed": get_date(str(future_year)),
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_data_links_resolver.apply_async",
             wraps=unwind_task_index_data_links_resolver_apply_async,
         ), patch(
-            "requests.put", new_callable=CopyingMock
+            "adsmp.http_client.put", new_callable=CopyingMock
         ) as p:
             tasks.task_index_records(
                 ["linkstest"],
@@ -529,24 +712,28 @@ class TestWorkers(unittest.TestCase):
             "adsmp.tasks.task_index_solr.apply_async",
             wraps=unwind_task_index_solr_apply_async,
         ):
-            getter.return_value = {
-                "bibcode": "foo",
-                "bib_data_updated": get_date("1972-04-01"),
-                "metrics": {},
-            }
+            getter.return_value = [
+                {
+                    "bibcode": "foo",
+                    "bib_data_updated": get_date("1972-04-01"),
+                    "metrics": {},
+                }
+            ]
             tasks.task_index_records(["foo"], force=True)
 
             self.assertEqual(update_solr.call_count, 1)
             self._check_checksum("foo", solr="0x8f51bd8d")
 
             # now change metrics (solr shouldn't be called)
-            getter.return_value = {
-                "bibcode": "foo",
-                "metrics_updated": get_date("1972-04-02"),
-                "bib_data_updated": get_date("1972-04-01"),
-                "metrics": {},
-                "solr_checksum": "0x8f51bd8d",
-            }
+            getter.return_value = [
+                {
+                    "bibcode": "foo",
+                    "metrics_updated": get_date("1972-04-02"),
+                    "bib_data_updated": get_date("1972-04-01"),
+                    "metrics": {},
+                    "solr_checksum": "0x8f51bd8d",
+                }
+            ]
             tasks.task_index_records(["foo"], force=True)
             self.assertEqual(update_solr.call_count, 1)
 
@@ -559,12 +746,14 @@ class TestWorkers(unittest.TestCase):
             "adsmp.tasks.task_index_solr.apply_async",
             wraps=unwind_task_index_solr_apply_async,
         ):
-            getter.return_value = {
-                "bibcode": "foo",
-                "metrics_updated": get_date("1972-04-02"),
-                "bib_data_updated": get_date("1972-04-01"),
-                "solr_checksum": "0x8f51bd8d",
-            }
+            getter.return_value = [
+                {
+                    "bibcode": "foo",
+                    "metrics_updated": get_date("1972-04-02"),
+                    "bib_data_updated": get_date("1972-04-01"),
+                    "solr_checksum": "0x8f51bd8d",
+                }
+            ]
 
             # update with matching checksum and then update and ignore checksums
             tasks.task_index_records(
@@ -595,19 +784,21 @@ class TestWorkers(unittest.TestCase):
         with patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "linkstest",
-                "nonbib_data": {"data_links_rows": [{"baz": 0}]},
-                "bib_data_updated": get_date(),
-                "nonbib_data_updated": get_date(),
-                "processed": get_date(str(future_year)),
-                "datalinks_checksum": "0x80e85169",
-            },
+            return_value=[
+                {
+                    "bibcode": "linkstest",
+                    "nonbib_data": {"data_links_rows": [{"baz": 0}]},
+                    "bib_data_updated": get_date(),
+                    "nonbib_data_updated": get_date(),
+                    "processed": get_date(str(future_year)),
+                    "datalinks_checksum": "0x80e85169",
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_data_links_resolver.apply_async",
             wraps=unwind_task_index_data_links_resolver_apply_async,
         ), patch(
-            "requests.put", return_value=r, new_callable=CopyingMock
+            "adsmp.http_client.put", return_value=r, new_callable=CopyingMock
         ) as p:
             # update with matching checksum and then update and ignore checksums
             tasks.task_index_records(
@@ -639,13 +830,15 @@ class TestWorkers(unittest.TestCase):
         with patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "metricstest",
-                "bib_data_updated": get_date(),
-                "metrics": {"refereed": False, "author_num": 2},
-                "processed": get_date(str(future_year)),
-                "metrics_checksum": "0x424cb03e",
-            },
+            return_value=[
+                {
+                    "bibcode": "metricstest",
+                    "bib_data_updated": get_date(),
+                    "metrics": {"refereed": False, "author_num": 2},
+                    "processed": get_date(str(future_year)),
+                    "metrics_checksum": "0x424cb03e",
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_metrics.apply_async",
             wraps=unwind_task_index_metrics_apply_async,
@@ -681,13 +874,15 @@ class TestWorkers(unittest.TestCase):
         with patch.object(
             self.app,
             "get_record",
-            return_value={
-                "bibcode": "noMetrics",
-                "nonbib_data": {"boost": 1.2},
-                "bib_data_updated": get_date(),
-                "nonbib_data_updated": get_date(),
-                "processed": get_date(str(future_year)),
-            },
+            return_value=[
+                {
+                    "bibcode": "noMetrics",
+                    "nonbib_data": {"boost": 1.2},
+                    "bib_data_updated": get_date(),
+                    "nonbib_data_updated": get_date(),
+                    "processed": get_date(str(future_year)),
+                }
+            ],
         ), patch(
             "adsmp.tasks.task_index_metrics.apply_async",
             wraps=unwind_task_index_metrics_apply_async,
@@ -0,0 +1,105 @@
+import unittest
+
+import mock
+
+from adsmp import validate
+
+
+class TestValidate(unittest.TestCase):
+
+    def setUp(self):
+        self.v = validate.Validate(('bibcode', 'title', 'citation_count'), ('id',), ('origin',))
+        self.v.config = {'SOLR_URL_OLD': 'http://old', 'SOLR_URL_NEW': 'http://new',
+                         'SOLR_VALIDATE_BATCH_SIZE': 2, 'SOLR_VALIDATE_THREADS': 2}
+        self.solr = {'http://old': {'a': {'bibcode': 'a', 'title': 'x', 'citation_count': 1},
+                                    'b': {'bibcode': 'b', 'title': 'y', 'citation_count': 1},
+                                    'c': {'bibcode': 'c', 'title': 'z', 'citation_count': 1}},
+                     'http://new': {'a': {'bibcode': 'a', 'title': 'x', 'citation_count': 2},
+                                    'b': {'bibcode': 'b', 'title': 'y', 'citation_count': 10},
+                                    'd': {'bibcode': 'd', 'title': 'z', 'citation_count': 1}}}
+
+    def get(self, url, params=None):
+        bibcodes = params['q'][len('bibcode:('):-1].replace('"', '').split(' OR ')
+        r = mock.Mock(status_code=200)
+        r.json.return_value = {'response': {'docs': [self.solr[url][b] for b in bibcodes if b in self.solr[url]]}}
+        return r
+
+    def test_compare_solr(self):
+        with mock.patch('adsmp.http_client.get', side_effect=self.get) as get:
+            totals, field_totals = self.v.compare_solr(bibcodelist=['a', 'b', 'c', 'd', 'e'])
+        # three batches, each sent to both solrs without highlighting
+        self.assertEqual(get.call_count, 6)
+        params = get.call_args_list[0][1]['params']
+        self.assertEqual(params['q'], 'bibcode:("a" OR "b")')
+        self.assertEqual(params['rows'], 2)
+        self.assertFalse('hl' in params)
+
+        self.assertEqual(totals['compared'], 2)
+        self.assertEqual(totals['with mismatches'], 1)
+        self.assertEqual(totals['missing from new'], 1)
+        self.assertEqual(totals['missing from old'], 1)
+        self.assertEqual(totals['not in either'], 1)
+        self.assertEqual(dict(field_totals), {'citation_count': {False: 1}})
+
+    def test_compare_solr_query_failure(self):
+        def get(url, params=None):
+            if url == 'http://new' and '"c"' in params['q']:
+                return mock.Mock(status_code=503)
+            return self.get(url, params)
+        with mock.patch('adsmp.http_client.get', side_effect=get):
+            totals, field_totals = self.v.compare_solr(bibcodelist=['a', 'b', 'c', 'd'])
+        self.assertEqual(totals['query failed'], 2)
+        self.assertEqual(totals['compared'], 2)
+
+    def test_compare_solr_window(self):
+        """At most SOLR_VALIDATE_THREADS batches are queried ahead of the comparison"""
+        queried = []
+        in_flight = []
+
+        def query_solr_batch(v, endpoint, bibcodes):
+            queried.append(bibcodes[0])
+            return self.solr[endpoint]
+
+        def compare_batch(v, batch, docs1, docs2, totals, field_totals):
+            in_flight.append(len(set(queried)) - len(in_flight))
+
+        bibcodes = ['x%s' % i for i in range(20)]
+        with mock.patch.object(validate.Validate, 'query_solr_batch', side_effect=query_solr_batch), \
+                mock.patch.object(validate.Validate, '_compare_batch', side_effect=compare_batch):
+            self.v.compare_solr(bibcodelist=bibcodes)
+        self.assertEqual(len(in_flight), 10)
+        self.assertTrue(max(in_flight) <= 2)
+
+
+    def test_text_similar(self):
+        # short texts are still decided by SequenceMatcher
+        self.assertTrue(validate.text_similar('a title of a paper', 'a title of the paper'))
+        self.assertFalse(validate.text_similar('a title of a paper', 'completely else'))
+        self.assertEqual(validate.text_similar('abcde', 'abcxy'),
+                         validate.SequenceMatcher(None, 'abcde', 'abcxy').ratio() >= 0.8)
+
+        words = ['word%s' % i for i in range(2000)]
+        body = ' '.join(words)
+        with mock.patch('adsmp.validate.SequenceMatcher') as sm:
+            # lengths too far apart for a ratio of 0.8
+            self.assertFalse(validate.text_similar(body, body[:len(body) // 2]))
+            # one word changed, the shingles agree
+            self.assertTrue(validate.text_similar(body, body.replace('word1000 ', 'changed ')))
+            # same length, nothing in common
+            self.assertFalse(validate.text_similar(body, body.upper()))
+            self.assertEqual(sm.call_count, 0)
+
+        # close to the threshold the exact ratio decides
+        changed = ' '.join(w if i % 5 else 'x' * len(w) for i, w in enumerate(words))
+        with mock.patch('adsmp.validate.SequenceMatcher') as sm:
+            sm.return_value.ratio.return_value = 0.9
+            self.assertTrue(validate.text_similar(body, changed))
+            self.assertEqual(sm.call_count, 1)
+
+    def test_fields_match_body(self):
+        body = ' '.join('word%s' % i for i in range(2000))
+        self.assertTrue(self.v.fields_match('a', {'body': body}, {'body': body + ' more'}, 'body'))
+        self.assertFalse(self.v.fields_match('a', {'body': body}, {'body': 'short'}, 'body'))
+
+if __name__ == '__main__':
+    unittest.main()
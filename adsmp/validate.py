@@ -3,10 +3,47 @@ from builtins import map
 from builtins import object
 import os
 import time
-import requests
 import sys
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from difflib import SequenceMatcher
 
+from adsmp import http_client
+
+# how the per field totals name the results of fields_match
+MISMATCH_LABELS = {False: 'mismatched',
+                   'required new field not in bibcode': 'missing required new field',
+                   'field not in bibcode': 'not in either database',
+                   'field not in s1': 'not in old database',
+                   'field not in s2': 'not in new database'}
+
+
+def _shingles(text, n=4):
+    return set(text[i:i + n] for i in range(max(len(text) - n + 1, 1)))
+
+
+def text_similar(f1, f2, threshold=0.8, exact_length=2000, margin=0.1):
+    """True if SequenceMatcher(None, f1, f2).ratio() >= threshold, without
+    running the quadratic SequenceMatcher on long texts when cheaper checks
+    already tell: the ratio can't exceed 2 * min(len) / (len1 + len2), and
+    for long texts a character shingle estimate decides unless it is within
+    margin of the threshold"""
+    if f1 == f2:
+        return True
+    l1, l2 = len(f1), len(f2)
+    if 2.0 * min(l1, l2) / (l1 + l2) < threshold:
+        return False
+    if l1 + l2 > exact_length:
+        s1, s2 = _shingles(f1), _shingles(f2)
+        common = len(s1 & s2)
+        # dice coefficient of the shingles, on the same scale as the ratio
+        estimate = 2.0 * common / (len(s1) + len(s2))
+        if estimate >= threshold + margin:
+            return True
+        if estimate < threshold - margin:
+            return False
+    return SequenceMatcher(None, f1, f2).ratio() >= threshold
+
 
 class Validate(object):
     """Validates the output of a new pipeline by comparing its SOLR instance against
@@ -50,77 +87,109 @@ class Validate(object):
 
         t1 = time.time()
 
-        for bibcode in bibcodes:
+        batch_size = self.config.get('SOLR_VALIDATE_BATCH_SIZE', 100)
+        threads = self.config.get('SOLR_VALIDATE_THREADS', 4)
+        totals = Counter()
+        field_totals = defaultdict(Counter)
+
+        # both solrs are queried at once; at most `threads` batches are in
+        # flight, the docs of a batch are released once it is compared
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            pending = deque()
+            for i in range(0, len(bibcodes), batch_size):
+                batch = bibcodes[i:i + batch_size]
+                pending.append((batch,
+                                executor.submit(Validate.query_solr_batch, self, SOLR_OLD, batch),
+                                executor.submit(Validate.query_solr_batch, self, SOLR_NEW, batch)))
+                if len(pending) >= threads:
+                    batch, f1, f2 = pending.popleft()
+                    Validate._compare_batch(self, batch, f1.result(), f2.result(), totals, field_totals)
+            while pending:
+                batch, f1, f2 = pending.popleft()
+                Validate._compare_batch(self, batch, f1.result(), f2.result(), totals, field_totals)
 
-            r1 = Validate.query_solr(self, SOLR_OLD, 'bibcode:"' + bibcode + '"', sort="bibcode desc", fl='*')
-            r2 = Validate.query_solr(self, SOLR_NEW, 'bibcode:"' + bibcode + '"', sort="bibcode desc", fl='*')
-
-            if (r1['response']['docs'] == []) and (r2['response']['docs'] == []):
+        tottime = time.time() - t1
+        self.logger.info('The following fields are ignored: {}'.format(self.ignore_fields))
+        for field in sorted(field_totals):
+            self.logger.info('Field {}: {}'.format(field, ', '.join('{} {}'.format(n, MISMATCH_LABELS.get(k, k))
+                                                                     for k, n in sorted(field_totals[field].items(), key=str))))
+        self.logger.info('Compared {} of {} bibcodes, {} with mismatched fields, {} missing from old SOLR, '
+                         '{} missing from new SOLR, {} in neither, {} not queried'.format(
+                             totals['compared'], len(bibcodes), totals['with mismatches'], totals['missing from old'],
+                             totals['missing from new'], totals['not in either'], totals['query failed']))
+        self.logger.info('Time elapsed to compare {} bibcodes: {} s'.format(len(bibcodes), tottime))
+        return totals, field_totals
+
+    def _compare_batch(self, batch, docs1, docs2, totals, field_totals):
+        """Compares the docs of one batch from both solrs, adds up the counts"""
+        if docs1 is None or docs2 is None:
+            self.logger.error('Could not query solr for {} bibcodes starting with {}'.format(len(batch), batch[0]))
+            totals['query failed'] += len(batch)
+            return
+        for bibcode in batch:
+            s1 = docs1.get(bibcode)
+            s2 = docs2.get(bibcode)
+            if s1 is None and s2 is None:
                 self.logger.error('Bibcode {} not in either SOLR'.format(bibcode))
-            elif r1['response']['docs'] == []:
+                totals['not in either'] += 1
+            elif s1 is None:
                 self.logger.error('Bibcode {} missing from old SOLR'.format(bibcode))
-            elif r2['response']['docs'] == []:
+                totals['missing from old'] += 1
+            elif s2 is None:
                 self.logger.error('Bibcode {} missing from new SOLR'.format(bibcode))
+                totals['missing from new'] += 1
             else:
-                s1 = r1['response']['docs'][0]
-                s2 = r2['response']['docs'][0]
-
-                Validate.pipeline_mismatch(self, bibcode, s1, s2)
-
-        tottime = time.time() - t1
-        self.logger.info('Time elapsed to compare {} bibcodes: {} s'.format(len(bibcodes), tottime))
-
-    def query_solr(self, endpoint, query, start=0, rows=200, sort="date desc", fl='bibcode'):
+                totals['compared'] += 1
+                mismatches = Validate.pipeline_mismatch(self, bibcode, s1, s2)
+                if mismatches:
+                    totals['with mismatches'] += 1
+                for field, match in mismatches.items():
+                    field_totals[field][match] += 1
+
+    def query_solr_batch(self, endpoint, bibcodes):
+        """Fetches the docs of several bibcodes with one query, returns {bibcode: doc} or None"""
+        query = 'bibcode:(' + ' OR '.join('"' + b + '"' for b in bibcodes) + ')'
+        r = Validate.query_solr(self, endpoint, query, rows=len(bibcodes), sort="bibcode desc", fl='*', hl=False)
+        if r is None:
+            return None
+        return dict((doc['bibcode'], doc) for doc in r['response']['docs'])
+
+    def query_solr(self, endpoint, query, start=0, rows=200, sort="date desc", fl='bibcode', hl=True):
         d = {'q': query,
              'sort': sort,
              'start': start,
              'rows': rows,
              'wt': 'json',
              'indent': 'true',
-             'hl': 'true',
-             'hl.fl': 'abstract,ack,body',
              }
+        if hl:
+            d['hl'] = 'true'
+            d['hl.fl'] = 'abstract,ack,body'
         if fl:
             d['fl'] = fl
 
-        response = requests.get(endpoint, params=d)
+        response = http_client.get(endpoint, params=d)
         if response.status_code == 200:
             results = response.json()
             return results
-        self.logger.warn('For query {}, there was a network problem: {0}\n'.format(query, response))
+        self.logger.warn('For query %s, there was a network problem: %s', query, response)
         return None
 
     def pipeline_mismatch(self, bibcode, s1, s2):
+        """Compares the fields of one bibcode, returns {field: result} for the fields that do not match"""
 
-        mismatch = 0
-        missing_required = 0
-        missing = 0
-        notins1 = 0
-        notins2 = 0
-
+        mismatches = {}
         for field in self.fields:
             if field not in self.ignore_fields:
                 match = Validate.fields_match(self, bibcode, s1, s2, field)
                 if match != True:
-                    if match == False:
-                        mismatch += 1
-                    if match == 'required new field not in bibcode':
-                        missing_required += 1
-                        missing += 1
-                    if match == 'field not in bibcode':
-                        missing += 1
-                    if match == 'field not in s1':
-                        notins1 += 1
-                    if match == 'field not in s2':
-                        notins2 += 1
-
-        if mismatch == 0:
-            self.logger.info('Bibcode {}: no mismatched fields'.format(bibcode))
+                    mismatches[field] = match
 
-        self.logger.info('The following fields are ignored: {}'.format(self.ignore_fields))
-        self.logger.info('Mismatch stats for bibcode {}: {} mismatches, {} missing required new fields, '
-                         '{} fields not in old database, {} fields not in new database, '
-                         '{} fields not in either database'.format(bibcode, mismatch, missing_required, notins1, notins2, missing))
+        if not mismatches:
+            self.logger.debug('Bibcode {}: no mismatched fields'.format(bibcode))
+        else:
+            self.logger.debug('Bibcode {}: mismatched fields {}'.format(bibcode, sorted(mismatches)))
+        return mismatches
 
     def fields_match(self, bibcode, s1, s2, field):
 
@@ -211,8 +280,7 @@ class Validate(object):
         if f1 != f2:
             # check how similar strings are
             if isinstance(f1, str) or (sys.version_info < (3,) and isinstance(f1, unicode)):
-                ratio = SequenceMatcher(None, f1, f2).ratio()
-                if ratio < 0.8:
+                if not text_similar(f1, f2, 0.8, self.config.get('SOLR_VALIDATE_EXACT_LENGTH', 2000)):
                     if field == 'body':
                         self.logger.warn(
                             'Bibcode %s: unicode field %s is different between databases.', bibcode, field,)
@@ -0,0 +1,25 @@
+"""add index_requests table
+
+Revision ID: 5b7e0d3a9c41
+Revises: e4b9a2c7d815
+Create Date: 2026-10-18 16:21:48.204117
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b7e0d3a9c41'
+down_revision = 'e4b9a2c7d815'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('index_requests',
+                    sa.Column('bibcode', sa.String(19), primary_key=True),
+                    sa.Column('options', sa.String(10), primary_key=True),
+                    sa.Column('queued', sa.TIMESTAMP))
+
+
+def downgrade():
+    op.drop_table('index_requests')
@@ -0,0 +1,75 @@
+"""store payload columns as jsonb
+
+Revision ID: 6f2b8c1d4e73
+Revises: 2d2af8a9c996
+Create Date: 2026-10-18 10:12:41.118023
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6f2b8c1d4e73'
+down_revision = '2d2af8a9c996'
+
+from alembic import op
+import logging
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+# fulltext is left as text, the next migration (a3d5e7f90b12) moves it into its own table
+columns = ('bib_data', 'orcid_claims', 'nonbib_data', 'metrics', 'augments')
+# the escape of the NUL character, unless the backslash itself is escaped
+nul_escape = "(?<!\\\\)((\\\\\\\\)*)\\\\u0000"
+
+# a single invalid value would abort the whole ALTER ... USING ::jsonb
+is_json = """
+CREATE FUNCTION pg_temp.is_json(value text) RETURNS boolean AS $$
+BEGIN
+    PERFORM value::jsonb;
+    RETURN true;
+EXCEPTION WHEN others THEN
+    RETURN false;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE
+"""
+
+
+def report(conn, message, column, where):
+    rows = conn.execute(sa.text("SELECT bibcode FROM records WHERE {0}".format(where))).fetchall()
+    if rows:
+        logger.warning(message, column, len(rows),
+                       ' '.join(r[0] for r in rows[:100]), len(rows) > 100 and ' ...' or '')
+
+
+def upgrade():
+    # sqlite keeps the serialized json in text columns (see models.JSONPayload)
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        return
+    conn = op.get_bind()
+    conn.execute(sa.text(is_json))
+    for c in columns:
+        # jsonb can not hold the NUL character, its escape is dropped
+        value = "regexp_replace({0}, '{1}', '\\1', 'g')".format(c, nul_escape)
+        report(conn, 'Removing NUL characters from %s of %s records: %s%s', c,
+               "{0} ~ '{1}'".format(c, nul_escape))
+        # empty values become NULL, other invalid json is kept as a json string
+        report(conn, 'Setting empty %s of %s records to NULL: %s%s', c,
+               "btrim({0}) = ''".format(c))
+        report(conn, 'Storing the invalid json in %s of %s records as a json string: %s%s', c,
+               "btrim({0}) != '' AND NOT pg_temp.is_json({1})".format(c, value))
+        op.alter_column('records', c, type_=postgresql.JSONB, existing_type=sa.Text,
+                        postgresql_using="CASE WHEN btrim({0}) = '' THEN NULL "
+                                         "WHEN pg_temp.is_json({1}) THEN ({1})::jsonb "
+                                         "ELSE to_jsonb({0}) END".format(c, value))
+    conn.execute(sa.text('DROP FUNCTION pg_temp.is_json(text)'))
+
+
+def downgrade():
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        return
+    for c in columns:
+        op.alter_column('records', c, type_=sa.Text, existing_type=postgresql.JSONB,
+                        postgresql_using='{0}::text'.format(c))
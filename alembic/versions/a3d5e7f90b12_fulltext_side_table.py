@@ -0,0 +1,79 @@
+"""move fulltext into its own compressed table
+
+Revision ID: a3d5e7f90b12
+Revises: 6f2b8c1d4e73
+Create Date: 2026-10-18 11:40:03.512264
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'a3d5e7f90b12'
+down_revision = '6f2b8c1d4e73'
+
+from alembic import op
+import sqlalchemy as sa
+import json
+import zlib
+
+# rows copied per round trip, keeps memory bounded on large tables
+batch_size = 1000
+
+
+def _serialize(value):
+    # fulltext is still text here (6f2b8c1d4e73 leaves it out), dicts only if it was ever jsonb
+    if not isinstance(value, str):
+        value = json.dumps(value)
+    return value
+
+
+def upgrade():
+    op.create_table('fulltext',
+                    sa.Column('bibcode', sa.String(19), primary_key=True),
+                    sa.Column('data', sa.LargeBinary))
+
+    conn = op.get_bind()
+    fulltext = sa.table('fulltext', sa.column('bibcode'), sa.column('data', sa.LargeBinary))
+    last_id = 0
+    while True:
+        rows = conn.execute(sa.text('SELECT id, bibcode, fulltext FROM records '
+                                    'WHERE id > :last_id AND fulltext IS NOT NULL '
+                                    'ORDER BY id LIMIT :limit'),
+                            {'last_id': last_id, 'limit': batch_size}).fetchall()
+        if not rows:
+            break
+        conn.execute(fulltext.insert(),
+                     [{'bibcode': r[1], 'data': zlib.compress(_serialize(r[2]).encode('utf-8'))} for r in rows])
+        last_id = rows[-1][0]
+
+    # the space taken by the old column is only given back by VACUUM FULL
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        with op.batch_alter_table("records") as batch_op:
+            batch_op.drop_column('fulltext')
+    else:
+        op.drop_column('records', 'fulltext')
+
+
+def downgrade():
+    cx = op.get_context()
+    # back to a text column, 6f2b8c1d4e73 never converted fulltext to jsonb
+    if 'sqlite' in cx.connection.engine.name:
+        with op.batch_alter_table("records") as batch_op:
+            batch_op.add_column(sa.Column('fulltext', sa.Text))
+    else:
+        op.add_column('records', sa.Column('fulltext', sa.Text))
+    update = sa.text('UPDATE records SET fulltext = :data WHERE bibcode = :bibcode')
+
+    conn = op.get_bind()
+    last_bibcode = ''
+    while True:
+        rows = conn.execute(sa.text('SELECT bibcode, data FROM fulltext '
+                                    'WHERE bibcode > :last_bibcode AND data IS NOT NULL '
+                                    'ORDER BY bibcode LIMIT :limit'),
+                            {'last_bibcode': last_bibcode, 'limit': batch_size}).fetchall()
+        if not rows:
+            break
+        conn.execute(update, [{'bibcode': r[0], 'data': zlib.decompress(r[1]).decode('utf-8')} for r in rows])
+        last_bibcode = rows[-1][0]
+
+    op.drop_table('fulltext')
@@ -0,0 +1,130 @@
+"""partition change_log by month (postgres 11+), compress oldvalue
+
+Revision ID: c81e4a5f2d36
+Revises: a3d5e7f90b12
+Create Date: 2026-10-18 14:02:55.730148
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c81e4a5f2d36'
+down_revision = 'a3d5e7f90b12'
+
+from alembic import op
+import sqlalchemy as sa
+from datetime import datetime
+import zlib
+
+# monthly partitions are created from the oldest entry up to this many months
+# ahead; afterwards app.ensure_changelog_partitions (run.py --prune-changelog)
+# keeps creating them. Partitioning needs postgres 11, on older servers only
+# oldvalue is converted.
+months_ahead = 3
+batch_size = 10000
+
+
+def _next_month(d):
+    return datetime(d.year + d.month // 12, d.month % 12 + 1, 1)
+
+
+def _decompress(value):
+    # values from before the upgrade were not compressed
+    if value is None:
+        return None
+    value = bytes(value)
+    try:
+        value = zlib.decompress(value)
+    except zlib.error:
+        pass
+    return value.decode('utf-8')
+
+
+def _partitioning_supported(conn):
+    # a primary key on a partitioned table and a default partition need
+    # postgres 11
+    return int(conn.execute(sa.text('SHOW server_version_num')).scalar()) >= 110000
+
+
+def upgrade():
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        # no partitioning on sqlite, only the compressed oldvalue
+        with op.batch_alter_table("change_log") as batch_op:
+            batch_op.alter_column('oldvalue', type_=sa.LargeBinary, existing_type=sa.Text)
+        # copied values keep their text storage class otherwise
+        op.execute('UPDATE change_log SET oldvalue = CAST(oldvalue AS BLOB)')
+        return
+
+    conn = op.get_bind()
+    if not _partitioning_supported(conn):
+        # older postgres: change_log stays a plain table (pruned with batched
+        # deletes), only oldvalue is compressed
+        op.execute("ALTER TABLE change_log ALTER COLUMN oldvalue TYPE BYTEA USING convert_to(oldvalue, 'UTF8')")
+        return
+
+    op.execute("CREATE TABLE change_log_partitioned ("
+               "id BIGINT NOT NULL DEFAULT nextval('change_log_id_seq'), "
+               "created TIMESTAMP NOT NULL, "
+               "key VARCHAR(255) NOT NULL, "
+               "type VARCHAR(255) NOT NULL, "
+               "oldvalue BYTEA, "
+               "permanent BOOLEAN DEFAULT FALSE, "
+               "PRIMARY KEY (id, created)) PARTITION BY RANGE (created)")
+
+    oldest = conn.execute(sa.text('SELECT min(created) FROM change_log')).scalar()
+    now = datetime.utcnow()
+    start = datetime((oldest or now).year, (oldest or now).month, 1)
+    stop = datetime(now.year, now.month, 1)
+    for i in range(months_ahead):
+        stop = _next_month(stop)
+    while start <= stop:
+        end = _next_month(start)
+        op.execute("CREATE TABLE change_log_y%04dm%02d PARTITION OF change_log_partitioned "
+                   "FOR VALUES FROM ('%s') TO ('%s')" % (start.year, start.month, start.isoformat(), end.isoformat()))
+        start = end
+    op.execute('CREATE TABLE change_log_default PARTITION OF change_log_partitioned DEFAULT')
+
+    # existing values are kept uncompressed, models.CompressedText reads both
+    op.execute("INSERT INTO change_log_partitioned (id, created, key, type, oldvalue, permanent) "
+               "SELECT id, COALESCE(created, 'epoch'), key, type, convert_to(oldvalue, 'UTF8'), permanent "
+               "FROM change_log")
+    op.execute('ALTER SEQUENCE change_log_id_seq OWNED BY change_log_partitioned.id')
+    op.drop_table('change_log')
+    op.execute('ALTER TABLE change_log_partitioned RENAME TO change_log')
+
+
+def downgrade():
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        rows = op.get_bind().execute(sa.text('SELECT id, oldvalue FROM change_log WHERE oldvalue IS NOT NULL')).fetchall()
+        with op.batch_alter_table("change_log") as batch_op:
+            batch_op.alter_column('oldvalue', type_=sa.Text, existing_type=sa.LargeBinary)
+        for r in rows:
+            op.get_bind().execute(sa.text('UPDATE change_log SET oldvalue = :oldvalue WHERE id = :id'),
+                                  {'id': r[0], 'oldvalue': _decompress(r[1])})
+        return
+
+    conn = op.get_bind()
+    op.execute("CREATE TABLE change_log_plain ("
+               "id BIGINT PRIMARY KEY DEFAULT nextval('change_log_id_seq'), "
+               "created TIMESTAMP, "
+               "key VARCHAR(255) NOT NULL, "
+               "type VARCHAR(255) NOT NULL, "
+               "oldvalue TEXT, "
+               "permanent BOOLEAN DEFAULT FALSE)")
+    insert = sa.text('INSERT INTO change_log_plain (id, created, key, type, oldvalue, permanent) '
+                     'VALUES (:id, :created, :key, :type, :oldvalue, :permanent)')
+    last_id = -1
+    while True:
+        rows = conn.execute(sa.text('SELECT id, created, key, type, oldvalue, permanent FROM change_log '
+                                    'WHERE id > :last_id ORDER BY id LIMIT :limit'),
+                            {'last_id': last_id, 'limit': batch_size}).fetchall()
+        if not rows:
+            break
+        values = [{'id': r[0], 'created': r[1], 'key': r[2], 'type': r[3], 'oldvalue': _decompress(r[4]), 'permanent': r[5]}
+                  for r in rows]
+        conn.execute(insert, values)
+        last_id = rows[-1][0]
+    op.execute('ALTER SEQUENCE change_log_id_seq OWNED BY change_log_plain.id')
+    op.drop_table('change_log')
+    op.execute('ALTER TABLE change_log_plain RENAME TO change_log')
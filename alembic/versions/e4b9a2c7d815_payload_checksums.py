@@ -0,0 +1,40 @@
+"""add payload checksum columns
+
+Revision ID: e4b9a2c7d815
+Revises: c81e4a5f2d36
+Create Date: 2026-10-18 15:02:17.530941
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e4b9a2c7d815'
+down_revision = 'c81e4a5f2d36'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+columns = ('bib_data', 'orcid_claims', 'nonbib_data', 'fulltext', 'metrics', 'augments')
+
+
+def upgrade():
+    # existing rows have no checksum, their next update is always written
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        with op.batch_alter_table("records") as batch_op:
+            for c in columns:
+                batch_op.add_column(sa.Column(c + '_payload_checksum', sa.String(10)))
+    else:
+        for c in columns:
+            op.add_column('records', sa.Column(c + '_payload_checksum', sa.String(10)))
+
+
+def downgrade():
+    cx = op.get_context()
+    if 'sqlite' in cx.connection.engine.name:
+        with op.batch_alter_table("records") as batch_op:
+            for c in columns:
+                batch_op.drop_column(c + '_payload_checksum')
+    else:
+        for c in columns:
+            op.drop_column('records', c + '_payload_checksum')
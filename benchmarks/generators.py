@@ -0,0 +1,128 @@
+"""Synthetic records for the benchmarks.
+
+Sizes follow what a typical refereed article looks like in the records
+table: a few KB of bibliographic metadata, tens of authors, references and
+reads, and (optionally) a fulltext body of a few tens of KB. Generation is
+seeded, so two runs work on the same data.
+"""
+import random
+import string
+
+from adsputils import get_date
+
+_words = [''.join(random.Random(i).choice(string.ascii_lowercase) for _ in range(3 + i % 9)) for i in range(2000)]
+
+
+def _text(rnd, n_words):
+    return ' '.join(rnd.choice(_words) for _ in range(n_words))
+
+
+def bibcode(i):
+    return '%04dBench%s...%05dA' % (2000 + i % 25, 'ABCDEFGHIJ'[i % 10], i % 100000)
+
+
+def bib_data(i, rnd, n_authors=30, n_references=40):
+    authors = ['%s, %s.' % (_text(rnd, 1).title(), rnd.choice(string.ascii_uppercase)) for _ in range(n_authors)]
+    return {
+        'bibcode': bibcode(i),
+        'title': [_text(rnd, 12).capitalize()],
+        'abstract': _text(rnd, 220),
+        'author': authors,
+        'author_norm': [a.replace('.', '') for a in authors],
+        'author_count': n_authors,
+        'first_author': authors[0],
+        'aff': ['%s Institute, %s' % (_text(rnd, 2).title(), _text(rnd, 1).title()) for _ in range(n_authors)],
+        'orcid_pub': ['-'] * n_authors,
+        'keyword': [_text(rnd, 2) for _ in range(6)],
+        'reference': [bibcode(rnd.randrange(1000000)) for _ in range(n_references)],
+        'doi': ['10.%d/bench.%d' % (1000 + i % 9000, i)],
+        'identifier': [bibcode(i), 'arXiv:%04d.%05d' % (1000 + i % 9000, i % 100000)],
+        'pub': 'The Benchmark Journal',
+        'pub_raw': 'The Benchmark Journal, Volume %d, Issue %d' % (i % 900, i % 12),
+        'pubdate': '%04d-%02d-00' % (2000 + i % 25, 1 + i % 12),
+        'year': str(2000 + i % 25),
+        'volume': str(i % 900),
+        'page': [str(i % 5000)],
+        'doctype': rnd.choice(['article', 'article', 'article', 'inproceedings', 'eprint', 'abstract']),
+        'database': ['astronomy'],
+        'bibstem': ['Bench'],
+        'property': ['REFEREED', 'ARTICLE'],
+    }
+
+
+def nonbib_data(i, rnd, n_reads=40, n_citations=25):
+    return {
+        'bibcode': bibcode(i),
+        'boost': rnd.random(),
+        'citation_count': n_citations,
+        'norm_cites': n_citations * 10,
+        'read_count': n_reads,
+        'readers': ['%016x' % rnd.getrandbits(64) for _ in range(n_reads)],
+        'reference': [bibcode(rnd.randrange(1000000)) for _ in range(n_citations)],
+        'simbad_objects': ['%d G' % rnd.randrange(10 ** 6) for _ in range(3)],
+        'grants': ['NASA %s' % rnd.randrange(10 ** 6) for _ in range(2)],
+        'data': ['CDS:1', 'NED:%d' % rnd.randrange(100)],
+        'property': ['REFEREED', 'ARTICLE', 'ESOURCE', 'OPENACCESS'],
+        'esource': ['PUB_HTML', 'PUB_PDF'],
+        'bibgroup': ['CfA'],
+    }
+
+
+def orcid_claims(i, rnd, n_authors=30):
+    verified = ['-'] * n_authors
+    verified[rnd.randrange(n_authors)] = '0000-0002-%04d-%04d' % (rnd.randrange(10000), rnd.randrange(10000))
+    return {'bibcode': bibcode(i), 'verified': verified, 'unverified': ['-'] * n_authors}
+
+
+def metrics(i, rnd, n_citations=25):
+    citations = [bibcode(rnd.randrange(1000000)) for _ in range(n_citations)]
+    return {
+        'bibcode': bibcode(i),
+        'an_citations': rnd.random(),
+        'an_refereed_citations': rnd.random(),
+        'author_num': 30,
+        'citations': citations,
+        'citation_num': n_citations,
+        'downloads': [rnd.randrange(100) for _ in range(25)],
+        'reads': [rnd.randrange(100) for _ in range(25)],
+        'refereed': True,
+        'refereed_citations': citations[:n_citations // 2],
+        'refereed_citation_num': n_citations // 2,
+        'reference_num': 40,
+        'rn_citations': rnd.random(),
+        'rn_citation_data': [{'ref_norm': rnd.random(), 'bibcode': b, 'pubyear': 2010, 'auth_norm': 1.0 / 30, 'cityear': 2015}
+                             for b in citations[:5]],
+    }
+
+
+def fulltext(i, rnd, n_words=6000):
+    return {'bibcode': bibcode(i), 'body': _text(rnd, n_words), 'acknowledgements': _text(rnd, 60)}
+
+
+def payloads(n, start=0, seed=42, with_fulltext=True, fulltext_words=6000):
+    """Yields (bibcode, {type: payload}) for n records, the types are the
+    ones accepted by app.update_storage"""
+    rnd = random.Random(seed)
+    for i in range(start, start + n):
+        out = {
+            'bib_data': bib_data(i, rnd),
+            'nonbib_data': nonbib_data(i, rnd),
+            'orcid_claims': orcid_claims(i, rnd),
+            'metrics': metrics(i, rnd),
+        }
+        if with_fulltext:
+            out['fulltext'] = fulltext(i, rnd, n_words=fulltext_words)
+        yield bibcode(i), out
+
+
+def db_records(n, start=0, seed=42, with_fulltext=True):
+    """Records as returned by app.get_record, without going through the db"""
+    now = get_date()
+    out = []
+    for i, (b, data) in enumerate(payloads(n, start=start, seed=seed, with_fulltext=with_fulltext)):
+        r = {'bibcode': b, 'id': start + i + 1}
+        for k, v in data.items():
+            r[k] = v
+            r[k + '_updated'] = now
+        out.append(r)
+    return out
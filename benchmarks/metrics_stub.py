@@ -0,0 +1,78 @@
+"""Minimal stand-in for the metrics database session, good enough to time
+the pipeline side of index_metrics (batching, mark_processed on the records
+database) without postgres:
+
+    with StubMetrics(app) as metrics:
+        app.index_metrics(batch, checksums)
+
+The upserted rows are serialized to json, roughly what the driver does to
+send them, and counted; nothing is stored.
+"""
+import json
+import threading
+
+
+class _Transaction(object):
+
+    def __init__(self, session):
+        self.session = session
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class _Session(object):
+
+    def __init__(self, stub):
+        self.stub = stub
+
+    def begin_nested(self):
+        return _Transaction(self)
+
+    def execute(self, statement, params=None):
+        params = params or []
+        size = len(json.dumps(params, default=str))
+        with self.stub.lock:
+            self.stub.statements += 1
+            self.stub.rows += len(params)
+            self.stub.bytes += size
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StubMetrics(object):
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.statements = self.rows = self.bytes = 0
+        self._saved = None
+
+    def __call__(self):
+        # app._metrics_session is a session factory
+        return _Session(self)
+
+    def start(self):
+        self._saved = (self.app._metrics_session, getattr(self.app, '_metrics_table_upsert', None))
+        self.app._metrics_session = self
+        self.app._metrics_table_upsert = None
+        return self
+
+    def stop(self):
+        self.app._metrics_session, self.app._metrics_table_upsert = self._saved
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
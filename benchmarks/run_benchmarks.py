@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+"""Times the indexing hot path on synthetic records and prints the results
+as JSON, to be kept and compared between runs:
+
+    python benchmarks/run_benchmarks.py -n 500 -o before.json
+    python benchmarks/run_benchmarks.py -n 500 -o after.json --compare before.json
+
+Runs offline: records go to an in-memory sqlite db (or --db-url, use a
+scratch database, tables are created and dropped), solr is replaced by a
+local stub server and the metrics database by a stub session unless
+--metrics-url is given.
+"""
+from __future__ import print_function
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+proj_home = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if proj_home not in sys.path:
+    sys.path.append(proj_home)
+
+import adsputils
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqlalchemy.orm import selectinload
+
+from adsmp import app as app_module, solr_updater
+from adsmp.models import Base, MetricsBase, Records
+from benchmarks import generators
+from benchmarks.metrics_stub import StubMetrics
+from benchmarks.solr_stub import StubSolr
+
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    """Registers fn(ctx) -> (number of items, run(i)); run is called
+    once per repetition"""
+    def decorator(fn):
+        BENCHMARKS[name] = fn
+        return fn
+    return decorator
+
+
+@benchmark('transform_json_record')
+def bench_transform(ctx):
+    return len(ctx.records), lambda i: [solr_updater.transform_json_record(r) for r in ctx.records]
+
+
+def _has_fields(doc):
+    # the "has:" and doctype_boost part of transform_json_record
+    has = [field for field in solr_updater.HAS_FIELDS if doc.get(field, "") and solr_updater.has_alnum(doc[field])]
+    return has, solr_updater.DOCTYPE_SCORES.get(doc.get("doctype"), None)
+
+
+def _has_fields_per_record(doc, config):
+    # the same as it was before the tables were computed at import: doctype
+    # scores and the sorted field list per record, a set of every character
+    # of the field
+    doctype_rank = config.get("DOCTYPE_RANKING")
+    unique_ranks = sorted(set(doctype_rank.values()))
+    rank_to_score = {rank: 1 - (i / (len(unique_ranks) - 1)) for i, rank in enumerate(unique_ranks)}
+    doctype_scores = {doctype: rank_to_score[rank] for doctype, rank in doctype_rank.items()}
+    has = []
+    for field in sorted(config.get("HAS_FIELDS", [])):
+        if doc.get(field, ""):
+            if not (isinstance(doc[field], list) or isinstance(doc[field], str)):
+                value = str.join("", str(doc[field]))
+            else:
+                value = str.join("", doc[field])
+            if any([char.isalnum() for char in set(value)]):
+                has.append(field)
+    return has, doctype_scores.get(doc.get("doctype"), None)
+
+
+@benchmark('has_fields')
+def bench_has_fields(ctx):
+    return len(ctx.solr_docs), lambda i: [_has_fields(d) for d in ctx.solr_docs]
+
+
+@benchmark('has_fields_per_record')
+def bench_has_fields_per_record(ctx):
+    # the reference for has_fields
+    config = solr_updater.config
+    return len(ctx.solr_docs), lambda i: [_has_fields_per_record(d, config) for d in ctx.solr_docs]
+
+
+@benchmark('transform_records')
+def bench_transform_records(ctx):
+    # solr document and checksum, in a process pool when SOLR_TRANSFORM_PROCESSES is set
+    return len(ctx.records), lambda i: ctx.app.transform_records(ctx.records)
+
+
+@benchmark('checksum')
+def bench_checksum(ctx):
+    return len(ctx.solr_docs), lambda i: [ctx.app.checksum(d) for d in ctx.solr_docs]
+
+
+@benchmark('Records.toJSON')
+def bench_tojson(ctx):
+    session = ctx.app._session()
+    rows = session.query(Records).options(selectinload(Records._fulltext)).all()
+    ctx.cleanup.append(session.close)
+    return len(rows), lambda i: [r.toJSON() for r in rows]
+
+
+@benchmark('update_storage')
+def bench_update_storage(ctx):
+    payloads = ctx.payloads[:ctx.batch_size]
+
+    def run(i):
+        for bibcode, data in payloads:
+            ctx.app.update_storage(bibcode, 'nonbib_data', dict(data['nonbib_data'], boost=i))
+    return len(payloads), run
+
+
+@benchmark('update_storage_unchanged')
+def bench_update_storage_unchanged(ctx):
+    payloads = ctx.payloads[:ctx.batch_size]
+
+    def run(i):
+        for bibcode, data in payloads:
+            ctx.app.update_storage(bibcode, 'orcid_claims', data['orcid_claims'])
+    return len(payloads), run
+
+
+@benchmark('update_storage_bulk')
+def bench_update_storage_bulk(ctx):
+    def run(i):
+        ctx.app.update_storage_bulk('nonbib_data', [(b, dict(data['nonbib_data'], boost=-i)) for b, data in ctx.payloads])
+    return len(ctx.payloads), run
+
+
+@benchmark('mark_processed')
+def bench_mark_processed(ctx):
+    bibcodes = [r['bibcode'] for r in ctx.records]
+    return len(bibcodes), lambda i: ctx.app.mark_processed(bibcodes, 'solr', checksums=ctx.checksums, status='success')
+
+
+def _mark_processed_per_row(app, bibcodes, checksums, status):
+    # mark_processed as it was before it became one executemany statement:
+    # one session and one UPDATE per bibcode
+    now = adsputils.get_date()
+    updt = {'processed': now, 'status': status, 'solr_processed': now}
+    for bibcode, checksum in zip(bibcodes, checksums):
+        updt['solr_checksum'] = checksum
+        with app.session_scope() as session:
+            session.query(Records).filter_by(bibcode=bibcode).update(updt, synchronize_session=False)
+            session.commit()
+
+
+@benchmark('mark_processed_per_row')
+def bench_mark_processed_per_row(ctx):
+    # the reference for mark_processed
+    bibcodes = [r['bibcode'] for r in ctx.records]
+    return len(bibcodes), lambda i: _mark_processed_per_row(ctx.app, bibcodes, ctx.checksums, 'success')
+
+
+def _index_solr(ctx, docs, solr):
+    for j in range(0, len(docs), ctx.batch_size):
+        ctx.app.index_solr(docs[j:j + ctx.batch_size], ctx.checksums[j:j + ctx.batch_size], [solr.url])
+
+
+@benchmark('index_solr')
+def bench_index_solr(ctx):
+    solr = StubSolr().start()
+    ctx.cleanup.append(solr.stop)
+    return len(ctx.solr_docs), lambda i: _index_solr(ctx, ctx.solr_docs, solr)
+
+
+@benchmark('index_solr_fallback')
+def bench_index_solr_fallback(ctx):
+    # every batch is rejected and bisected down to single documents
+    solr = StubSolr(max_batch=1).start()
+    ctx.cleanup.append(solr.stop)
+    docs = ctx.solr_docs[:ctx.batch_size]
+    return len(docs), lambda i: _index_solr(ctx, docs, solr)
+
+
+@benchmark('index_metrics')
+def bench_index_metrics(ctx):
+    if not ctx.app._metrics_session:
+        # no metrics database, time the pipeline side only
+        metrics = StubMetrics(ctx.app).start()
+        ctx.cleanup.append(metrics.stop)
+    batch = [r['metrics'] for r in ctx.records]
+
+    def run(i):
+        for j in range(0, len(batch), ctx.batch_size):
+            ctx.app.index_metrics(batch[j:j + ctx.batch_size], ctx.checksums[j:j + ctx.batch_size])
+    return len(batch), run
+
+
+class Context(object):
+
+    def __init__(self, app, payloads, batch_size):
+        self.app = app
+        self.payloads = payloads
+        self.batch_size = batch_size
+        self.cleanup = []
+        self.records = app.get_record([b for b, _ in payloads])
+        self.solr_docs = [solr_updater.transform_json_record(r) for r in self.records]
+        self.checksums = [app.checksum(d) for d in self.solr_docs]
+
+
+def _median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+
+def run_benchmark(ctx, name, repeat):
+    items, run = BENCHMARKS[name](ctx)
+    if run is None:
+        return {'skipped': True}
+    run(-1)  # warm up (caches, connections, lazy imports)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run(i)
+        times.append(time.perf_counter() - start)
+    median = _median(times)
+    return OrderedDict([
+        ('items', items),
+        ('repeat', repeat),
+        ('min', min(times)),
+        ('median', median),
+        ('mean', sum(times) / len(times)),
+        ('items_per_sec', items / median if median else None),
+    ])
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=proj_home,
+                                       stderr=subprocess.STDOUT).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Prints median times against a previous run, returns the names of the
+    benchmarks that got slower by more than threshold (a ratio)"""
+    regressions = []
+    print('%-28s %12s %12s %8s' % ('benchmark', 'baseline [s]', 'current [s]', 'ratio'), file=sys.stderr)
+    for name, current in results['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before or 'median' not in before or 'median' not in current:
+            continue
+        ratio = current['median'] / before['median'] if before['median'] else float('inf')
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  <- slower'
+        print('%-28s %12.4f %12.4f %8.2f%s' % (name, before['median'], current['median'], ratio, flag), file=sys.stderr)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the indexing hot path.')
+    parser.add_argument('-n', '--records', dest='records', type=int, default=500,
+                        help='Number of synthetic records')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=100,
+                        help='Batch size for index_solr/index_metrics, number of documents for index_solr_fallback')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5,
+                        help='Timed repetitions of every benchmark (after one warm up run)')
+    parser.add_argument('--db-url', dest='db_url', default='sqlite:///',
+                        help='Records database; tables are created and dropped, use a scratch database')
+    parser.add_argument('--metrics-url', dest='metrics_url', default=None,
+                        help='Metrics database (postgres), index_metrics uses a stub session without it')
+    parser.add_argument('--no-fulltext', dest='fulltext', action='store_false', default=True,
+                        help='Generate records without fulltext')
+    parser.add_argument('--fulltext-words', dest='fulltext_words', type=int, default=6000,
+                        help='Words in the fulltext body of every record (6000 is ~40KB)')
+    parser.add_argument('--only', dest='only', nargs='+', choices=list(BENCHMARKS.keys()), default=None,
+                        help='Run only these benchmarks')
+    parser.add_argument('-o', '--output', dest='output', default=None,
+                        help='Write the JSON results to this file (default: stdout)')
+    parser.add_argument('--compare', dest='compare', default=None,
+                        help='JSON results of a previous run; exit code is 1 when a benchmark got slower')
+    parser.add_argument('--threshold', dest='threshold', type=float, default=1.1,
+                        help='Ratio of median times reported as slower by --compare')
+    args = parser.parse_args(argv)
+
+    local_config = {'SQLALCHEMY_URL': args.db_url, 'SQLALCHEMY_ECHO': False,
+                    'METRICS_SQLALCHEMY_URL': args.metrics_url}
+    if args.metrics_url:
+        # the app reflects the metrics table when it starts
+        metrics_engine = create_engine(args.metrics_url)
+        MetricsBase.metadata.create_all(bind=metrics_engine)
+    app = app_module.ADSMasterPipelineCelery('benchmarks', proj_home=proj_home, local_config=local_config)
+    # the fallback benchmark logs every rejected post
+    for logger in (app.logger, solr_updater.logger):
+        logger.setLevel(logging.CRITICAL)
+    engine = app._session.get_bind()
+    Base.metadata.create_all(bind=engine)
+
+    ctx = None
+    try:
+        payloads = list(generators.payloads(args.records, with_fulltext=args.fulltext,
+                                                 fulltext_words=args.fulltext_words))
+        for type in ('bib_data', 'nonbib_data', 'orcid_claims', 'metrics', 'fulltext'):
+            app.update_storage_bulk(type, [(b, data[type]) for b, data in payloads if type in data])
+        ctx = Context(app, payloads, args.batch_size)
+
+        results = OrderedDict([
+            ('meta', OrderedDict([
+                ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+                ('git', _git_revision()),
+                ('python', platform.python_version()),
+                ('sqlalchemy', sqlalchemy.__version__),
+                ('db', engine.dialect.name),
+                ('metrics_db', metrics_engine.dialect.name if args.metrics_url else 'stub'),
+                ('cpus', os.cpu_count()),
+                ('records', args.records),
+                ('fulltext', args.fulltext),
+                ('fulltext_words', args.fulltext_words),
+                ('batch_size', args.batch_size),
+            ])),
+            ('results', OrderedDict()),
+        ])
+        for name in args.only or BENCHMARKS.keys():
+            results['results'][name] = run_benchmark(ctx, name, args.repeat)
+    finally:
+        for cleanup in (ctx.cleanup if ctx else []):
+            cleanup()
+        Base.metadata.drop_all(bind=engine)
+        if args.metrics_url:
+            MetricsBase.metadata.drop_all(bind=metrics_engine)
+        app.close_app()
+
+    out = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(out + '\n')
+    else:
+        print(out)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,84 @@
+"""Minimal stand-in for the solr update handler, good enough to time the
+pipeline side of index_solr and delete_by_bibcodes offline.
+
+    with StubSolr(max_batch=1) as solr:
+        app.index_solr(docs, checksums, [solr.url])
+
+Posts with more than `max_batch` documents are rejected with a 400, which
+makes index_solr bisect every batch down to single documents.
+"""
+import json
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer as ThreadingHTTPServer
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like solr
+    # one write per response, otherwise small packets wait for delayed acks
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        data = json.loads(body.decode('utf-8'))
+        stub = self.server.stub
+        docs = data if isinstance(data, list) else []
+        with stub.lock:
+            stub.requests += 1
+            if stub.max_batch and len(docs) > stub.max_batch:
+                stub.rejected += len(docs)
+                status = 400
+            else:
+                stub.docs += len(docs)
+                status = 200
+        if status == 200:
+            out = {'responseHeader': {'status': 0, 'QTime': 1}}
+        else:
+            out = {'responseHeader': {'status': 400}, 'error': {'msg': 'batch rejected by stub', 'code': 400}}
+        out = json.dumps(out).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubSolr(object):
+
+    def __init__(self, max_batch=None, host='127.0.0.1', port=0):
+        self.max_batch = max_batch
+        self.lock = threading.Lock()
+        self.requests = self.docs = self.rejected = 0
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.stub = self
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%s/solr/collection1/update' % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
@@ -21,17 +21,78 @@ METRICS_SQLALCHEMY_URL = None  #'postgres://postgres@localhost:5432/metrics'
 
 # Main Solr
 SOLR_URLS = ["http://localhost:9983/solr/collection1/update"]
+# when several SOLR_URLS are configured, post updates to all of them concurrently
+SOLR_PARALLEL_UPDATES = False
+# max number of bibcodes OR'ed into one solr delete query
+SOLR_DELETE_BATCH_SIZE = 500
 
 # For the run's argument --validate_solr, which compares two Solr instances for
 # the given bibcodes or file of bibcodes
 SOLR_URL_NEW = "http://localhost:9983/solr/collection1/query"
 SOLR_URL_OLD = "http://localhost:9984/solr/collection1/query"
+# bibcodes fetched per query and number of batches (each queried from both
+# solrs) in flight while validating
+SOLR_VALIDATE_BATCH_SIZE = 100
+SOLR_VALIDATE_THREADS = 4
+# text fields longer than this (both values together) are first compared with
+# a cheap shingle estimate, SequenceMatcher only runs when it is close to 0.8
+SOLR_VALIDATE_EXACT_LENGTH = 2000
 
 # url and token for the update endpoint of the links resolver microservice
 # new links data is sent to this url, the mircoservice updates its datastore
 LINKS_RESOLVER_UPDATE_URL = "http://localhost:8080/update"
 ADS_API_TOKEN = "fixme"
 
+# outbound http calls (solr, links resolver, validation) use pooled keep-alive
+# sessions, one per host; timeout is in seconds, retries use exponential backoff
+HTTP_POOL_CONNECTIONS = 10
+HTTP_POOL_MAXSIZE = 10
+HTTP_TIMEOUT = 300
+HTTP_RETRIES = 3
+HTTP_BACKOFF_FACTOR = 0.5
+# status codes retried (GET/PUT/DELETE only, solr update posts handle their own errors)
+HTTP_RETRY_STATUSES = (502, 503, 504)
+
+
+# change_log is partitioned by month on postgres 11+; run.py --prune-changelog
+# creates partitions this many months ahead and deletes leftovers in batches
+CHANGELOG_PARTITIONS_AHEAD = 3
+CHANGELOG_PRUNE_BATCH_SIZE = 10000
+
+
+# number of bibcodes fetched per query when the index tasks load records
+REINDEX_LOAD_CHUNK_SIZE = 1000
+# number of records read per (short) transaction by the run.py reindex producer
+REINDEX_PAGE_SIZE = 1000
+# bibcodes queued for indexing are not queued again (with the same options)
+# until task_index_records picks them up or INDEX_INFLIGHT_TTL seconds passed
+INDEX_INFLIGHT_TTL = 3600
+# reindex_records builds the solr documents of batches with at least
+# SOLR_TRANSFORM_MIN_BATCH records in SOLR_TRANSFORM_PROCESSES worker processes
+# (0 or 1: build them in the worker itself)
+SOLR_TRANSFORM_PROCESSES = 0
+SOLR_TRANSFORM_MIN_BATCH = 200
+
+# per stage timing of the index tasks (db_load, transform, enqueue, http_post,
+# upsert, mark_processed) and counts of the records update_storage wrote or
+# skipped as unchanged: None (off), 'log' (one log line per stage) or
+# 'prometheus' (totals served by every worker process on the first free port
+# from INSTRUMENTATION_PORT, see adsmp/instrumentation.py)
+INSTRUMENTATION = None
+INSTRUMENTATION_PORT = 9105
+# run.py --rebuild-collection pauses queueing when rebuild-index or index-solr
+# hold more than HIGH_WATER messages and resumes once both are below LOW_WATER;
+# the depths are read (from the rabbitmq management api) every CHECK_BATCHES
+# queued batches
+REBUILD_QUEUE_HIGH_WATER = 200
+REBUILD_QUEUE_LOW_WATER = 50
+REBUILD_QUEUE_CHECK_BATCHES = 20
+# run.py --batch-update-record consumes the update-record queue (instead of a
+# celery worker) storing up to BATCH_SIZE messages, or what arrives within
+# BATCH_WAIT milliseconds, with one bulk operation per message type
+UPDATE_RECORD_BATCH_SIZE = 100
+UPDATE_RECORD_BATCH_WAIT = 500
+
 
 ENABLE_HAS = True
 
@@ -16,10 +16,10 @@ except ImportError:
     from urlparse import urlparse
 
 from adsputils import setup_logging, get_date, load_config
-from adsmp.models import KeyValue, Records
+from adsmp.models import Fulltext, KeyValue, Records
 from adsmp import tasks, solr_updater, validate
+from sqlalchemy import case, func, or_, text
 from sqlalchemy.orm import load_only
-from sqlalchemy.orm.attributes import InstrumentedAttribute
 
 # ============================= INITIALIZATION ==================================== #
 proj_home = os.path.realpath(os.path.dirname(__file__))
@@ -39,7 +39,8 @@ def _print_record(bibcode):
         print('stored by us:', bibcode)
         r = session.query(Records).filter_by(bibcode=bibcode).first()
         if r:
-            print(json.dumps(r.toJSON(), indent=2, default=str, sort_keys=True))
+            # fulltext is left out here, it is only loaded to build the solr doc below
+            print(json.dumps(r.toJSON(load_only=Records._row_fields), indent=2, default=str, sort_keys=True))
         else:
             print('None')
         print('-' * 80)
@@ -50,11 +51,79 @@ def _print_record(bibcode):
         print('=' * 80)
 
 
-def diagnostics(bibcodes):
+def record_stats(app, estimate=False):
+    """
+    Counts of the records table: non null values per column, records per
+    status, records waiting to be processed and the oldest of them.
+    The column counts come from one aggregate query; with estimate=True
+    (postgres only) totals, column and status counts are read from the
+    planner statistics instead and the processing state, which needs a
+    scan, is not counted (pending, processed and oldest_pending are None).
+
+    :param: app - the application
+    :param: estimate - use pg_class/pg_stats estimates
+    :return: dict
+    """
+    table = Records.__table__
+    pending = or_(Records.processed.is_(None), Records.processed <= Records.updated)
+    stats = None
+    with app.session_scope() as session:
+        if estimate and session.get_bind().dialect.name == 'postgresql':
+            stats = _estimated_stats(session, table)
+        if stats is None:
+            columns = [c.name for c in table.columns]
+            row = session.query(func.count(), *[func.count(table.c[c]) for c in columns]).one()
+            stats = {'estimated': False,
+                     'total': row[0],
+                     'columns': dict(zip(columns, row[1:])),
+                     'status': dict(session.query(Records.status, func.count()).group_by(Records.status).all())}
+            stats['columns']['fulltext'] = session.query(func.count(Fulltext.bibcode)).scalar()
+        if stats['estimated']:
+            # there are no statistics to estimate it from, only a scan tells
+            stats['pending'] = stats['processed'] = stats['oldest_pending'] = None
+            return stats
+        row = session.query(func.sum(case([(pending, 1)], else_=0)),
+                            func.min(case([(pending, Records.updated)], else_=None))).one()
+        stats['pending'] = row[0] or 0
+        stats['processed'] = stats['total'] - stats['pending']
+        stats['oldest_pending'] = row[1]
+    return stats
+
+
+def _estimated_stats(session, table):
+    # the tables of the current schema, not those of the same name elsewhere
+    totals = dict(session.execute(text("SELECT relname, reltuples FROM pg_class "
+                                       "WHERE relname IN ('records', 'fulltext') AND relkind = 'r' "
+                                       "AND relnamespace = current_schema()::regnamespace")).fetchall())
+    rows = session.execute(text("SELECT attname, null_frac, most_common_vals::text, most_common_freqs "
+                                "FROM pg_stats WHERE tablename = 'records' "
+                                "AND schemaname = current_schema()")).fetchall()
+    if not rows or totals.get('records', -1) < 0:
+        # never analyzed, no statistics to estimate from
+        return None
+    total = int(totals['records'])
+    attrs = dict((r[0], r[1:]) for r in rows)
+    columns = {}
+    for c in table.columns:
+        if c.name in attrs:
+            columns[c.name] = int(round(total * (1 - attrs[c.name][0])))
+    columns['fulltext'] = int(max(totals.get('fulltext', 0), 0))
+    status = {}
+    if 'status' in attrs:
+        null_frac, values, freqs = attrs['status']
+        if values:
+            for value, freq in zip(values.strip('{}').split(','), freqs):
+                status[value] = int(round(total * freq))
+        status[None] = int(round(total * null_frac))
+    return {'estimated': True, 'total': total, 'columns': columns, 'status': status}
+
+
+def diagnostics(bibcodes, estimate=False):
     """
     Show information about what we have in our storage.
 
     :param: bibcodes - list of bibcodes
+    :param: estimate - show estimated counts (from the postgres statistics)
     """
 
     if not bibcodes:
@@ -67,10 +136,20 @@ def diagnostics(bibcodes):
     for b in bibcodes:
         _print_record(b)
 
-    with app.session_scope() as session:
-        for x in dir(Records):
-            if isinstance(getattr(Records, x), InstrumentedAttribute):
-                print('# of %s' % x, session.query(Records).filter(getattr(Records, x) != None).count())
+    stats = record_stats(app, estimate=estimate)
+    if stats['estimated']:
+        print('counts are estimates from the postgres statistics')
+    print('# of records', stats['total'])
+    for x in sorted(stats['columns']):
+        print('# of %s' % x, stats['columns'][x])
+    for x in sorted(stats['status'], key=str):
+        print('# with status %s' % x, stats['status'][x])
+    if stats['estimated']:
+        print('# processed / pending processing: not counted with --estimate')
+    else:
+        print('# processed', stats['processed'])
+        print('# pending processing', stats['pending'])
+        print('oldest pending update', stats['oldest_pending'])
 
     print('sending test bibcodes to the queue for reindexing')
     tasks.task_index_records.apply_async(
@@ -97,12 +176,45 @@ def print_kvs():
             print(kv.key, kv.value)
 
 
+def _reindex_checkpoint_key(key):
+    return key + '.checkpoint'
+
+
+def _save_reindex_checkpoint(key, since, last_id):
+    """Records how far the reindex producer got, so an interrupted run can resume."""
+    with app.session_scope() as session:
+        kv = session.query(KeyValue).filter_by(key=_reindex_checkpoint_key(key)).first()
+        if kv is None:
+            kv = KeyValue(key=_reindex_checkpoint_key(key))
+            session.add(kv)
+        kv.value = json.dumps({'since': since.isoformat(), 'last_id': last_id})
+        session.commit()
+
+
+def _send_index_records(app, bibcodes, kwargs, priority=0):
+    """Queues task_index_records for the bibcodes that are not already in
+    flight with the same kwargs, returns the number of coalesced duplicates"""
+    queued = app.claim_index_requests(bibcodes, kwargs)
+    if queued:
+        try:
+            tasks.task_index_records.apply_async(args=(queued,), kwargs=kwargs, priority=priority)
+        except Exception:
+            app.release_index_requests(queued)
+            raise
+    return len(bibcodes) - len(queued)
+
+
 def reindex(since=None, batch_size=None, force_indexing=False, update_solr=True, update_metrics=True,
             update_links=True, force_processing=False, ignore_checksums=False, solr_targets=None,
             update_processed=True, priority=0):
     """
     Initiates routing of the records (everything that was updated)
     since point in time T.
+
+    Records are read in pages ordered by id (keyset pagination), each page in
+    its own short transaction. When `since` is not given, the id of the last
+    record sent to the queue is checkpointed in the KeyValue table and an
+    interrupted run is resumed from there by the next invocation.
     """
     if force_indexing:
         key = 'last.reindex.forced'
@@ -116,114 +228,94 @@ def reindex(since=None, batch_size=None, force_indexing=False, update_solr=True,
     else:
         key = key + '.metrics-only'
 
-    previous_since = None
+    checkpoint = since is None
+    last_id = 0
     now = get_date()
     if since is None:
         with app.session_scope() as session:
+            cp = session.query(KeyValue).filter_by(key=_reindex_checkpoint_key(key)).first()
             kv = session.query(KeyValue).filter_by(key=key).first()
-            if kv is None:
+            if cp is not None:
+                # previous run did not finish, pick up where it stopped
+                cp = json.loads(cp.value)
+                since = get_date(cp['since'])
+                last_id = cp['last_id']
+                logger.info('Resuming interrupted reindex after record id: %s', last_id)
+            elif kv is None:
                 since = get_date('1972')
                 kv = KeyValue(key=key, value=now.isoformat())
                 session.add(kv)
             else:
                 since = get_date(kv.value)
-                previous_since = since
                 kv.value = now.isoformat()
             session.commit()
+        _save_reindex_checkpoint(key, since, last_id)
     else:
         since = get_date(since)
 
     logger.info('Sending records changed since: %s', since.isoformat())
     sent = 0
+    coalesced = 0
     last_bibcode = None
-    year_zero = adsputils.get_date('1972')
+    page_size = app.conf.get('REINDEX_PAGE_SIZE', 1000)
+
+    def send(batch, commit=False):
+        kwargs = {
+           'force': force_indexing,
+           'update_solr': update_solr,
+           'update_metrics': update_metrics,
+           'update_links': update_links,
+           'ignore_checksums': ignore_checksums,
+           'solr_targets': solr_targets,
+           'update_processed': update_processed,
+           'priority': priority
+        }
+        if commit:
+            kwargs['commit'] = force_indexing
+        return _send_index_records(app, batch, kwargs, priority=priority)
 
     try:
-        # select everything that was updated since
+        # select everything that was updated since, skipping records that
+        # were already processed (unless forced)
         batch = []
-        with app.session_scope() as session:
-            for rec in session.query(Records) \
-                .filter(Records.updated >= since) \
-                .options(load_only(Records.bibcode, Records.updated, Records.processed)) \
-                .yield_per(100):
-
-                if rec.processed is None:
-                    processed = year_zero
-                else:
-                    processed = get_date(rec.processed)
-                updated = get_date(rec.updated)
-
-                if not force_processing and processed > updated:
-                    continue  # skip records that were already processed
-
+        while True:
+            with app.session_scope() as session:
+                q = session.query(Records.id, Records.bibcode) \
+                    .filter(Records.updated >= since) \
+                    .filter(Records.id > last_id)
+                if not force_processing:
+                    q = q.filter(or_(Records.processed.is_(None), Records.processed <= Records.updated))
+                page = q.order_by(Records.id).limit(page_size).all()
+            if not page:
+                break
+
+            for rec_id, bibcode in page:
                 sent += 1
                 if sent % 1000 == 0:
                     logger.debug('Sending %s records', sent)
-
-                if not batch_size or batch_size < 0:
-                    batch.append(rec.bibcode)
-                elif batch_size > len(batch):
-                    batch.append(rec.bibcode)
-                else:
-                    batch.append(rec.bibcode)
-                    tasks.task_index_records.apply_async(
-                        args=(batch,),
-                        kwargs={
-                           'force': force_indexing,
-                           'update_solr': update_solr,
-                           'update_metrics': update_metrics,
-                           'update_links': update_links,
-                           'ignore_checksums': ignore_checksums,
-                           'solr_targets': solr_targets,
-                           'update_processed': update_processed,
-                           'priority': priority
-                        },
-                        priority=priority
-                    )
+                batch.append(bibcode)
+                if batch_size and batch_size > 0 and len(batch) >= batch_size:
+                    coalesced += send(batch)
                     batch = []
-                    last_bibcode = rec.bibcode
+                    last_bibcode = bibcode
+                    if checkpoint:
+                        _save_reindex_checkpoint(key, since, rec_id)
+            last_id = page[-1][0]
 
         if len(batch) > 0:
-            tasks.task_index_records.apply_async(
-                args=(batch,),
-                kwargs={
-                   'force': force_indexing,
-                   'update_solr': update_solr,
-                   'update_metrics': update_metrics,
-                   'update_links': update_links,
-                   'commit': force_indexing,
-                   'ignore_checksums': ignore_checksums,
-                   'solr_targets': solr_targets,
-                   'update_processed': update_processed,
-                   'priority': priority
-                },
-                priority=priority
-            )
+            coalesced += send(batch, commit=True)
         elif force_indexing and last_bibcode:
             # issue one extra call with the commit
-            tasks.task_index_records.apply_async(
-                args=([last_bibcode],),
-                kwargs={
-                   'force': force_indexing,
-                   'update_solr': update_solr,
-                   'update_metrics': update_metrics,
-                   'update_links': update_links,
-                   'commit': force_indexing,
-                   'ignore_checksums': ignore_checksums,
-                   'solr_targets': solr_targets,
-                   'update_processed': update_processed,
-                   'priority': priority
-                },
-                priority=priority
-            )
-        logger.info('Done processing %s records', sent)
-    except Exception as e:
-        if previous_since:
-            logger.error('Failed while submitting data to pipeline, resetting timestamp back to: %s', previous_since)
+            send([last_bibcode], commit=True)
+
+        if checkpoint:
             with app.session_scope() as session:
-                kv = session.query(KeyValue).filter_by(key=key).first()
-                kv.value = previous_since
+                session.query(KeyValue).filter_by(key=_reindex_checkpoint_key(key)).delete()
                 session.commit()
+        logger.info('Done processing %s records, %s duplicate index requests coalesced', sent, coalesced)
+    except Exception as e:
+        if checkpoint:
+            logger.error('Failed while submitting data to pipeline, next run will resume from the checkpoint')
         else:
             logger.error('Failed while submitting data to pipeline')
         raise e
@@ -290,9 +382,45 @@ def delete_obsolete_records(older_than, batch_size=1000):
     logger.info("Deleted {} obsolete records".format(deleted))
 
 
+def prune_changelog(older_than, archive=False):
+    """
+    Removes change log entries older than `older_than` timestamp (permanent
+    entries are kept) and makes sure change_log partitions exist for the
+    coming months; run it at least monthly
+    """
+    if not older_than:
+        raise Exception('This operation requires a valid timestamp')
+
+    app.ensure_changelog_partitions()
+    removed = app.prune_changelog(older_than, archive=archive)
+    logger.info('Pruned %s change_log entries older than %s', removed, older_than)
+
+
+def _wait_for_queues(rabbitmq, queues, high_water, low_water, poll=10.0):
+    """
+    Blocks while any of the queues is deeper than high_water, once paused
+    it resumes only when all of them drained below low_water
+    """
+    depths = [rabbitmq.get_queue_depth('master_pipeline', q) for q in queues]
+    if max(depths) <= high_water:
+        return 0.0
+    start = time.time()
+    logger.info('Pausing, queue depths %s above high water mark %s', dict(zip(queues, depths)), high_water)
+    while max(depths) > low_water:
+        time.sleep(poll)
+        depths = [rabbitmq.get_queue_depth('master_pipeline', q) for q in queues]
+    paused = time.time() - start
+    logger.info('Resuming after %.1fs, queue depths %s', paused, dict(zip(queues, depths)))
+    return paused
+
+
 def rebuild_collection(collection_name, batch_size):
     """
     Will grab all recs from the database and send them to solr
+
+    Bibcodes are read by id in short transactions and queued only while the
+    rebuild-index and index-solr queues stay below the configured water marks
+    (checked every REBUILD_QUEUE_CHECK_BATCHES batches)
     """
     # first, fail if we can not monitor queue length before we queue anything
     u = urlparse(app.conf['OUTPUT_CELERY_BROKER'])
@@ -301,35 +429,51 @@ def rebuild_collection(collection_name, batch_size):
         logger.error('failed to connect to rabbitmq with PyRabbit to monitor queue')
         sys.exit(1)
 
-    now = get_date()
     solr_urls = collection_to_urls(collection_name)
+    high_water = app.conf.get('REBUILD_QUEUE_HIGH_WATER', 200)
+    low_water = app.conf.get('REBUILD_QUEUE_LOW_WATER', 50)
+    check_batches = max(app.conf.get('REBUILD_QUEUE_CHECK_BATCHES', 20), 1)
+    queues = ('rebuild-index', 'index-solr')
 
     logger.info('Sending all records to: %s', ';'.join(solr_urls))
     sent = 0
+    last_id = 0
+    start = time.time()
+    queued = [0]  # batches
+
+    def send(batch):
+        # the queue depths cost one http request per queue
+        if queued[0] % check_batches == 0:
+            _wait_for_queues(rabbitmq, queues, high_water, low_water)
+        tasks.task_rebuild_index.delay(batch, solr_targets=solr_urls)
+        queued[0] += 1
+        elapsed = max(time.time() - start, 1e-6)
+        logger.debug('Queued %s records, %.1f records/sec', sent, sent / elapsed)
 
     batch = []
-    _tasks = []
-    with app.session_scope() as session:
+    while True:
         # master db only contains valid documents, indexing task will make sure that incomplete docs are rejected
-        for rec in session.query(Records) \
-                          .options(load_only(Records.bibcode)) \
-                          .yield_per(batch_size):
-
+        with app.session_scope() as session:
+            page = session.query(Records.id, Records.bibcode) \
+                          .filter(Records.id > last_id) \
+                          .order_by(Records.id) \
+                          .limit(batch_size) \
+                          .all()
+        if not page:
+            break
+        last_id = page[-1][0]
+
+        for rec_id, bibcode in page:
             sent += 1
-            if sent % 1000 == 0:
-                logger.debug('Sending %s records', sent)
-
-            batch.append(rec.bibcode)
-            if len(batch) > batch_size:
-                t = tasks.task_rebuild_index.delay(batch, solr_targets=solr_urls)
-                _tasks.append(t)
+            batch.append(bibcode)
+            if len(batch) >= batch_size:
+                send(batch)
                 batch = []
 
     if len(batch) > 0:
-        t = tasks.task_rebuild_index.delay(batch, solr_targets=solr_urls)
-        _tasks.append(t)
+        send(batch)
 
-    logger.info('Done queueing bibcodes for rebuilding collection %s', collection_name)
+    logger.info('Done queueing %s bibcodes for rebuilding collection %s', sent, collection_name)
     # now wait for rebuild-index queue to empty
     queue_length = 1
     while queue_length > 0:
@@ -348,13 +492,24 @@ def rebuild_collection(collection_name, batch_size):
         time.sleep(stime)
     logger.info('Completed waiting %s for index-solr queue to empty, queue_length %s, sent %s' % (stime, queue_length, sent))
 
-    logger.info('Done rebuilding collection %s, sent %s records', collection_name, sent)
+    elapsed = max(time.time() - start, 1e-6)
+    logger.info('Done rebuilding collection %s, sent %s records, %.1f records/sec', collection_name, sent, sent / elapsed)
 
 
 def reindex_failed_bibcodes(app, update_processed=True):
     """from status field in records table we compute what failed"""
     bibs = []
     count = 0
+    coalesced = 0
+    kwargs = {
+        'force': True,
+        'update_solr': True,
+        'update_metrics': True,
+        'update_links': True,
+        'ignore_checksums': True,
+        'update_processed': update_processed,
+        'priority': 0
+    }
     with app.session_scope() as session:
         for rec in session.query(Records) \
                           .filter(Records.status.notin_(['success', 'retrying'])) \
@@ -365,39 +520,11 @@ def reindex_failed_bibcodes(app, update_processed=True):
             bibs.append(rec.bibcode)
             count += 1
             rec.status = 'retrying'
-            if len(bibs) >= 100:
-                session.commit()
-                tasks.task_index_records.apply_async(
-                    args=(bibs,),
-                    kwargs={
-                       'force': True,
-                       'update_solr': True,
-                       'update_metrics': True,
-                       'update_links': True,
-                       'ignore_checksums': True,
-                       'update_processed': update_processed,
-                       'priority': 0
-                    },
-                    priority=0
-                )
-                bibs = []
-        if bibs:
-            session.commit()
-            tasks.task_index_records.apply_async(
-                args=(bibs,),
-                kwargs={
-                   'force': True,
-                   'update_solr': True,
-                   'update_metrics': True,
-                   'update_links': True,
-                   'ignore_checksums': True,
-                   'update_processed': update_processed,
-                   'priority': 0
-                },
-                priority=0
-            )
-            bibs = []
-        logger.info('Done reindexing %s previously failed bibcodes', count)
+        session.commit()
+    # sent after the session is closed, claiming the requests uses the same (scoped) session
+    for i in range(0, len(bibs), 100):
+        coalesced += _send_index_records(app, bibs[i:i + 100], kwargs)
+    logger.info('Done reindexing %s previously failed bibcodes, %s duplicate index requests coalesced', count, coalesced)
 
 
 if __name__ == '__main__':
@@ -409,6 +536,13 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Show diagnostic message')
 
+    parser.add_argument('--estimate',
+                        dest='estimate',
+                        action='store_true',
+                        default=False,
+                        help='With --diagnostics, show estimated counts from the postgres statistics (no table scans, '
+                             'the processing state is not counted)')
+
     parser.add_argument('-b',
                         '--bibcodes',
                         dest='bibcodes',
@@ -442,6 +576,32 @@ if __name__ == '__main__':
                         default=False,
                         help='Delete records without bib_data that are in the db and that are older than `since` timestamp.')
 
+    parser.add_argument('--prune-changelog',
+                        dest='prune_changelog',
+                        action='store_true',
+                        default=False,
+                        help='Remove change_log entries older than --older-than (permanent entries are kept), ' +
+                        'on postgres whole monthly partitions are dropped and upcoming ones created')
+
+    parser.add_argument('--older-than',
+                        dest='older_than',
+                        action='store',
+                        default=None,
+                        help='Datestamp used by --prune-changelog')
+
+    parser.add_argument('--archive',
+                        dest='archive',
+                        action='store_true',
+                        default=False,
+                        help='With --prune-changelog, detach old partitions but keep them as standalone tables')
+
+    parser.add_argument('--batch-update-record',
+                        dest='batch_update_record',
+                        action='store_true',
+                        default=False,
+                        help='Consume the update-record queue in batches (instead of running a celery worker for it), ' +
+                        'see UPDATE_RECORD_BATCH_SIZE and UPDATE_RECORD_BATCH_WAIT')
+
     parser.add_argument('-k',
                         '--kv',
                         dest='kv',
@@ -537,11 +697,17 @@ if __name__ == '__main__':
 
     # uff: this whole block needs refactoring (as is written, it only allows for single operation)
     if args.diagnostics:
-        diagnostics(args.bibcodes)
+        diagnostics(args.bibcodes, estimate=args.estimate)
 
     elif args.delete_obsolete:
         delete_obsolete_records(args.since, batch_size=args.batch_size)
 
+    elif args.prune_changelog:
+        prune_changelog(args.older_than, archive=args.archive)
+
+    elif args.batch_update_record:
+        tasks.consume_update_record_batches()
+
     elif args.validate:
         fields = ('abstract', 'ack', 'aff', 'alternate_bibcode', 'alternate_title', 'arxiv_class', 'author',
                   'author_count', 'author_facet', 'author_facet_hier', 'author_norm', 'bibgroup', 'bibgroup_facet',
@@ -575,7 +741,12 @@ if __name__ == '__main__':
                 for line in f:
                     bibcode = line.strip()
                     if bibcode:
-                        tasks.task_delete_documents(bibcode)
+                        bibs.append(bibcode)
+                    if len(bibs) >= args.batch_size:
+                        tasks.task_delete_documents_batch(bibs)
+                        bibs = []
+            if bibs:
+                tasks.task_delete_documents_batch(bibs)
         else:
             print('please provide a file of bibcodes to delete via -n')
 
@@ -603,44 +774,30 @@ if __name__ == '__main__':
 
         if args.filename:
             print('sending bibcodes from file to the queue for reindexing')
+            kwargs = {
+                'force': True,
+                'update_solr': update_solr,
+                'update_metrics': update_metrics,
+                'update_links': update_links,
+                'ignore_checksums': args.ignore_checksums,
+                'solr_targets': solr_urls,
+                'priority': args.priority,
+                'update_processed': args.update_processed
+            }
             bibs = []
+            coalesced = 0
             with open(args.filename) as f:
                 for line in f:
                     bibcode = line.strip()
                     if bibcode:
                         bibs.append(bibcode)
                     if len(bibs) >= 100:
-                        tasks.task_index_records.apply_async(
-                            args=(bibs,),
-                            kwargs={
-                                'force': True,
-                                'update_solr': update_solr,
-                                'update_metrics': update_metrics,
-                                'update_links': update_links,
-                                'ignore_checksums': args.ignore_checksums,
-                                'solr_targets': solr_urls,
-                                'priority': args.priority,
-                                'update_processed': args.update_processed
-                            },
-                            priority=args.priority
-                        )
+                        coalesced += _send_index_records(app, bibs, kwargs, priority=args.priority)
                         bibs = []
                 if len(bibs) > 0:
-                    tasks.task_index_records.apply_async(
-                        args=(bibs,),
-                        kwargs={
-                            'force': True,
-                            'update_solr': update_solr,
-                            'update_metrics': update_metrics,
-                            'update_links': update_links,
-                            'ignore_checksums': args.ignore_checksums,
-                            'solr_targets': solr_urls,
-                            'priority': args.priority,
-                            'update_processed': args.update_processed
-                        },
-                        priority=args.priority
-                    )
+                    coalesced += _send_index_records(app, bibs, kwargs, priority=args.priority)
                     bibs = []
+            print('%s duplicate index requests coalesced' % coalesced)
         else:
             print('sending bibcode since date to the queue for reindexing')
             reindex(since=args.since, batch_size=args.batch_size, force_indexing=args.force_indexing,
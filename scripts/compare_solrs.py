@@ -6,14 +6,20 @@ from builtins import str
 import json
 import sys
 import os
-import requests
 import argparse
 import json
 import pickle
+from concurrent.futures import ThreadPoolExecutor
 
 # python compare_solrs.py --solr-endpoints http://adsqb.cfa.harvard.edu:9983/solr/BumblebeeETL/select http://adsqb.cfa.harvard.edu:9983/solr/collection1/select --bibcode stdin fields < testBibcodes.txt
+# python compare_solrs.py --solr-endpoints http://localhost:9983/solr/collection1/select http://localhost:9984/solr/collection1/select collections
+
+homedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if homedir not in sys.path:
+    sys.path.append(homedir)
 
 from adsputils import setup_logging
+from adsmp import http_client
 logger = setup_logging('compare-solr', level='DEBUG')
 
 
@@ -28,22 +34,27 @@ def query_solr(
     rows=200,
     sort='date desc',
     fl=None,
+    cursor_mark=None,
     ):
     d = {
         'q': query,
         'sort': sort,
-        'start': start,
         'rows': rows,
         'wt': 'json',
         'indent': 'true',
         'hl': 'true',
         'hl.fl': 'abstract,ack,body',
         }
+    if cursor_mark:
+        # solr refuses start together with a cursor, highlighting is of no use here
+        d['cursorMark'] = cursor_mark
+        d['hl'] = 'false'
+        del d['hl.fl']
+    else:
+        d['start'] = start
     if fl:
         d['fl'] = fl
-    if fl:
-        d['fl'] = fl
-    response = requests.get(endpoint, params=d)
+    response = http_client.get(endpoint, params=d)
     if response.status_code == 200:
         results = response.json()
         return results
@@ -69,6 +80,84 @@ def parseDocs(result):
 
 
 
+def iter_solr(endpoint, query='*:*', rows=500, fl='*'):
+    """Yields every doc matching the query sorted by bibcode, one page
+    at a time using a solr cursor; the next page is fetched while the
+    current one is consumed"""
+    # the cursor needs the uniqueKey (id) as tie breaker
+    sort = 'bibcode asc,id asc'
+    executor = ThreadPoolExecutor(max_workers=1)
+    # the first page is requested right away, not on the first next()
+    future = executor.submit(query_solr, endpoint, query, rows=rows, sort=sort, fl=fl, cursor_mark='*')
+
+    def docs(future):
+        cursor = '*'
+        try:
+            while True:
+                result = future.result()
+                next_cursor = result['nextCursorMark']
+                if next_cursor != cursor:
+                    future = executor.submit(query_solr, endpoint, query, rows=rows, sort=sort, fl=fl, cursor_mark=next_cursor)
+                for doc in result['response']['docs']:
+                    yield doc
+                if next_cursor == cursor:
+                    return
+                cursor = next_cursor
+        finally:
+            executor.shutdown(wait=False)
+    return docs(future)
+
+
+def merge_join(docs1, docs2):
+    """Pairs up two streams of docs sorted by bibcode, yields
+    (bibcode, doc1, doc2) with None for the side missing the bibcode"""
+    doc1 = next(docs1, None)
+    doc2 = next(docs2, None)
+    while doc1 is not None or doc2 is not None:
+        if doc2 is None or (doc1 is not None and doc1['bibcode'] < doc2['bibcode']):
+            yield doc1['bibcode'], doc1, None
+            doc1 = next(docs1, None)
+        elif doc1 is None or doc2['bibcode'] < doc1['bibcode']:
+            yield doc2['bibcode'], None, doc2
+            doc2 = next(docs2, None)
+        else:
+            yield doc1['bibcode'], doc1, doc2
+            doc1 = next(docs1, None)
+            doc2 = next(docs2, None)
+
+
+def compare_collections(endpoint1, endpoint2, query='*:*', rows=500):
+    """Walks both solrs at once and compares every doc with
+    compare_docs, memory use does not grow with the collection size"""
+    totals = {'same': 0, 'changed': 0, 'added': 0, 'missing': 0}
+    docs1 = iter_solr(endpoint1, query, rows)
+    docs2 = iter_solr(endpoint2, query, rows)
+    for bibcode, doc1, doc2 in merge_join(docs1, docs2):
+        if doc1 is None:
+            totals['added'] += 1
+            message = 'bibcode {} added, only in second solr'.format(bibcode)
+            print(message)
+            logger.warn(message)
+        elif doc2 is None:
+            totals['missing'] += 1
+            message = 'bibcode {} missing, only in first solr'.format(bibcode)
+            print(message)
+            logger.warn(message)
+        else:
+            mismatches = compare_docs(doc1, doc2)
+            if mismatches:
+                totals['changed'] += 1
+                message = 'bibcode {} changed, {} errors: {}'.format(bibcode, len(mismatches), mismatches)
+                print(message)
+                logger.error(message)
+            else:
+                totals['same'] += 1
+    message = 'compared collections: {same} same, {changed} changed, {added} added, {missing} missing'.format(**totals)
+    print(message)
+    logger.info(message)
+    return totals
+
+
 def compare_fields(result1, result2):
     mismatches = []
     if not ('response' in result1 and 'docs' in result1['response']
@@ -88,6 +177,11 @@ def compare_fields(result1, result2):
 
     doc1 = result1['response']['docs'][0]
     doc2 = result2['response']['docs'][0]
+    return compare_docs(doc1, doc2)
+
+
+def compare_docs(doc1, doc2):
+    mismatches = []
     bibcode = doc1['bibcode']  # needed for log messages
 
     # the following fields can't be expected to match so should not be compared
@@ -172,13 +266,9 @@ def isnumber(arg):
 
 
 def query_and_compare(bibcode, endpoint1, endpoint2):
-    the_filter = 'bibcode:{}'.format(bibcode)
-    query = '*'
-    result = {}
-    result1 = query_solr(endpoint1, query, the_filter=the_filter, fl='*'
-                         )
-    result2 = query_solr(endpoint2, query, the_filter=the_filter, fl='*'
-                         )
+    query = 'bibcode:"{}"'.format(bibcode)
+    result1 = query_solr(endpoint1, query, fl='*')
+    result2 = query_solr(endpoint2, query, fl='*')
     failure = compare_fields(result1, result2)
     if len(failure) > 0:
         message = \
@@ -196,7 +286,7 @@ def query_and_compare(bibcode, endpoint1, endpoint2):
 
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('command', help='bibcodes | fields')
+    parser.add_argument('command', help='bibcodes | fields | collections')
 
     parser.add_argument('--solr-endpoints', nargs=2,
                         dest='solr_endpoints', default=[SOLR1_PATH,
@@ -205,16 +295,16 @@ def main():
     parser.add_argument(
         '--query',
         nargs=1,
-        default='star',
+        default=None,
         type=str,
         dest='query',
-        help='"q=" parameter',
+        help='"q=" parameter (default star, *:* for collections)',
         )
 
     parser.add_argument(
         '--bibcode',
         nargs=1,
-        default='2003ASPC..295..361M',
+        default=['2003ASPC..295..361M'],
         type=str,
         dest='bibcode',
         help='compare fields of two solr instances for this bibcode',
@@ -228,7 +318,7 @@ def main():
 
         result = {}
         for endpoint in args.solr_endpoints:
-            result[endpoint] = query_solr(endpoint, args.query)
+            result[endpoint] = query_solr(endpoint, (args.query or ['star'])[0])
 
         data = parseDocs(result)
         for bibcode in data:
@@ -242,20 +332,26 @@ def main():
         if args.bibcode[0] == 'stdin':
             while True:
                 line = sys.stdin.readline()
-            if len(line) == 0:
-                break
-            bibcode = line.strip()
-            mismatch = query_and_compare(bibcode,
-                    args.solr_endpoints[0], args.solr_endpoints[1])
-            if mismatch:
-                print('mismatch on bibcode {}'.format(bibcode))
-            else:
-                failure = query_and_compare(args.bibcode,
+                if len(line) == 0:
+                    break
+                bibcode = line.strip()
+                mismatch = query_and_compare(bibcode,
                         args.solr_endpoints[0], args.solr_endpoints[1])
+                if mismatch:
+                    print('mismatch on bibcode {}'.format(bibcode))
+        else:
+            failure = query_and_compare(args.bibcode[0],
+                    args.solr_endpoints[0], args.solr_endpoints[1])
+    elif args.command == 'collections':
+
+        # walk both solrs sorted by bibcode and diff every doc
+
+        compare_collections(args.solr_endpoints[0], args.solr_endpoints[1], query=(args.query or ['*:*'])[0])
     else:
         print('no command supplied')
         print('use "bibcoces" to see if two solrs have the same bibcodes')
         print('use "fields" to compare fields for the passed bibcodes match between solrs')
+        print('use "collections" to diff every doc of the two solrs')
 
 
 if __name__ == '__main__':
@@ -7,6 +7,8 @@ homedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 if homedir not in sys.path:
     sys.path.append(homedir)
 
+from sqlalchemy import and_, case, exists, func, select
+
 from adsmp import tasks
 from adsmp.models import Records
 
@@ -26,6 +28,15 @@ from adsmp.models import Records
 
 # to run this code one must delete the unique constraint on bibcodes in postgres
 
+# with --all the duplicate bibcodes are found with one GROUP BY query and
+# resolved with sql in batches of --batch-size bibcodes: per column the
+# newest non null value is copied into the row with the lowest id, then
+# the other rows are deleted (the shared fulltext row is left alone).
+# --all only merges rows with exactly the same bibcode; --bibcodes and
+# --filename match with LIKE '%bibcode%', which also catches padded variants
+
+MERGED_FIELDS = ('augments', 'bib_data', 'fulltext', 'metrics', 'nonbib_data', 'orcid_claims')
+
 def main():
     parser = argparse.ArgumentParser(description='Delete duplicate bibcodes from records table')
     parser.add_argument('-n',
@@ -38,9 +49,23 @@ def main():
                         dest='bibcodes',
                         action='store',
                         help='List of bibcodes separated by spaces')
+    parser.add_argument('-a',
+                        '--all',
+                        dest='all',
+                        action='store_true',
+                        help='Find and resolve every duplicated bibcode in the records table')
+    parser.add_argument('--batch-size',
+                        dest='batch_size',
+                        action='store',
+                        type=int,
+                        default=500,
+                        help='Number of duplicated bibcodes resolved per transaction')
 
     args = parser.parse_args()
-    if args.bibcodes:
+    if args.all:
+        n = process_all(tasks.app, batch_size=args.batch_size)
+        print('resolved {} duplicated bibcodes'.format(n))
+    elif args.bibcodes:
         args.bibcodes = args.bibcodes.split(' ')
         for bibcode in args.bibcodes:
             process_bibcode(tasks.app, bibcode)
@@ -51,7 +76,69 @@ def main():
                 if bibcode:
                     process_bibcode(tasks.app, bibcode)
     else:
-        print('error, you must supply either --bibcodes or --filename')
+        print('error, you must supply either --all, --bibcodes or --filename')
+
+
+def find_duplicates(app):
+    """Returns every bibcode that has more than one row, in one pass over the table"""
+    with app.session_scope() as session:
+        q = session.query(Records.bibcode) \
+                   .group_by(Records.bibcode) \
+                   .having(func.count(Records.id) > 1) \
+                   .order_by(Records.bibcode)
+        return [x[0] for x in q]
+
+
+def merge_duplicates(app, bibcodes):
+    """Merges the rows of the given bibcodes into the one with the
+    lowest id and deletes the others, all with sql in one transaction"""
+    table = Records.__table__
+    other = table.alias('other')
+    keepers = select([func.min(other.c.id)]) \
+        .where(other.c.bibcode.in_(bibcodes)) \
+        .group_by(other.c.bibcode)
+
+    values = {}
+    for field in MERGED_FIELDS:
+        updated = other.c[field + '_updated']
+        if field == 'fulltext':
+            # the fulltext itself is in its own table, keyed by bibcode
+            present = updated.isnot(None)
+            columns = (field + '_updated', field + '_payload_checksum')
+        else:
+            present = other.c[field].isnot(None)
+            columns = (field, field + '_updated', field + '_payload_checksum')
+        rows = and_(other.c.bibcode == table.c.bibcode, present)
+        for column in columns:
+            # same order for every column of a field, so they all come from
+            # the same row; the keeper's value stays when no row has one
+            newest = select([other.c[column]]) \
+                .where(rows) \
+                .order_by(updated.is_(None), updated.desc(), other.c.id) \
+                .limit(1) \
+                .scalar_subquery()
+            values[column] = case([(exists().where(rows), newest)], else_=table.c[column])
+    with app.session_scope() as session:
+        session.execute(table.update().where(table.c.id.in_(keepers)).values(values))
+        r = session.execute(table.delete().where(and_(table.c.bibcode.in_(bibcodes),
+                                                      table.c.id.notin_(keepers))))
+        session.commit()
+        return r.rowcount
+
+
+def process_all(app, batch_size=500):
+    """Resolves every duplicated bibcode, batch_size bibcodes per transaction"""
+    bibcodes = find_duplicates(app)
+    process_bibcodes(app, bibcodes, batch_size=batch_size)
+    return len(bibcodes)
+
+
+def process_bibcodes(app, bibcodes, batch_size=500):
+    """Resolves the given bibcodes, batch_size bibcodes per transaction"""
+    for i in range(0, len(bibcodes), batch_size):
+        batch = bibcodes[i:i + batch_size]
+        deleted = merge_duplicates(app, batch)
+        print('merged {} bibcodes, deleted {} duplicate rows'.format(len(batch), deleted))
 
 
 def process_bibcode(app, bibcode):
@@ -69,8 +156,9 @@ def process_bibcode(app, bibcode):
                     if getattr(first, field) is None or getattr(first, field + '_updated') < getattr(rec, field + '_updated'):
                         setattr(first, field, getattr(rec, field))
                         setattr(first, field + '_updated', getattr(rec, field + '_updated'))
-        for rec in recs[1:]:
-            session.delete(rec)
+        # core delete: an orm delete would cascade to the fulltext row the
+        # duplicates share with the record that is kept
+        session.execute(Records.__table__.delete().where(Records.__table__.c.id.in_([rec.id for rec in recs[1:]])))
 
 
 if __name__ == '__main__':
@@ -17,7 +17,7 @@ if proj_home not in sys.path:
     sys.path.append(proj_home)
 
 from subprocess import PIPE, Popen
-from adsmp import tasks
+from adsmp import http_client, tasks
 from adsputils import setup_logging, load_config
 
 
@@ -61,7 +61,7 @@ def run():
 
     try:
         # verify both cores are there
-        cores = requests.get(cores_url + '?wt=json').json()
+        cores = http_client.get(cores_url + '?wt=json').json()
         if set(cores['status'].keys()) != set(['collection1', 'collection2']):
             raise Exception('we dont have both cores available')
 
@@ -70,11 +70,11 @@ def run():
         logger.info('We are starting the indexing into collection2; once finished; we will automatically activate the new core')
 
         logger.info('First, we will delete all documents from collection2')
-        r = requests.post(update_url + '?commit=true&waitSearcher=true', data='<delete><query>*:*</query></delete>', headers={'Content-Type': 'text/xml'}, timeout=60*60)
+        r = http_client.post(update_url + '?commit=true&waitSearcher=true', data='<delete><query>*:*</query></delete>', headers={'Content-Type': 'text/xml'}, timeout=60*60)
         r.raise_for_status()
         logger.info('Done deleting all docs from collection2')
 
-        cores = requests.get(cores_url + '?wt=json').json()
+        cores = http_client.get(cores_url + '?wt=json').json()
         if set(cores['status'].keys()) != set(['collection1', 'collection2']):
             raise Exception('We dont have both cores available')
 
@@ -98,7 +98,7 @@ def run():
 
         # issue commit
         commit_time = datetime.datetime.utcnow()
-        r = requests.get(update_url + '?commit=true&waitSearcher=false')
+        r = http_client.get(update_url + '?commit=true&waitSearcher=false')
         r.raise_for_status()
         logger.info('Issued async commit to SOLR')
 
@@ -106,7 +106,7 @@ def run():
         solr_error_count = 0
         finished = False
         while not finished:
-            r = requests.get(mbean_url)
+            r = http_client.get(mbean_url)
             if r.status_code != 200:
                 solr_error_count += 1
                 if solr_error_count > 2:
@@ -143,7 +143,7 @@ def run():
 
 
         # all is well; swap the cores!
-        r = requests.get(cores_url + '?action=SWAP&core=collection2&other=collection1&wt=json')
+        r = http_client.get(cores_url + '?action=SWAP&core=collection2&other=collection1&wt=json')
         r.raise_for_status()
         logger.info('Swapped collection1 with collection2')
 
@@ -151,7 +151,7 @@ def run():
         time.sleep(30)
 
         # verify the new core is loaded
-        new_cores = requests.get(cores_url + '?wt=json').json()
+        new_cores = http_client.get(cores_url + '?wt=json').json()
         assert_same(cores['status']['collection2']['dataDir'], new_cores['status']['collection1']['dataDir'])
         logger.info('Verified the new collection is in place')
 
@@ -183,7 +183,7 @@ def write_lockfile(lockfile, data):
 def verify_collection2_size(cores_url, min_committed_docs, min_index_size):
     # Try to get info from solr
     try:
-        response = requests.get(cores_url + '?wt=json')
+        response = http_client.get(cores_url + '?wt=json')
         #response.raise_for_status()  # Raise an exception for non-2xx status codes
         cores = response.json()
     except (requests.exceptions.RequestException, json.decoder.JSONDecodeError, ValueError, TypeError) as e:
@@ -225,7 +225,7 @@ def monitor_solr_writes():
     finshed = False
     logger.info('starting to monitor docsPending on solr')
     while not finshed:
-        r = requests.get(mbean_url)
+        r = http_client.get(mbean_url)
         if r.status_code != 200:
             solr_error_count += 1
             if solr_error_count > 2: